@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""
+Compares `encrypt_values` with the batch engine in `encrypt_values_batch`.
+
+Run from the repository root:
+
+    $ python benchmarks/bench_encrypt.py --leaves 500 5000
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from django.conf import settings  # noqa
+
+settings.configure(
+    FIELD_ENCRYPTION_KEY='4MC8zC3jFPdjZm5Mf_2nyi44K8HChtaEoMv8nV6CNMo=',
+)
+
+from django_encrypted_json.batch import encrypt_values_batch  # noqa
+from django_encrypted_json.utils import encrypt_values  # noqa
+
+
+def make_document(leaves):
+    """
+    Returns a document with the given number of leaves, split between
+    strings, ints, floats and booleans in nested dicts and lists.
+    """
+    doc = {}
+    for index in range(leaves // 4):
+        doc['item_%d' % index] = {
+            'name': u'value %d' % index,
+            'count': index,
+            'ratio': index / 3.0,
+            'flags': [index % 2 == 0],
+        }
+    return doc
+
+
+def bench(func, doc, leaves, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func(doc)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return leaves / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--leaves', type=int, nargs='+', default=[500, 5000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print('%8s %16s %16s %8s' % ('leaves', 'serial leaves/s', 'batch leaves/s',
+                                 'speedup'))
+    for leaves in args.leaves:
+        doc = make_document(leaves)
+        leaves = (leaves // 4) * 4
+        serial = bench(encrypt_values, doc, leaves, args.repeat)
+        batch = bench(encrypt_values_batch, doc, leaves, args.repeat)
+        print('%8d %16.0f %16.0f %7.2fx' % (leaves, serial, batch,
+                                            batch / serial))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+# -*- coding=utf-8 -*-
+"""
+Generators for benchmark documents of a controlled shape and size.
+"""
+UNICODE_HODGEPODGE = \
+    u"Testing «ταБЬℓσ»: 1<2 & 4+1>3, now 20% off! ÄŸÃ¼ÅŸiöçı 木下さん利用"
+
+
+def scalar(index):
+    """
+    Returns a leaf value, cycling through the json scalar types.
+    """
+    return [
+        u'value %d' % index,
+        index,
+        index / 3.0,
+        index % 2 == 0,
+        None,
+    ][index % 5]
+
+
+def flat(leaves):
+    """
+    A single dict of leaves.
+    """
+    return {'key_%d' % i: scalar(i) for i in range(leaves)}
+
+
+def nested(leaves, depth=8):
+    """
+    Dicts nested depth levels deep, the leaves spread over the levels.
+    """
+    doc = {}
+    level = doc
+    per_level = max(leaves // depth, 1)
+    index = 0
+    for _ in range(depth):
+        for _ in range(per_level):
+            if index == leaves:
+                break
+            level['key_%d' % index] = scalar(index)
+            index += 1
+        level['child'] = {}
+        level = level['child']
+    return doc
+
+
+def wide_list(leaves):
+    """
+    A list of small records, like an array of line items.
+    """
+    return {
+        'items': [
+            {'sku': u'SKU-%06d' % i, 'qty': i, 'price': i / 7.0,
+             'gift': i % 3 == 0}
+            for i in range(leaves // 4)
+        ],
+    }
+
+
+def unicode_heavy(leaves):
+    """
+    A dict of non-ascii strings.
+    """
+    return {
+        'text_%d' % i: u'%s %d' % (UNICODE_HODGEPODGE, i)
+        for i in range(leaves)
+    }
+
+
+SHAPES = {
+    'flat': flat,
+    'nested': nested,
+    'wide_list': wide_list,
+    'unicode': unicode_heavy,
+}
+
+# skip_keys variations, applied to every shape
+SKIP_KEYS = {
+    'none': (),
+    'some': ('key_0', 'key_1', 'sku', 'text_0'),
+    'many': tuple('key_%d' % i for i in range(0, 1000, 2)) + ('sku', 'qty'),
+    'paths': ('items[*].sku', '*.key_0', '$.text_0'),
+}
+
+
+def count_leaves(data):
+    if isinstance(data, dict):
+        return sum(count_leaves(value) for value in data.values())
+    if isinstance(data, (list, tuple)):
+        return sum(count_leaves(value) for value in data)
+    return 1
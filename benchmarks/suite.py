@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+"""
+Measures encryption, decryption and ORM round trips for generated documents.
+
+Every result is printed as one json object per line, so runs of different
+commits can be compared, e.g. by saving the output and diffing it:
+
+    $ python benchmarks/suite.py > before.jsonl
+    $ python benchmarks/suite.py --orm > after.jsonl
+
+`--orm` also saves and loads `TestModel` rows, this needs the database from
+tests/tests_project/settings.py.  A test database is created and destroyed.
+`--cipher aes-gcm` measures the AEAD tokens instead of Fernet.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'tests'))
+
+from benchmarks import documents  # noqa
+
+
+def setup_django(orm, cipher):
+    import django
+    from django.conf import settings
+
+    if orm:
+        os.environ.setdefault(
+            'DJANGO_SETTINGS_MODULE', 'tests_project.settings')
+    else:
+        settings.configure(
+            FIELD_ENCRYPTION_KEY=[
+                '4MC8zC3jFPdjZm5Mf_2nyi44K8HChtaEoMv8nV6CNMo=',
+                '293xHgWwVwu1CrXTc-i1n5olreSGelFAxsbYcfWl-0k=',
+            ],
+        )
+    django.setup()
+    settings.FIELD_ENCRYPTION_CIPHER = cipher
+
+
+def timed(func, repeat):
+    """
+    Returns the best wall time of func over repeat runs, and its result.
+    """
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.time()
+        result = func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def peak_memory(func):
+    """
+    Returns the growth of the peak RSS, in kB, while running func.
+
+    func runs in a forked child so every measurement starts from the same
+    baseline.
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        func()
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.write(write_fd, str(after - before).encode('ascii'))
+        os._exit(0)
+
+    os.close(write_fd)
+    output = os.read(read_fd, 64)
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    return int(output)
+
+
+def bench_document(shape, skip, leaves, repeat):
+    from django.core.serializers.json import DjangoJSONEncoder
+
+    from django_encrypted_json.batch import encrypt_values_batch
+    from django_encrypted_json.utils import (
+        decrypt_document, decrypt_values, encrypt_document
+    )
+
+    doc = documents.SHAPES[shape](leaves)
+    skip_keys = documents.SKIP_KEYS[skip]
+    plain_size = len(json.dumps(doc, cls=DjangoJSONEncoder))
+    leaf_count = documents.count_leaves(doc)
+
+    modes = {
+        'leaf': (
+            lambda: encrypt_values_batch(doc, skip_keys=skip_keys),
+            decrypt_values,
+        ),
+        'envelope': (
+            lambda: encrypt_document(doc, skip_keys=skip_keys),
+            decrypt_document,
+        ),
+    }
+
+    for mode, (encrypt, decrypt) in sorted(modes.items()):
+        encrypt_time, encrypted = timed(encrypt, repeat)
+        decrypt_time, _ = timed(lambda: decrypt(encrypted), repeat)
+
+        yield {
+            'benchmark': 'document',
+            'shape': shape,
+            'skip_keys': skip,
+            'mode': mode,
+            'leaves': leaf_count,
+            'plain_bytes': plain_size,
+            'overhead_bytes': len(json.dumps(encrypted)) - plain_size,
+            'encrypt_leaves_per_s': int(round(leaf_count / encrypt_time)),
+            'decrypt_leaves_per_s': int(round(leaf_count / decrypt_time)),
+            'encrypt_peak_kb': peak_memory(encrypt),
+            'decrypt_peak_kb': peak_memory(lambda: decrypt(encrypted)),
+        }
+
+
+def bench_orm(shape, leaves, rows):
+    from django.db import connection
+    from test_app.models import TestModel
+
+    doc = documents.SHAPES[shape](leaves)
+    leaf_count = documents.count_leaves(doc)
+
+    TestModel.objects.all().delete()
+    start = time.time()
+    for _ in range(rows):
+        TestModel.objects.create(json=doc)
+    save_time = time.time() - start
+
+    start = time.time()
+    list(TestModel.objects.all())
+    load_time = time.time() - start
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT avg(pg_column_size(json)) FROM test_app_testmodel')
+        stored_bytes = int(cursor.fetchone()[0])
+
+    return {
+        'benchmark': 'orm',
+        'shape': shape,
+        'leaves': leaf_count,
+        'rows': rows,
+        'stored_bytes_per_row': stored_bytes,
+        'save_rows_per_s': int(round(rows / save_time)),
+        'load_rows_per_s': int(round(rows / load_time)),
+    }
+
+
+def get_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+            stderr=subprocess.STDOUT).strip().decode('ascii')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--leaves', type=int, nargs='+', default=[100, 1000])
+    parser.add_argument('--shapes', nargs='+', default=sorted(
+        documents.SHAPES), choices=sorted(documents.SHAPES))
+    parser.add_argument('--skip-keys', nargs='+', default=sorted(
+        documents.SKIP_KEYS), choices=sorted(documents.SKIP_KEYS))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--orm', action='store_true',
+                        help='also run save/load round trips on TestModel')
+    parser.add_argument('--rows', type=int, default=100)
+    parser.add_argument('--cipher', default='fernet')
+    args = parser.parse_args()
+
+    setup_django(args.orm, args.cipher)
+
+    def emit(result):
+        result['revision'] = revision
+        result['cipher'] = args.cipher
+        print(json.dumps(result, sort_keys=True))
+        sys.stdout.flush()
+
+    revision = get_revision()
+
+    for shape in args.shapes:
+        for leaves in args.leaves:
+            for skip in args.skip_keys:
+                for result in bench_document(shape, skip, leaves, args.repeat):
+                    emit(result)
+
+    if args.orm:
+        from django.db import connection
+
+        name = connection.creation.create_test_db(verbosity=0)
+        try:
+            for shape in args.shapes:
+                for leaves in args.leaves:
+                    emit(bench_orm(shape, leaves, args.rows))
+        finally:
+            connection.creation.destroy_test_db(name, verbosity=0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+import base64
+import os
+import struct
+import time
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.hmac import HMAC
+from . import utils
+from .ciphers import FERNET
+from .encoding import get_encoder_class
+from .lazy import (
+    LazyContainer, LazyDecryptedDict, LazyDecryptedList, materialize
+)
+from .skip_rules import compile_skip_keys
+
+IV_SIZE = 16
+BLOCK_SIZE = 16
+
+
+class BatchFernet(object):
+    """
+    Encrypts many values at once, producing standard Fernet tokens.
+
+    A plain `Fernet.encrypt` call reads the clock, reads 16 random bytes and
+    builds new padding, cipher and HMAC objects for every value.  This class
+    does that work once per batch instead: the IVs for the whole batch come
+    from a single `os.urandom` read, every token shares one timestamp, and the
+    AES key and keyed HMAC state are reused (the HMAC is copied, not re-keyed).
+
+    The tokens are byte for byte what `Fernet._encrypt_from_parts` would
+    produce, so `Fernet.decrypt`/`MultiFernet.decrypt` read them as usual.
+    """
+
+    def __init__(self, fernet, backend=None):
+        """
+        Arguments:
+            fernet (cryptography.fernet.Fernet): the key to encrypt with.
+            backend: the cryptography backend, defaults to the backend of
+                the fernet instance.
+        """
+        self._backend = backend or getattr(
+            fernet, '_backend', None) or default_backend()
+        self._algorithm = algorithms.AES(fernet._encryption_key)
+        self._hmac = HMAC(
+            fernet._signing_key, hashes.SHA256(), backend=self._backend)
+
+    def encrypt_many(self, payloads, current_time=None):
+        """
+        Returns a list of Fernet tokens, one for each of the payloads.
+
+        Arguments:
+            payloads (list[bytes]): the data to encrypt.
+            current_time (int): the timestamp to embed, defaults to now.
+
+        Returns:
+            list[bytes]
+        """
+        if not payloads:
+            return []
+
+        if current_time is None:
+            current_time = int(time.time())
+
+        prefix = b"\x80" + struct.pack(">Q", current_time)
+        ivs = os.urandom(IV_SIZE * len(payloads))
+
+        tokens = []
+        for index, data in enumerate(payloads):
+            if not isinstance(data, bytes):
+                raise TypeError("data must be bytes.")
+
+            iv = ivs[index * IV_SIZE:(index + 1) * IV_SIZE]
+
+            # PKCS7, same as padding.PKCS7(128).padder() but without the
+            # per value padder object.
+            pad = BLOCK_SIZE - len(data) % BLOCK_SIZE
+            encryptor = Cipher(
+                self._algorithm, modes.CBC(iv), self._backend
+            ).encryptor()
+            ciphertext = (
+                encryptor.update(data + chr(pad) * pad) + encryptor.finalize()
+            )
+
+            basic_parts = prefix + iv + ciphertext
+            h = self._hmac.copy()
+            h.update(basic_parts)
+            tokens.append(
+                base64.urlsafe_b64encode(basic_parts + h.finalize()))
+
+        return tokens
+
+
+def encrypt_many(payloads, ring=None):
+    """
+    Returns the tokens of the payloads encrypted with the primary key of
+    ring, in one batch, tagged when the ring tags tokens.
+
+    Arguments:
+        payloads (list[bytes]): the data to encrypt.
+        ring (KeyRing): the keys, defaults to `utils.get_crypter()`.
+
+    Returns:
+        list[str]
+    """
+    ring = ring or utils.get_crypter()
+    if ring.cipher == FERNET:
+        tokens = BatchFernet(ring.primary).encrypt_many(payloads)
+    else:
+        tokens = ring.primary_aead.encrypt_many(payloads)
+
+    if ring.tag_tokens:
+        tokens = [ring.tag(token) for token in tokens]
+    return tokens
+
+
+def flatten_values(data, skip_keys=None, encoder_class=None, _state=None,
+                   in_place=False):
+    """
+    Returns a copy of the data tree and the encryptable leaves it contains.
+
+    The copy has the same shape as data, with lists, tuples and sets turned
+    into lists just like `encrypt_values` does.  Each leaf is returned as a
+    `(container, key, payload)` triple where payload is the leaf serialized to
+    bytes and `container[key]` is the slot in the copy the encrypted value
+    belongs in.  Values matched by the skip_keys rules are copied as is.
+
+    Lazy containers are copied too, but their untouched tokens are reused
+    instead of being returned as leaves.
+
+    With `in_place=True` the dicts and lists of data are reused instead of
+    copied, see `utils.decrypt_values` for when that is safe.
+
+    Arguments:
+        data (object): the data to flatten.
+        skip_keys (list[str]): a list of keys or paths that should not be
+            encrypted, see `django_encrypted_json.skip_rules`
+        encoder_class: the json encoder class used for non string values.
+        in_place (bool): reuse the dicts and lists of data.
+
+    Returns:
+        tuple(object, list[tuple])
+    """
+    rules = compile_skip_keys(skip_keys)
+    encoder_class = encoder_class or get_encoder_class()
+    encode_leaf = utils.get_leaf_encoder()
+
+    # A single root slot lets scalar documents share the same code path.
+    root = [data]
+    leaves = []
+    stack = [(root, 0, data, rules.root if _state is None else _state)]
+
+    while stack:
+        container, key, value, state = stack.pop()
+
+        if isinstance(value, (list, tuple, set)):
+            copy = value if in_place and isinstance(value, list) \
+                else list(value)
+            container[key] = copy
+            for index, item in enumerate(copy):
+                skipped, item_state = rules.enter(state, index, index=True)
+                if skipped:
+                    if isinstance(item, LazyContainer):
+                        copy[index] = materialize(item)
+                else:
+                    stack.append((copy, index, item, item_state))
+
+        elif isinstance(value, dict):
+            copy = value if in_place else {}
+            container[key] = copy
+            for item_key, item in value.iteritems():
+                skipped, item_state = rules.enter(state, item_key)
+                if skipped:
+                    if isinstance(item, LazyContainer):
+                        item = materialize(item)
+                    copy[item_key] = item
+                else:
+                    stack.append((copy, item_key, item, item_state))
+
+        elif isinstance(value, (LazyDecryptedDict, LazyDecryptedList)):
+            is_list = isinstance(value, LazyDecryptedList)
+            if is_list:
+                copy = [None] * len(value)
+                item_keys = range(len(value))
+            else:
+                copy = {}
+                item_keys = list(value)
+            container[key] = copy
+
+            for item_key in item_keys:
+                untouched, raw = value.raw_value(item_key)
+                skipped, item_state = rules.enter(
+                    state, item_key, index=is_list)
+                if skipped:
+                    copy[item_key] = (
+                        raw if untouched else materialize(value[item_key]))
+                elif untouched and utils.is_token(raw):
+                    copy[item_key] = raw
+                else:
+                    stack.append(
+                        (copy, item_key, value[item_key], item_state))
+
+        else:
+            leaves.append(
+                (container, key, encode_leaf(value, encoder_class)))
+
+    return root, leaves
+
+
+def encrypt_values_batch(data, skip_keys=None, fernet=None, compressor=None,
+                         _state=None, in_place=False, ring=None):
+    """
+    Returns data with values it contains encrypted in a single batch.
+
+    This is equivalent to `encrypt_values` using the primary key from
+    settings.FIELD_ENCRYPTION_KEY, but instead of recursing and encrypting
+    each leaf on its own it flattens the document, encrypts every leaf with
+    one `BatchFernet` pass, or one pass of the AEAD cipher set by
+    `FIELD_ENCRYPTION_CIPHER`, and writes the tokens back into the copy.
+
+    Arguments:
+        data (object): the data to encrypt.
+        skip_keys (list[str]): a list of keys that should not be encrypted
+        fernet (cryptography.fernet.Fernet): the key to encrypt with,
+            defaults to the first key in settings.FIELD_ENCRYPTION_KEY.
+            Tokens are only tagged with the key id when using the default.
+        compressor (Compressor): compresses large leaves before they are
+            encrypted, see `django_encrypted_json.compression`.
+        in_place (bool): write the tokens into the dicts and lists of data
+            instead of a copy, see `utils.decrypt_values` for when that is
+            safe.
+        ring (KeyRing): the keys to encrypt with when fernet isn't given,
+            defaults to `utils.get_crypter()`.
+
+    Returns:
+        object
+    """
+    root, leaves = flatten_values(
+        data, skip_keys, _state=_state, in_place=in_place)
+
+    payloads = [payload for _, _, payload in leaves]
+    if compressor is not None:
+        payloads = [compressor.compress(payload) for payload in payloads]
+
+    if fernet is None:
+        tokens = encrypt_many(payloads, ring)
+    else:
+        tokens = BatchFernet(fernet).encrypt_many(payloads)
+
+    for (container, key, _), token in zip(leaves, tokens):
+        container[key] = token
+
+    return root[0]
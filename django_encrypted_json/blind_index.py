@@ -0,0 +1,213 @@
+"""
+Blind indexes, equality lookups on encrypted values.
+
+Fernet tokens are randomized, the same value never encrypts to the same
+token twice, so the database can't compare encrypted values.  A field with
+`blind_index` paths also stores a keyed HMAC digest of the value found at
+each path:
+
+    {
+        'email': 'gAAAAA...',
+        'user': {'name': 'gAAAAA...'},
+        '__blind__': {'email': '3f1c...'}
+    }
+
+Equal values produce equal digests, so `filter(data__blind__email=value)`
+compares the digest of value with the stored one in SQL and can use an
+expression index on `(data -> '__blind__' ->> 'email')`.  Nested paths are
+dotted, list items are addressed by their index:
+
+    Model.objects.filter(**{'data__blind__user.emails.0': value})
+
+The digests are keyed with `FIELD_BLIND_INDEX_KEY`, which must differ from
+the encryption keys.  `__blind__` is a reserved top level key, documents
+using it are rejected.  A blind index reveals which rows share a value, only
+index values that are unique enough for that to be acceptable.
+"""
+import hashlib
+import hmac
+from collections import Mapping, Sequence
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import CharField, Transform
+
+from .encoding import canonical_bytes
+
+BLIND_INDEX_KEY = '__blind__'
+PATH_SEPARATOR = '.'
+
+
+def get_blind_index_key():
+    """
+    Returns the HMAC key from settings.FIELD_BLIND_INDEX_KEY.
+
+    Raises:
+        ImproperlyConfigured: if the key is missing or is also an
+            encryption key.
+    """
+    key = getattr(settings, 'FIELD_BLIND_INDEX_KEY', None)
+    if not key:
+        raise ImproperlyConfigured(
+            'FIELD_BLIND_INDEX_KEY is required to use blind indexes.')
+
+    encryption_keys = settings.FIELD_ENCRYPTION_KEY
+    if isinstance(encryption_keys, dict):
+        encryption_keys = list(encryption_keys.values())
+    elif not isinstance(encryption_keys, (list, tuple)):
+        encryption_keys = [encryption_keys]
+    if key in encryption_keys:
+        raise ImproperlyConfigured(
+            'FIELD_BLIND_INDEX_KEY must not be one of the '
+            'FIELD_ENCRYPTION_KEY keys.')
+
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return key
+
+
+def blind_digest(path, value, key=None):
+    """
+    Returns the hex HMAC-SHA256 digest of the value at the path.
+
+    The path is part of the digest, so equal values under different paths
+    can't be matched against each other.
+
+    Arguments:
+        path (str): the indexed path.
+        value (object): the plaintext value.
+        key (bytes): the HMAC key, defaults to FIELD_BLIND_INDEX_KEY.
+
+    Returns:
+        str
+    """
+    key = key or get_blind_index_key()
+    message = path.encode('utf-8') + b'\0' + canonical_bytes(value)
+    return hmac.new(key, message, hashlib.sha256).hexdigest()
+
+
+def get_path(data, path):
+    """
+    Returns a `(found, value)` tuple for the path in data, a dotted string
+    or a list of keys and list indexes.
+
+    Returns:
+        tuple(bool, object)
+    """
+    if isinstance(path, basestring):
+        path = path.split(PATH_SEPARATOR)
+
+    value = data
+    for part in path:
+        if isinstance(value, Mapping):
+            if not isinstance(part, basestring):
+                part = unicode(part)
+            if part not in value:
+                return False, None
+            value = value[part]
+        elif isinstance(value, Sequence) and \
+                not isinstance(value, basestring):
+            try:
+                value = value[int(part)]
+            except (ValueError, IndexError):
+                return False, None
+        else:
+            return False, None
+
+    return True, value
+
+
+def build_blind_index(data, paths):
+    """
+    Returns the `{path: digest}` index of the plaintext data.
+
+    Paths missing from data are left out of the index.
+
+    Arguments:
+        data (object): the plaintext document.
+        paths (list[str]): the dotted paths to index.
+
+    Returns:
+        dict
+    """
+    key = get_blind_index_key()
+    index = {}
+    for path in paths:
+        found, value = get_path(data, path)
+        if found:
+            index[path] = blind_digest(path, value, key)
+    return index
+
+
+def strip_blind_index(data):
+    """
+    Returns the stored data without its blind index.
+    """
+    if isinstance(data, dict) and BLIND_INDEX_KEY in data:
+        data = dict(data)
+        del data[BLIND_INDEX_KEY]
+    return data
+
+
+class BlindDigestField(CharField):
+    """
+    The output field of a blind index path, the operands of its lookups are
+    replaced by their digest.
+    """
+
+    lookups = ('exact', 'in', 'isnull')
+
+    def __init__(self, path, *args, **kwargs):
+        self.path = path
+        super(BlindDigestField, self).__init__(*args, **kwargs)
+
+    def get_lookup(self, lookup_name):
+        if lookup_name not in self.lookups:
+            return None
+        return super(BlindDigestField, self).get_lookup(lookup_name)
+
+    def get_prep_value(self, value):
+        return blind_digest(self.path, value)
+
+
+class BlindIndexKeyTransform(Transform):
+    """
+    Selects the stored digest of one path, `(column -> '__blind__' ->> path)`.
+    """
+
+    def __init__(self, path, *args, **kwargs):
+        super(BlindIndexKeyTransform, self).__init__(*args, **kwargs)
+        self.path = path
+        self.output_field = BlindDigestField(path)
+
+    def as_sql(self, qn, connection):
+        lhs, params = qn.compile(self.lhs)
+        return "(%s ->> %%s)" % lhs, params + [self.path]
+
+
+class BlindIndexKeyTransformFactory(object):
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, *args, **kwargs):
+        return BlindIndexKeyTransform(self.path, *args, **kwargs)
+
+
+class BlindIndexTransform(Transform):
+    """
+    The `blind` transform, the next lookup name is the path to compare.
+    """
+
+    lookup_name = 'blind'
+
+    def as_sql(self, qn, connection):
+        lhs, params = qn.compile(self.lhs)
+        return "(%s -> '%s')" % (lhs, BLIND_INDEX_KEY), params
+
+    def get_lookup(self, lookup_name):
+        return None
+
+    def get_transform(self, path):
+        if path not in getattr(self.lhs.output_field, 'blind_index', ()):
+            return None
+        return BlindIndexKeyTransformFactory(path)
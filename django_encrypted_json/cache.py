@@ -0,0 +1,151 @@
+import copy
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.signals import setting_changed
+
+from .signals import keys_reloaded
+
+
+class LRUCache(object):
+    """
+    A bounded, thread safe LRU cache counting its hits and misses.
+
+    The least recently used entries are evicted once `max_size` entries are
+    stored.  Subclasses can expire entries with `is_expired`.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def is_expired(self, value):
+        return False
+
+    def lookup(self, key):
+        """
+        Returns a `(found, value)` tuple for the key.
+
+        Returns:
+            tuple(bool, object)
+        """
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                value = None
+            else:
+                if not self.is_expired(value):
+                    # re-insert to mark the entry as the most recently used
+                    self._entries[key] = value
+                    self.hits += 1
+                    return True, value
+
+            self.misses += 1
+            return False, None
+
+    def store(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """
+        Returns the hit and miss counters and the current size.
+
+        Returns:
+            dict
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._entries),
+            'max_size': self.max_size,
+        }
+
+
+class DecryptionCache(LRUCache):
+    """
+    A bounded, thread safe LRU cache of decrypted values keyed by token.
+
+    Equal tokens always decrypt to the same value, so the cache never needs
+    to be invalidated, the least recently used entries are simply evicted
+    once `max_size` entries are stored.  Mutable values are copied on the
+    way in and out so callers can't change the cached value.
+    """
+
+    def get(self, token):
+        """
+        Returns a `(found, value)` tuple for the token.
+
+        Returns:
+            tuple(bool, object)
+        """
+        found, value = self.lookup(token)
+        if isinstance(value, (dict, list)):
+            value = copy.deepcopy(value)
+        return found, value
+
+    def set(self, token, value):
+        if isinstance(value, (dict, list)):
+            value = copy.deepcopy(value)
+        self.store(token, value)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_decryption_cache():
+    """
+    Returns the process wide `DecryptionCache`, or None when disabled.
+
+    The cache is enabled by setting `FIELD_ENCRYPTION_CACHE_SIZE` to the
+    maximum number of decrypted values to keep.
+
+    Returns:
+        DecryptionCache or None
+    """
+    global _cache
+
+    max_size = getattr(settings, 'FIELD_ENCRYPTION_CACHE_SIZE', 0)
+    if not max_size:
+        return None
+
+    with _cache_lock:
+        if _cache is None or _cache.max_size != max_size:
+            _cache = DecryptionCache(max_size)
+        return _cache
+
+
+def reset_decryption_cache(**kwargs):
+    """
+    Drops the cache, when its size changes or the keys are reloaded.
+
+    A removed key must stop decrypting values, including cached ones.
+    """
+    global _cache
+
+    if kwargs.get('setting', 'FIELD_ENCRYPTION_CACHE_SIZE') == \
+            'FIELD_ENCRYPTION_CACHE_SIZE':
+        with _cache_lock:
+            _cache = None
+
+
+setting_changed.connect(reset_decryption_cache)
+keys_reloaded.connect(reset_decryption_cache)
@@ -0,0 +1,210 @@
+"""
+Saving unchanged values without encrypting them again.
+
+Every encryption uses a fresh IV, so saving a value that was only loaded
+rewrites the whole document with new tokens.  When a stored document is
+loaded, the decrypted dict or list is returned as a `TrackedDict` or
+`TrackedList` that remembers the stored value and a fingerprint of the
+decrypted one.  If the fingerprint still matches when the field is saved,
+the stored value is written back as is.
+
+A loaded value therefore exists twice, as stored tokens and decrypted, and
+the field can't decrypt it in place.  The fingerprint itself is computed
+without serializing the whole document at once.  Fields with `lazy=True`
+aren't tracked and only decrypt what is read, the exports in
+`django_encrypted_json.export` decrypt in place.
+
+`SkipUnchangedFieldsMixin` goes one step further and leaves the unchanged
+encrypted fields out of the UPDATE.
+
+Unchanged values keep the key they were encrypted with, re-encrypt them
+with `rotate_encryption_keys` after adding a key.  Fields with
+`key_resolver` only reuse the stored tokens while they are encrypted with
+the key of the instance, a row moved to another key id is encrypted again.
+"""
+import hashlib
+
+from . import utils
+from .blind_index import BLIND_INDEX_KEY
+from .encoding import iter_canonical_bytes
+from .skip_rules import compile_skip_keys
+
+
+class Tracked(object):
+    """
+    Base class of the containers that remember their stored value.
+    """
+
+    def track(self, stored, fingerprint):
+        self.stored = stored
+        self.fingerprint = fingerprint
+        return self
+
+    def get_stored(self):
+        """
+        Returns the stored value when the container is unchanged, or None.
+        """
+        if fingerprint(self) == self.fingerprint:
+            return self.stored
+        return None
+
+
+class TrackedDict(Tracked, dict):
+    """
+    A decrypted dict loaded from the database.
+    """
+
+
+class TrackedList(Tracked, list):
+    """
+    A decrypted list loaded from the database.
+    """
+
+
+def fingerprint(value):
+    """
+    Returns a digest of the value, or None when it can't be serialized.
+
+    The value is hashed while it is serialized, so a large document is never
+    held as a single string.
+
+    Returns:
+        bytes
+    """
+    digest = hashlib.sha1()
+    try:
+        for chunk in iter_canonical_bytes(value):
+            digest.update(chunk)
+    except (TypeError, ValueError):
+        return None
+    return digest.digest()
+
+
+def is_fully_encrypted(stored, skip_keys=()):
+    """
+    Returns True when every value of the stored document outside of
+    skip_keys is a token, so it is exactly what saving it would write.
+
+    Returns:
+        bool
+    """
+    if utils.is_envelope(stored):
+        return True
+
+    if not isinstance(stored, (dict, list)):
+        return False
+
+    rules = compile_skip_keys(skip_keys)
+    stack = [(stored, rules.root)]
+    while stack:
+        container, state = stack.pop()
+        is_list = isinstance(container, list)
+        if is_list:
+            items = enumerate(container)
+        else:
+            items = (
+                (key, value) for key, value in container.iteritems()
+                if key != BLIND_INDEX_KEY
+            )
+
+        for key, value in items:
+            skipped, item_state = rules.enter(state, key, index=is_list)
+            if skipped:
+                continue
+            if isinstance(value, (dict, list)):
+                stack.append((value, item_state))
+            elif not utils.is_token(value):
+                return False
+
+    return True
+
+
+def track(value, stored, skip_keys=()):
+    """
+    Returns the decrypted value wrapped so it remembers the stored value.
+
+    Values that aren't dicts or lists, or whose stored value isn't fully
+    encrypted, are returned as they are.
+
+    Arguments:
+        value (object): the decrypted value.
+        stored (object): the value as it was loaded from the database.
+        skip_keys (list[str]): the keys stored in plaintext.
+
+    Returns:
+        object
+    """
+    if isinstance(value, dict):
+        tracked_class = TrackedDict
+    elif isinstance(value, list):
+        tracked_class = TrackedList
+    else:
+        return value
+
+    if not is_fully_encrypted(stored, skip_keys):
+        return value
+
+    digest = fingerprint(value)
+    if digest is None:
+        return value
+
+    return tracked_class(value).track(stored, digest)
+
+
+def get_stored(value):
+    """
+    Returns the stored value of an unchanged tracked value, or None.
+    """
+    if isinstance(value, Tracked):
+        return value.get_stored()
+    return None
+
+
+def get_unchanged_fields(instance):
+    """
+    Returns the names of the encrypted fields of instance that were loaded
+    from the database and have not changed since.
+
+    Returns:
+        list[str]
+    """
+    from .fields import EncryptedValueJsonField
+
+    unchanged = []
+    for field in instance._meta.concrete_fields:
+        if not isinstance(field, EncryptedValueJsonField) or \
+                field.attname not in instance.__dict__:
+            continue
+
+        stored = get_stored(instance.__dict__[field.attname])
+        if stored is not None and \
+                field.is_current(stored, field.get_key_ring(instance)):
+            unchanged.append(field.name)
+
+    return unchanged
+
+
+class SkipUnchangedFieldsMixin(object):
+    """
+    A model mixin leaving unchanged encrypted fields out of the UPDATE when
+    `save()` is called without `update_fields`.
+
+    Only the UPDATE statement changes, `save()` otherwise behaves as usual:
+    the signals are sent, and an instance whose row was deleted is inserted
+    again with all of its fields.
+    """
+
+    def _do_update(self, base_qs, using, pk_val, values, update_fields,
+                   forced_update):
+        if update_fields is None:
+            unchanged = get_unchanged_fields(self)
+            if unchanged:
+                values = [
+                    value for value in values
+                    if value[0].name not in unchanged
+                ]
+
+        # Without values Django checks that the row exists, so a deleted
+        # row is still inserted.
+        return super(SkipUnchangedFieldsMixin, self)._do_update(
+            base_qs, using, pk_val, values, update_fields, forced_update)
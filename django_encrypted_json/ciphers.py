@@ -0,0 +1,206 @@
+"""
+AEAD ciphers, an alternative to Fernet tokens.
+
+Fernet encrypts with AES-CBC and authenticates with a separate HMAC-SHA256
+pass, and its token carries a version byte, a timestamp, an IV, up to a block
+of padding and the HMAC before being base64 encoded.  The AEAD ciphers do
+both in a single pass and their token is only
+
+    prefix + urlsafe_b64(nonce + ciphertext + tag)
+
+without padding, where the prefix names the cipher and its version, e.g.
+`a1.` for AES-GCM and `c1.` for ChaCha20-Poly1305.  The prefix is also the
+associated data, so a token can't be read as another cipher's.
+
+Set `FIELD_ENCRYPTION_CIPHER` to 'aes-gcm' or 'chacha20-poly1305' to write
+AEAD tokens.  Fernet tokens and the tokens of every registered cipher are
+always read, so existing rows can be migrated with `rotate_encryption_keys`.
+
+The AEAD keys are derived with HKDF-SHA256 from the `FIELD_ENCRYPTION_KEY`
+keys, one key per cipher, so no new keys have to be managed and the Fernet
+keys can't be recovered from them.  Tokens are tagged with the key id like
+Fernet tokens, see `utils.KeyRing`.
+"""
+import base64
+import binascii
+import os
+import re
+
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import InvalidToken
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import (
+    AESGCM, ChaCha20Poly1305
+)
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+FERNET = 'fernet'
+
+NONCE_SIZE = 12
+TAG_SIZE = 16
+
+# The nonce and the tag of an empty payload, base64 encoded without padding.
+AEAD_TOKEN_MIN_LENGTH = 38
+
+AEAD_BODY_RE = re.compile(r'^[A-Za-z0-9_-]+$')
+
+_ciphers = {}
+_prefixes = {}
+
+
+def register_cipher(name, prefix, algorithm):
+    """
+    Registers an AEAD cipher.
+
+    Arguments:
+        name (str): the value of `FIELD_ENCRYPTION_CIPHER` selecting it.
+        prefix (str): the prefix of its tokens, e.g. 'a1.', it must end with
+            a '.' and must not contain ':'.
+        algorithm: a class with the interface of
+            `cryptography.hazmat.primitives.ciphers.aead.AESGCM`, taking a
+            32 byte key and a 12 byte nonce.
+    """
+    if not prefix.endswith('.') or ':' in prefix:
+        raise ValueError("Cipher prefixes must end with '.', without ':'")
+    _ciphers[name] = (prefix, algorithm)
+    _prefixes[prefix] = name
+
+
+register_cipher('aes-gcm', 'a1.', AESGCM)
+register_cipher('chacha20-poly1305', 'c1.', ChaCha20Poly1305)
+
+
+def is_cipher(name):
+    return name == FERNET or name in _ciphers
+
+
+def get_token_cipher(token):
+    """
+    Returns the name of the AEAD cipher of an untagged token, or None.
+
+    Returns:
+        str
+    """
+    prefix, separator, _ = token.partition('.')
+    if not separator:
+        return None
+    return _prefixes.get(prefix + separator)
+
+
+def is_aead_token(data):
+    """
+    Returns True if data, untagged, has the shape of an AEAD token.
+
+    Returns:
+        bool
+    """
+    name = get_token_cipher(data)
+    if name is None:
+        return False
+
+    body = data[len(_ciphers[name][0]):]
+    return (
+        len(body) >= AEAD_TOKEN_MIN_LENGTH and
+        len(body) % 4 != 1 and
+        AEAD_BODY_RE.match(body) is not None
+    )
+
+
+def derive_key(fernet, name):
+    """
+    Returns the 32 byte key of the cipher derived from a Fernet key.
+
+    Arguments:
+        fernet (cryptography.fernet.Fernet): the configured key.
+        name (str): the cipher name, part of the HKDF info.
+
+    Returns:
+        bytes
+    """
+    hkdf = HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=b'django-encrypted-json:' + name.encode('ascii'),
+        backend=default_backend(),
+    )
+    return hkdf.derive(fernet._signing_key + fernet._encryption_key)
+
+
+class AEADCipher(object):
+    """
+    Encrypts and decrypts the tokens of one cipher with one key.
+    """
+
+    def __init__(self, name, key):
+        """
+        Arguments:
+            name (str): a registered cipher name.
+            key (bytes): the 32 byte key, see `derive_key`.
+        """
+        try:
+            self.prefix, algorithm = _ciphers[name]
+        except KeyError:
+            raise ValueError('Unknown cipher %r' % name)
+        self.name = name
+        self._aead = algorithm(key)
+        self._associated_data = self.prefix.encode('ascii')
+
+    @classmethod
+    def from_fernet(cls, name, fernet):
+        return cls(name, derive_key(fernet, name))
+
+    def encrypt(self, data):
+        return self.encrypt_many([data])[0]
+
+    def encrypt_many(self, payloads):
+        """
+        Returns a list of tokens, one for each of the payloads.
+
+        The nonces of the whole batch come from a single `os.urandom` read.
+
+        Arguments:
+            payloads (list[bytes]): the data to encrypt.
+
+        Returns:
+            list[str]
+        """
+        nonces = os.urandom(NONCE_SIZE * len(payloads))
+        tokens = []
+        for index, data in enumerate(payloads):
+            if not isinstance(data, bytes):
+                raise TypeError("data must be bytes.")
+
+            nonce = nonces[index * NONCE_SIZE:(index + 1) * NONCE_SIZE]
+            sealed = self._aead.encrypt(nonce, data, self._associated_data)
+            tokens.append(
+                self.prefix +
+                base64.urlsafe_b64encode(nonce + sealed).rstrip(b'='))
+
+        return tokens
+
+    def decrypt(self, token):
+        """
+        Returns the decrypted bytes of the token.
+
+        Raises:
+            InvalidToken: if the token is not one of this key and cipher.
+        """
+        if not token.startswith(self.prefix):
+            raise InvalidToken
+
+        body = token[len(self.prefix):]
+        try:
+            data = base64.urlsafe_b64decode(body + b'=' * (-len(body) % 4))
+        except (TypeError, binascii.Error):
+            raise InvalidToken
+
+        if len(data) < NONCE_SIZE + TAG_SIZE:
+            raise InvalidToken
+
+        try:
+            return self._aead.decrypt(
+                data[:NONCE_SIZE], data[NONCE_SIZE:], self._associated_data)
+        except InvalidTag:
+            raise InvalidToken
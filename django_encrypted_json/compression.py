@@ -0,0 +1,131 @@
+"""
+Optional compression of values before they are encrypted.
+
+Encrypted data doesn't compress, so large documents have to be compressed
+before encryption.  A compressed payload is
+
+    COMPRESSED_MARKER + codec name + b':' + compressed bytes
+
+Like the compact leaf marker, `COMPRESSED_MARKER` never starts a legacy
+payload, so compressed and uncompressed values can be mixed freely and are
+recognized when decrypted.  Codecs are registered by name with
+`register_codec`, 'zlib' is always available.
+"""
+import threading
+import zlib
+
+COMPRESSED_MARKER = b'\xc2'
+
+_codecs = {}
+
+
+def register_codec(name, compress, decompress):
+    """
+    Registers a compression codec.
+
+    Arguments:
+        name (str): the name stored in the payload, ascii without ':'.
+        compress (function): bytes -> compressed bytes.
+        decompress (function): compressed bytes -> bytes.
+    """
+    if b':' in name:
+        raise ValueError("Codec names can't contain ':'")
+    _codecs[name] = (compress, decompress)
+
+
+register_codec(b'zlib', zlib.compress, zlib.decompress)
+
+
+class CompressionStats(object):
+    """
+    Counts the payloads considered for compression and their sizes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.compressed = 0
+        self.skipped = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def add(self, size_in, size_out):
+        with self._lock:
+            if size_out is None:
+                self.skipped += 1
+            else:
+                self.compressed += 1
+                self.bytes_in += size_in
+                self.bytes_out += size_out
+
+    def report(self):
+        """
+        Returns the counters and the compression ratio achieved so far.
+
+        Returns:
+            dict
+        """
+        return {
+            'compressed': self.compressed,
+            'skipped': self.skipped,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'ratio': (
+                float(self.bytes_in) / self.bytes_out
+                if self.bytes_out else None),
+        }
+
+
+compression_stats = CompressionStats()
+
+
+class Compressor(object):
+    """
+    Compresses payloads of at least `threshold` bytes with a codec.
+
+    A payload is only stored compressed when that makes it smaller.
+    """
+
+    def __init__(self, codec=b'zlib', threshold=1024):
+        if codec not in _codecs:
+            raise ValueError('Unknown compression codec %r' % codec)
+        self.codec = codec
+        self.threshold = threshold
+        self._compress = _codecs[codec][0]
+        self._prefix = COMPRESSED_MARKER + codec + b':'
+
+    def compress(self, payload):
+        if len(payload) < self.threshold:
+            compression_stats.add(len(payload), None)
+            return payload
+
+        compressed = self._prefix + self._compress(payload)
+        if len(compressed) >= len(payload):
+            compression_stats.add(len(payload), None)
+            return payload
+
+        compression_stats.add(len(payload), len(compressed))
+        return compressed
+
+
+def is_compressed(payload):
+    return payload[:1] == COMPRESSED_MARKER
+
+
+def decompress(payload):
+    """
+    Returns the payload decompressed, if it was compressed.
+
+    Returns:
+        bytes
+    """
+    if not is_compressed(payload):
+        return payload
+
+    codec, _, data = payload[1:].partition(b':')
+    try:
+        return _codecs[codec][1](data)
+    except KeyError:
+        raise ValueError('Unknown compression codec %r' % codec)
@@ -0,0 +1,157 @@
+"""
+The compact leaf format.
+
+The original leaf format escapes strings with `unicode_escape` and converts
+everything else with `json.dumps`, both produce ascii only.  Non ascii text
+grows up to 6x and a `True` costs 4 bytes.  The compact format starts with
+`COMPACT_MARKER`, a byte that never starts an ascii payload, followed by a
+one byte type tag and the value:
+
+    's'   utf-8 encoded string
+    'i'   int, minimal big endian two's complement
+    'f'   float, 8 byte IEEE 754
+    't'   True
+    'F'   False
+    'n'   None
+    'j'   anything else, `json.dumps` with the configured encoder
+
+Both formats are always read, `FIELD_ENCRYPTION_COMPACT_LEAVES` selects
+the one that is written.  Since compact leaves keep their type, plaintext
+strings given to `decrypt_values` are then returned as they are too, instead
+of being parsed with `json.loads`.
+"""
+import binascii
+import json
+import struct
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+COMPACT_MARKER = b'\xc1'
+
+DEFAULT_ENCODER_CLASS = 'django.core.serializers.json.DjangoJSONEncoder'
+
+_encoder_classes = {}
+
+
+def get_encoder_class():
+    """
+    Returns the class named by `PGJSON_ENCODER_CLASS`, imported once.
+
+    This is `django_pgjson.fields.get_encoder_class` without the import on
+    every call.
+    """
+    path = getattr(settings, 'PGJSON_ENCODER_CLASS', DEFAULT_ENCODER_CLASS)
+    try:
+        return _encoder_classes[path]
+    except KeyError:
+        encoder_class = _encoder_classes[path] = import_string(path)
+        return encoder_class
+
+
+def canonical_bytes(value):
+    """
+    Returns value serialized the same way every time, keys sorted.
+    """
+    return json.dumps(
+        value, cls=get_encoder_class(), sort_keys=True,
+        separators=(',', ':'), ensure_ascii=False
+    ).encode('utf-8')
+
+
+def iter_canonical_bytes(value):
+    """
+    Yields the bytes of `canonical_bytes(value)` in chunks, without ever
+    holding the whole serialized value.
+    """
+    encoder = get_encoder_class()(
+        sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    for chunk in encoder.iterencode(value):
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode('utf-8')
+        yield chunk
+
+
+def is_compact(payload):
+    return payload[:1] == COMPACT_MARKER
+
+
+def int_to_bytes(value):
+    length = (value.bit_length() + 8) // 8
+    value &= (1 << (length * 8)) - 1
+    return binascii.unhexlify('%0*x' % (length * 2, value))
+
+
+def int_from_bytes(data):
+    value = int(binascii.hexlify(data), 16)
+    if ord(data[0]) & 0x80:
+        value -= 1 << (len(data) * 8)
+    return value
+
+
+def encode_compact(data, encoder_class=None):
+    """
+    Returns the leaf value in the compact format.
+
+    Arguments:
+        data (object): the leaf value.
+        encoder_class: the json encoder class for values without a type
+            tag, defaults to `PGJSON_ENCODER_CLASS`.
+
+    Returns:
+        bytes
+    """
+    if isinstance(data, unicode):
+        return COMPACT_MARKER + b's' + data.encode('utf-8')
+
+    if isinstance(data, str):
+        # validate and keep the bytes, py2 str values are utf-8 text
+        data.decode('utf-8')
+        return COMPACT_MARKER + b's' + data
+
+    if data is True:
+        return COMPACT_MARKER + b't'
+
+    if data is False:
+        return COMPACT_MARKER + b'F'
+
+    if data is None:
+        return COMPACT_MARKER + b'n'
+
+    if isinstance(data, (int, long)):
+        return COMPACT_MARKER + b'i' + int_to_bytes(data)
+
+    if isinstance(data, float):
+        return COMPACT_MARKER + b'f' + struct.pack('>d', data)
+
+    return COMPACT_MARKER + b'j' + json.dumps(
+        data, cls=encoder_class or get_encoder_class(), ensure_ascii=False
+    ).encode('utf-8')
+
+
+def decode_compact(payload):
+    """
+    Returns the leaf value of a compact payload.
+
+    Returns:
+        object
+    """
+    tag = payload[1:2]
+    data = payload[2:]
+
+    if tag == b's':
+        return data.decode('utf-8')
+    if tag == b't':
+        return True
+    if tag == b'F':
+        return False
+    if tag == b'n':
+        return None
+    if tag == b'i':
+        return int_from_bytes(data)
+    if tag == b'f':
+        return struct.unpack('>d', data)[0]
+    if tag == b'j':
+        return json.loads(data.decode('utf-8'))
+
+    raise ValueError('Unknown compact leaf type %r' % tag)
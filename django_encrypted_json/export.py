@@ -0,0 +1,149 @@
+"""
+Streams decrypted rows for bulk exports.
+
+`queryset.iterator()` reads every row before the first one is returned, and
+the values are then decrypted one by one while the database waits.
+`iter_decrypted` overlaps the two: a reader thread fetches chunks through a
+server side cursor and hands each chunk to a thread pool for decryption,
+while the caller consumes the chunks that are already done:
+
+    for pk, data in iter_decrypted(
+            Document.objects.filter(kind='invoice'), ['pk', 'data'],
+            stream=sys.stderr):
+        writer.write(pk, data)
+
+The rows are returned in the order of the queryset as `values_list` tuples,
+with the encrypted fields decrypted the way the field reads them.  At most
+`prefetch` chunks are read ahead, so memory stays bounded whatever the size
+of the export.  The rows are read inside `transaction.atomic()`, the export
+is a single snapshot of the table.
+"""
+import multiprocessing
+import threading
+from functools import partial
+from multiprocessing.pool import ThreadPool
+from Queue import Empty, Full, Queue
+
+from django.db import connections, transaction
+
+from .fields import EncryptedValueJsonField
+from .instrumentation import instrument
+from .maintenance import ThroughputReporter, get_model_label, iter_chunks
+
+_DONE = object()
+
+
+def _decrypt_chunk(job):
+    fields, rows = job
+    # the rows were just read and are dropped once decrypted
+    decrypters = [
+        field and partial(field.decrypt, in_place=True) for field in fields]
+    return [
+        tuple(
+            instrument(field, 'decrypt', decrypt, value)
+            if field is not None and value is not None else value
+            for field, decrypt, value in zip(fields, decrypters, row)
+        )
+        for row in rows
+    ]
+
+
+def _read(chunks, pool, fields, queue, stop):
+    """
+    Reads the chunks and queues their decryption, in the reader thread.
+    """
+    try:
+        for rows in chunks:
+            result = pool.apply_async(_decrypt_chunk, ((fields, rows),))
+            while not stop.is_set():
+                try:
+                    queue.put(result, timeout=0.1)
+                    break
+                except Full:
+                    continue
+            if stop.is_set():
+                return
+        queue.put(_DONE)
+    except Exception as e:
+        if not stop.is_set():
+            queue.put(e)
+    finally:
+        chunks.close()
+
+
+def iter_decrypted(queryset, fields, chunk_size=1000, workers=None,
+                   prefetch=2, stream=None):
+    """
+    Yields the rows of queryset with the encrypted fields decrypted.
+
+    Arguments:
+        queryset (QuerySet): the rows to export.
+        fields (list[str]): the fields to return, as for `values_list`.
+        chunk_size (int): the number of rows read and decrypted at a time.
+        workers (int): the number of decryption threads, defaults to the
+            number of cpus.
+        prefetch (int): the number of chunks read ahead of the caller.
+        stream: a stream the progress and rows per second are written to
+            after every chunk.
+
+    Returns:
+        generator
+    """
+    model = queryset.model
+    opts = model._meta
+    row_fields = []
+    for name in fields:
+        field = opts.pk if name == 'pk' else opts.get_field(name)
+        row_fields.append(
+            field if isinstance(field, EncryptedValueJsonField) else None)
+
+    sql, params = queryset.values_list(*fields).query.sql_with_params()
+
+    reporter = None
+    if stream is not None:
+        reporter = ThroughputReporter(
+            stream, get_model_label(model), changes=False)
+
+    # The connection is resolved here, the reader thread would get one of
+    # its own, outside of the caller's transaction.  The cursor of the
+    # reader lives as long as this transaction.
+    connection = connections[queryset.db]
+    with transaction.atomic(using=queryset.db):
+        chunks = iter_chunks(connection.connection, sql, params, chunk_size)
+
+        pool = ThreadPool(workers or multiprocessing.cpu_count())
+        queue = Queue(maxsize=max(prefetch, 1))
+        stop = threading.Event()
+        reader = threading.Thread(
+            target=_read, args=(chunks, pool, row_fields, queue, stop))
+        reader.daemon = True
+        reader.start()
+
+        try:
+            while True:
+                result = queue.get()
+                if result is _DONE:
+                    break
+                if isinstance(result, Exception):
+                    raise result
+
+                rows = result.get()
+                for row in rows:
+                    yield row
+
+                if reporter is not None:
+                    reporter.update(len(rows))
+
+            if reporter is not None:
+                reporter.report(final=True)
+        finally:
+            stop.set()
+            # unblock a reader waiting for room in the queue
+            while True:
+                try:
+                    queue.get_nowait()
+                except Empty:
+                    break
+            reader.join()
+            pool.close()
+            pool.join()
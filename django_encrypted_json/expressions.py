@@ -0,0 +1,302 @@
+"""
+Reads and updates of a single value in SQL.
+
+Changing one value of a document normally means loading the row, decrypting
+the whole document and encrypting it all again.  `JsonSet` encrypts only the
+new value and sets it at its path with `jsonb_set`, the other tokens are not
+touched:
+
+    Document.objects.filter(pk=pk).update(
+        data=JsonSet('data', 'stats.views', views))
+    Document.objects.filter(kind='invoice').update(
+        data=JsonSet('data', ['items', 0, 'status'], 'paid'))
+
+Paths are dotted strings, whose numeric parts are list indexes, or lists of
+keys and int indexes.  The value is encrypted the way the field would
+encrypt it at that path, so skip_keys still apply, and the blind index
+digests under the path are updated in the same statement.
+
+As with `jsonb_set`, the last key of the path is created when it is missing
+but the keys before it must exist, otherwise the row is left unchanged.
+Envelope documents are a single token, only their top level skip_keys can be
+set.  `EncryptedValueJsonField` columns are cast to jsonb and back.
+`jsonb_set` needs PostgreSQL 9.5.
+
+`JsonGet` is the other way around, it selects only the value at a path,
+`(data #> '{status}')`, and decrypts the tokens it contains:
+
+    Document.objects.annotate(
+        status=JsonGet('data', 'status')).values('pk', 'status')
+    Document.objects.defer('data').annotate(
+        status=JsonGet('data', 'status'))
+
+Missing paths are returned as None.  Envelope documents can't be cut in SQL,
+the whole document is selected for the paths inside its token.
+"""
+from django.core.exceptions import FieldError
+from django.db.models import Field
+from django.db.models.expressions import Expression, F
+from django_pgjson.fields import JsonAdapter
+
+from .batch import encrypt_values_batch
+from .blind_index import (
+    BLIND_INDEX_KEY, PATH_SEPARATOR, blind_digest, get_blind_index_key,
+    get_path
+)
+from .instrumentation import instrument
+from .lazy import materialize
+from .plaintext import path_literal
+from .utils import ENVELOPE_KEY, decrypt_document, decrypt_values, is_envelope
+
+
+def parse_path(path):
+    """
+    Returns the path as a list of keys and int list indexes.
+
+    Raises:
+        ValueError: if the path is empty.
+    """
+    if isinstance(path, basestring):
+        path = [
+            int(part) if part.isdigit() else part
+            for part in path.split(PATH_SEPARATOR)
+        ]
+    path = list(path)
+    if not path or any(part == '' for part in path):
+        raise ValueError('Invalid path %r' % (path,))
+    return path
+
+
+def resolve_field(name, query):
+    """
+    Returns the encrypted field called name of the query's model.
+
+    Raises:
+        FieldError: if the field is not an encrypted json field.
+    """
+    from .fields import EncryptedValueJsonField
+
+    field = query.model._meta.get_field(name)
+    if not isinstance(field, EncryptedValueJsonField):
+        raise FieldError(
+            'An encrypted json field is required, %s is not one' % name)
+    return field
+
+
+class JsonGet(Expression):
+    """
+    Selects and decrypts the value at a path of an encrypted document.
+    """
+
+    def __init__(self, name, path):
+        """
+        Arguments:
+            name (str): the name of the encrypted field.
+            path (str or list): the path of the value to select.
+        """
+        super(JsonGet, self).__init__(output_field=Field())
+        self.name = name
+        self.path = parse_path(path)
+        self.column = None
+
+    def __repr__(self):
+        return '%s(%s, %r)' % (self.__class__.__name__, self.name, self.path)
+
+    def get_source_expressions(self):
+        return [self.column] if self.column is not None else []
+
+    def set_source_expressions(self, exprs):
+        if exprs:
+            self.column, = exprs
+
+    def resolve_expression(self, query=None, allow_joins=True, reuse=None,
+                           summarize=False, for_save=False):
+        c = self.copy()
+        c.is_summary = summarize
+        c.encrypted_field = resolve_field(self.name, query)
+        c.column = F(self.name).resolve_expression(
+            query, allow_joins, reuse, summarize, for_save)
+        return c
+
+    def as_sql(self, compiler, connection):
+        column, column_params = compiler.compile(self.column)
+        sql = '(%s #> %%s)' % column
+        params = column_params + [
+            path_literal([unicode(part) for part in self.path])]
+
+        field = self.encrypted_field
+        rules = field.skip_rules
+        if field.envelope and not isinstance(self.path[0], int) and \
+                rules.enter(rules.root, self.path[0])[0]:
+            return sql, params
+
+        # Rows still, or already, in the envelope format are selected whole.
+        sql = "CASE WHEN (%s::jsonb ? '%s') THEN %s ELSE %s END" % (
+            column, ENVELOPE_KEY, column, sql)
+        return sql, column_params + column_params + params
+
+    def convert_value(self, value, expression, connection, context):
+        if value is None:
+            return value
+
+        field = self.encrypted_field
+        if is_envelope(value):
+            found, value = get_path(
+                decrypt_document(value, field.get_decrypter()), self.path)
+            return value if found else None
+
+        return instrument(field, 'decrypt', self._decrypt, value)
+
+    def _decrypt(self, value):
+        field = self.encrypted_field
+        # the value was just read from the database
+        return decrypt_values(
+            value, field.get_decrypter(), cache=field.get_cache(),
+            in_place=True)
+
+
+class JsonSet(Expression):
+    """
+    Sets the value at a path of an encrypted document, for `update()`.
+    """
+
+    def __init__(self, name, path, value):
+        """
+        Arguments:
+            name (str): the name of the encrypted field.
+            path (str or list): the path of the value to set.
+            value (object): the new plaintext value.
+        """
+        super(JsonSet, self).__init__()
+        self.name = name
+        self.path = parse_path(path)
+        self.value = value
+        self.column = None
+
+    def __repr__(self):
+        return '%s(%s, %r)' % (self.__class__.__name__, self.name, self.path)
+
+    def get_source_expressions(self):
+        return [self.column] if self.column is not None else []
+
+    def set_source_expressions(self, exprs):
+        if exprs:
+            self.column, = exprs
+
+    def resolve_expression(self, query=None, allow_joins=True, reuse=None,
+                           summarize=False, for_save=False):
+        c = self.copy()
+        c.is_summary = summarize
+        field = resolve_field(self.name, query)
+        if field.key_resolver is not None:
+            raise ValueError(
+                "JsonSet can't encrypt %s, its keys depend on the row" % (
+                    field.name))
+
+        c._output_field = field
+        c.column = F(self.name).resolve_expression(
+            query, allow_joins, reuse, summarize, for_save)
+        c.stored = instrument(field, 'encrypt', c.encrypt, c.value)
+        c.digests, c.removed = c.update_blind_index(field)
+        return c
+
+    def encrypt(self, value):
+        """
+        Returns value encrypted the way the field stores it at the path.
+
+        Raises:
+            ValueError: if the path is inside the token of an envelope or
+                starts with a reserved key.
+        """
+        field = self._output_field
+        if self.path[0] in field.get_reserved_keys():
+            raise ValueError(
+                "'%s' is reserved and can't be set" % self.path[0])
+        rules = field.skip_rules
+        if field.envelope:
+            if isinstance(self.path[0], int) or \
+                    not rules.enter(rules.root, self.path[0])[0]:
+                raise ValueError(
+                    'Only the skip_keys of the envelope field %s can be '
+                    'set' % field.name)
+            return materialize(value)
+
+        state = rules.root
+        for part in self.path:
+            skipped, state = rules.enter(
+                state, part, index=isinstance(part, int))
+            if skipped:
+                return materialize(value)
+
+        return encrypt_values_batch(
+            value, skip_keys=rules, compressor=field.compressor,
+            _state=state)
+
+    def update_blind_index(self, field):
+        """
+        Returns the digests of the indexed paths the value replaces and the
+        indexed paths it no longer contains.
+
+        Raises:
+            ValueError: if the path is inside an indexed value.
+
+        Returns:
+            tuple(dict, list[str])
+        """
+        if not field.blind_index:
+            return {}, []
+
+        dotted = PATH_SEPARATOR.join(unicode(part) for part in self.path)
+        prefix = dotted + PATH_SEPARATOR
+        digests = {}
+        removed = []
+        key = None
+        for indexed in field.blind_index:
+            if dotted.startswith(indexed + PATH_SEPARATOR):
+                raise ValueError(
+                    "'%s' is inside the blind index path '%s' of %s, set "
+                    "the whole value" % (dotted, indexed, field.name))
+
+            if indexed == dotted:
+                found, value = True, self.value
+            elif indexed.startswith(prefix):
+                found, value = get_path(self.value, indexed[len(prefix):])
+            else:
+                continue
+
+            if found:
+                key = key or get_blind_index_key()
+                digests[indexed] = blind_digest(indexed, value, key)
+            else:
+                removed.append(indexed)
+
+        return digests, removed
+
+    def as_sql(self, compiler, connection):
+        if connection.pg_version < 90500:
+            raise RuntimeError(
+                'JsonSet needs PostgreSQL >= 9.5 for jsonb_set.')
+
+        column, column_params = compiler.compile(self.column)
+        document = "COALESCE(%s::jsonb, '{}'::jsonb)" % column
+        sql = "jsonb_set(%s, %%s, %%s::jsonb, true)" % document
+        params = column_params + [
+            path_literal([unicode(part) for part in self.path]),
+            JsonAdapter(self.stored),
+        ]
+
+        if self.digests or self.removed:
+            index = "(COALESCE(%s -> '%s', '{}'::jsonb) || %%s::jsonb)" % (
+                document, BLIND_INDEX_KEY)
+            index_params = column_params + [JsonAdapter(self.digests)]
+            for path in self.removed:
+                index = '(%s - %%s)' % index
+                index_params.append(path)
+
+            sql = "jsonb_set(%s, '{%s}', %s, true)" % (
+                sql, BLIND_INDEX_KEY, index)
+            params = params + index_params
+
+        if self._output_field.db_type(connection) == 'json':
+            sql = '(%s)::json' % sql
+        return sql, params
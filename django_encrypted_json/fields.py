@@ -1,7 +1,63 @@
+import json
+from functools import partial
+
 from django.db.models.fields import NOT_PROVIDED
-from django_pgjson.fields import JsonField, JsonBField, JsonAdapter
+from django_pgjson.fields import (
+    JsonAdapter, JsonBField, JsonField, JsonFormField
+)
+
+from .batch import encrypt_values_batch
+from .blind_index import (
+    BLIND_INDEX_KEY, BlindIndexTransform, build_blind_index, strip_blind_index
+)
+from .cache import get_decryption_cache
+from .changes import get_stored, track
+from .compression import Compressor
+from .encoding import get_encoder_class
+from .instrumentation import instrument
+from .key_providers import decrypt_token, get_key_ring
+from .lazy import lazy_decrypt_values, materialize
+from .plaintext import PlainContainsLookup, PlainTransform
+from .skip_rules import compile_skip_keys
+from .utils import (
+    ENVELOPE_KEY, decrypt_document, decrypt_values, encrypt_document,
+    get_crypter, is_envelope, iter_tokens
+)
+
+def check_reserved_keys(value, reserved_keys):
+    """
+    Raises:
+        ValueError: if value is a dict using a key of reserved_keys.
+    """
+    if isinstance(value, dict):
+        for key in reserved_keys:
+            if key in value:
+                raise ValueError(
+                    "'%s' is reserved and can't be used as a top level "
+                    "key" % key)
+
+
+class EncryptedJsonFormField(JsonFormField):
+    """
+    The form field of the encrypted fields, it also renders the lazy
+    containers of `lazy=True` fields.
+    """
+
+    def prepare_value(self, value):
+        return super(EncryptedJsonFormField, self).prepare_value(
+            materialize(value))
+
+
+class PreEncryptedValue(object):
+    """
+    A value that has already been encrypted by `EncryptedValueJsonField`.
+
+    Assigning one to an encrypted field stores `value` as is, see
+    `django_encrypted_json.parallel`.
+    """
 
-from .utils import decrypt_values, encrypt_values
+    def __init__(self, value):
+        self.value = value
 
 
 class EncryptedValueJsonField(JsonField):
@@ -47,9 +103,65 @@ class EncryptedValueJsonField(JsonField):
 
     Note that values will be forced to a string using `json.dumps` and restored
     using `json.loads`.
+
+    `skip_keys` names keys stored in plaintext at any depth, or paths such as
+    `'items[*].sku'`, see `django_encrypted_json.skip_rules`.
+
+    With `envelope=True` the whole document is encrypted as a single token
+    instead, see `encrypt_document`.  Only the top level `skip_keys` are kept
+    in plaintext in this mode.  Both formats are always read, so a field can
+    be switched to the envelope format and its rows migrated gradually.
+
+    With `lazy=True` dicts and lists are returned as lazy containers that only
+    decrypt a value when it is read, see `django_encrypted_json.lazy`.
+    Values that were never changed keep their tokens when saved again.
+
+    With `compress=True`, or the name of a registered codec, values of at
+    least `compress_threshold` bytes are compressed before they are
+    encrypted, see `django_encrypted_json.compression`.  This is most useful
+    together with `envelope=True`.
+
+    With `blind_index`, a list of dotted paths, a keyed digest of the value
+    at each path is stored next to the encrypted values so they can be
+    compared in SQL, `filter(data__blind__email=value)`, see
+    `django_encrypted_json.blind_index`.
+
+    The plaintext `skip_keys` values can be compared in SQL with the `plain`
+    transform, `filter(data__plain__tenant='acme')`, see
+    `django_encrypted_json.plaintext`.
+
+    With `key_resolver`, a callable returning a key id for a model instance,
+    every row is encrypted with its own key, e.g. one per tenant, see
+    `django_encrypted_json.key_providers`.  The values are encrypted when
+    the instance is saved, `QuerySet.update()` only accepts
+    `PreEncryptedValue` instances for these fields.  It can't be combined
+    with `lazy=True`.
+
+    Dicts and lists loaded from the database remember their stored value,
+    saving them unchanged writes the stored value again instead of
+    encrypting it, see `django_encrypted_json.changes`.
+
+    Decrypted values are cached when `FIELD_ENCRYPTION_CACHE_SIZE` is set,
+    see `django_encrypted_json.cache`.  The cost of every encryption and
+    decryption can be reported, see `django_encrypted_json.instrumentation`.
     """
     def __init__(self, *args, **kwargs):
         self.skip_keys = kwargs.pop('skip_keys', [])
+        self.skip_rules = compile_skip_keys(self.skip_keys)
+        self.envelope = kwargs.pop('envelope', False)
+        self.lazy = kwargs.pop('lazy', False)
+        self.blind_index = tuple(kwargs.pop('blind_index', ()))
+        self.key_resolver = kwargs.pop('key_resolver', None)
+        if self.key_resolver is not None and self.lazy:
+            raise ValueError("key_resolver can't be combined with lazy=True")
+
+        compress = kwargs.pop('compress', False)
+        compress_threshold = kwargs.pop('compress_threshold', 1024)
+        self.compressor = None
+        if compress:
+            self.compressor = Compressor(
+                b'zlib' if compress is True else compress,
+                compress_threshold)
 
         return super(EncryptedValueJsonField, self).__init__(*args, **kwargs)
 
@@ -59,14 +171,127 @@ class EncryptedValueJsonField(JsonField):
         return name, path, args, kwargs
 
     def to_python(self, value):
+        if isinstance(value, PreEncryptedValue):
+            return value
+
         value = super(EncryptedValueJsonField, self).to_python(value)
-        return decrypt_values(value)
+        return instrument(self, 'decrypt', self.decrypt, value)
+
+    def decrypt(self, value, in_place=False):
+        """
+        Returns value decrypted the way this field reads it.
+
+        With `in_place=True` the dicts and lists of value are reused and the
+        result doesn't remember its stored value, see `decrypt_values` for
+        when that is safe.
+
+        Returns:
+            object
+        """
+        stored = value
+        if self.blind_index:
+            value = strip_blind_index(value)
+        if is_envelope(value):
+            value = decrypt_document(value, self.get_decrypter())
+        elif self.lazy:
+            return lazy_decrypt_values(value)
+        else:
+            value = decrypt_values(
+                value, self.get_decrypter(), cache=self.get_cache(),
+                in_place=in_place)
+
+        if in_place:
+            return value
+        return track(value, stored, self.skip_rules)
 
     def get_db_prep_value(self, value, connection, prepared=False):
         value = super(JsonField, self).get_db_prep_value(
             value, connection, prepared=prepared
         )
 
+        if isinstance(value, PreEncryptedValue):
+            value = value.value
+        elif self.key_resolver is not None and value is not None:
+            raise ValueError(
+                '%s is encrypted with per row keys, save the instance or '
+                'pass a PreEncryptedValue' % self.name)
+        else:
+            value = instrument(self, 'encrypt', self.encrypt, value)
+
+        if self.null and value is None:
+            return None
+
+        return JsonAdapter(value)
+
+    def pre_save(self, model_instance, add):
+        value = super(EncryptedValueJsonField, self).pre_save(
+            model_instance, add)
+        if self.key_resolver is None or isinstance(value, PreEncryptedValue):
+            return value
+
+        encrypt = partial(self.encrypt, ring=self.get_key_ring(model_instance))
+        return PreEncryptedValue(instrument(self, 'encrypt', encrypt, value))
+
+    def get_key_ring(self, model_instance):
+        """
+        Returns the `KeyRing` of the instance, or None for the default keys.
+
+        Returns:
+            KeyRing
+        """
+        if self.key_resolver is None:
+            return None
+        key_id = self.key_resolver(model_instance)
+        if key_id is None:
+            return None
+        return get_key_ring(key_id)
+
+    def get_reserved_keys(self):
+        """
+        Returns the top level keys the stored documents of this field use
+        for their own data: the envelope key, and the blind index key when
+        the field has a blind index.
+
+        Returns:
+            tuple(str)
+        """
+        if self.blind_index:
+            return (ENVELOPE_KEY, BLIND_INDEX_KEY)
+        return (ENVELOPE_KEY,)
+
+    def get_decrypter(self):
+        """
+        Returns the function decrypting the tokens of this field, None for
+        the default keys.
+        """
+        if self.key_resolver is None:
+            return None
+        return decrypt_token
+
+    def get_cache(self):
+        """
+        Returns the decryption cache of this field, None when disabled.
+        """
+        if self.key_resolver is not None:
+            return None
+        return get_decryption_cache()
+
+    def encrypt(self, value, ring=None):
+        """
+        Returns value encrypted the way this field stores it.
+
+        Arguments:
+            value (object): the value to encrypt.
+            ring (KeyRing): the keys to encrypt with, defaults to
+                `utils.get_crypter()`.
+
+        Returns:
+            object
+        """
+        stored = get_stored(value)
+        if stored is not None and self.is_current(stored, ring):
+            return stored
+
         # Because an empty string is not valid json, replace it with an empty
         # dict
         if self.blank and value == "":
@@ -81,15 +306,73 @@ class EncryptedValueJsonField(JsonField):
         if self.null and value is None:
             return None
 
-        value = encrypt_values(value, skip_keys=self.skip_keys)
+        check_reserved_keys(value, self.get_reserved_keys())
 
-        return JsonAdapter(value)
+        if self.envelope:
+            encrypted = encrypt_document(
+                materialize(value), encrypter=ring and ring.encrypt,
+                skip_keys=self.skip_rules, compressor=self.compressor)
+        else:
+            encrypted = encrypt_values_batch(
+                value, skip_keys=self.skip_rules, compressor=self.compressor,
+                ring=ring)
+
+        if self.blind_index and isinstance(encrypted, dict):
+            encrypted[BLIND_INDEX_KEY] = build_blind_index(
+                value, self.blind_index)
+
+        return encrypted
+
+    def is_current(self, stored, ring=None):
+        """
+        Returns True when the stored value is in the format this field
+        writes, so it can be stored again as is.
+
+        With `key_resolver` every token must also be encrypted with the
+        primary key of ring, the keys of the instance, see `get_key_ring`.
+        A row moved to another key id is encrypted again.
+
+        Arguments:
+            stored (object): the value as it was loaded from the database.
+            ring (KeyRing): the keys the instance is encrypted with.
+
+        Returns:
+            bool
+        """
+        if self.envelope != is_envelope(stored):
+            return False
+        has_index = isinstance(stored, dict) and BLIND_INDEX_KEY in stored
+        if has_index != bool(self.blind_index):
+            return False
+
+        if self.key_resolver is not None:
+            ring = ring or get_crypter()
+            return all(
+                ring.is_primary(token.encode('ascii'))
+                for _, _, token in iter_tokens(strip_blind_index(stored)))
+        return True
+
+    def formfield(self, **kwargs):
+        defaults = {'form_class': EncryptedJsonFormField}
+        defaults.update(kwargs)
+        return super(EncryptedValueJsonField, self).formfield(**defaults)
+
+    def value_to_string(self, obj):
+        value = materialize(self._get_val_from_obj(obj))
+        return json.dumps(value, cls=get_encoder_class(), **self._options)
 
 
 class EncryptedValueJsonBField(JsonBField, EncryptedValueJsonField):
     """
     A JSONB field that will silently encrypt and decrypt the values of the
     JSON value.  It is based on django-pgjson's JSONB field.
+
+    Its `jcontains` lookup only accepts the `skip_keys`.
     """
 
     pass
+
+
+EncryptedValueJsonField.register_lookup(BlindIndexTransform)
+EncryptedValueJsonField.register_lookup(PlainTransform)
+EncryptedValueJsonBField.register_lookup(PlainContainsLookup)
@@ -0,0 +1,170 @@
+"""
+Reports the cost of the work done by the encrypted fields.
+
+Every encryption and decryption done by a field can be reported to
+
+* the `field_encrypted` and `field_decrypted` signals,
+* a callback named by `FIELD_ENCRYPTION_METRICS_CALLBACK`, a dotted path or a
+  callable, called with the same keyword arguments as the signals,
+* the `django_encrypted_json` logger, as a warning, when the operation took
+  longer than `FIELD_ENCRYPTION_SLOW_THRESHOLD` seconds.
+
+The keyword arguments are `field`, `operation` ('encrypt' or 'decrypt'),
+`leaves`, `plaintext_bytes`, `ciphertext_bytes`, `duration` in seconds and
+`fallback_leaves`, the number of values `decrypt_values` returned without
+decrypting them.  `plaintext_bytes` is None for lazily decrypted values.
+
+When none of these are configured the only cost is checking that they
+aren't.  Sizes are only computed when something listens.
+"""
+import json
+import logging
+import time
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .encoding import get_encoder_class
+from .lazy import LazyContainer
+from .signals import field_decrypted, field_encrypted
+from .utils import decrypt_stats
+
+logger = logging.getLogger('django_encrypted_json')
+
+SIGNALS = {
+    'encrypt': field_encrypted,
+    'decrypt': field_decrypted,
+}
+
+
+def get_callback():
+    callback = getattr(settings, 'FIELD_ENCRYPTION_METRICS_CALLBACK', None)
+    if isinstance(callback, basestring):
+        callback = import_string(callback)
+    return callback
+
+
+def count_leaves(data, limit=None):
+    """
+    Returns the number of values in data that are not containers.
+
+    With a limit the walk stops as soon as limit values were counted, and
+    limit is returned, so comparing a large document with a threshold
+    doesn't walk all of it.
+    """
+    count = 0
+    stack = [iter((data,))]
+    while stack:
+        for value in stack[-1]:
+            if isinstance(value, dict):
+                stack.append(value.itervalues())
+                break
+            elif isinstance(value, (list, tuple, set)):
+                stack.append(iter(value))
+                break
+
+            count += 1
+            if limit is not None and count >= limit:
+                return count
+        else:
+            stack.pop()
+    return count
+
+
+def get_size(data):
+    if data is None or isinstance(data, LazyContainer):
+        return None
+    return len(json.dumps(data, cls=get_encoder_class()))
+
+
+def is_instrumented(operation):
+    """
+    Returns True when anything listens to the operation.
+    """
+    return bool(
+        SIGNALS[operation].receivers or get_callback() is not None or
+        getattr(settings, 'FIELD_ENCRYPTION_SLOW_THRESHOLD', None) is not None
+    )
+
+
+def instrument(field, operation, func, value):
+    """
+    Returns func(value), reporting the cost when anything listens.
+
+    Arguments:
+        field (EncryptedValueJsonField): the field doing the work.
+        operation (str): 'encrypt' or 'decrypt'.
+        func (function): the function doing the work.
+        value (object): the value to encrypt or decrypt.
+
+    Returns:
+        object
+    """
+    if not is_instrumented(operation):
+        return func(value)
+
+    # measured first, func may work in place
+    value_size = get_size(value)
+
+    fallbacks = decrypt_stats.skipped + decrypt_stats.invalid
+    start = time.time()
+    result = func(value)
+    duration = time.time() - start
+
+    # global counters, only approximate with concurrent threads
+    fallbacks = decrypt_stats.skipped + decrypt_stats.invalid - fallbacks
+    report(field, operation, value, result, duration, value_size, fallbacks)
+    return result
+
+
+def report(field, operation, value, result, duration, value_size,
+           fallback_leaves=0):
+    """
+    Reports an operation done elsewhere, e.g. in another process.
+
+    Arguments:
+        field (EncryptedValueJsonField): the field doing the work.
+        operation (str): 'encrypt' or 'decrypt'.
+        value (object): the value that was encrypted or decrypted.
+        result (object): the encrypted or decrypted value.
+        duration (float): the time it took, in seconds.
+        value_size (int): the size of value before the operation, see
+            `get_size`.
+        fallback_leaves (int): the number of values returned without
+            decrypting them.
+    """
+    signal = SIGNALS[operation]
+    callback = get_callback()
+    threshold = getattr(settings, 'FIELD_ENCRYPTION_SLOW_THRESHOLD', None)
+
+    if operation == 'encrypt':
+        plaintext, ciphertext = value, result
+        plaintext_bytes, ciphertext_bytes = value_size, get_size(result)
+    else:
+        plaintext, ciphertext = result, value
+        plaintext_bytes, ciphertext_bytes = get_size(result), value_size
+
+    info = {
+        'field': field,
+        'operation': operation,
+        'leaves': count_leaves(
+            ciphertext if isinstance(plaintext, LazyContainer)
+            else plaintext),
+        'plaintext_bytes': plaintext_bytes,
+        'ciphertext_bytes': ciphertext_bytes,
+        'duration': duration,
+        'fallback_leaves': fallback_leaves,
+    }
+    model = getattr(field, 'model', None)
+
+    if signal.receivers:
+        signal.send(sender=model, **info)
+
+    if callback is not None:
+        callback(**info)
+
+    if threshold is not None and duration >= threshold:
+        logger.warning(
+            'Slow %s of %s.%s: %.3fs for %d leaves',
+            operation, model.__name__ if model else None, field.name,
+            duration, info['leaves'])
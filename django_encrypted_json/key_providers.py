@@ -0,0 +1,194 @@
+"""
+Per row keys, e.g. one key per tenant.
+
+A field with `key_resolver`, a callable returning the key id of a model
+instance, encrypts every row with the key of that id:
+
+    data = EncryptedValueJsonBField(
+        key_resolver=lambda obj: 'tenant-%d' % obj.tenant_id)
+
+The keys come from the key provider, `FIELD_ENCRYPTION_KEY_PROVIDER`, a
+callable or its dotted path taking a key id and returning that Fernet key,
+or None when there is no such key.  It may read them from a table, a vault
+or a KMS.  A key id names a single key: to rotate the key of a tenant have
+the resolver return a new id.  Tokens are tagged with the id of their key,
+`tenant-7:gAAAAA...`, so they are decrypted without the instance and old
+tokens keep working with the old key.  A resolver returning None uses the
+`FIELD_ENCRYPTION_KEY` keys.
+
+The `KeyRing` built for each key is kept in a bounded, thread safe LRU cache
+for `FIELD_ENCRYPTION_KEY_CACHE_TTL` seconds (300 by default), at most
+`FIELD_ENCRYPTION_KEY_CACHE_SIZE` of them (1000 by default), so the provider
+is only called again once a key expired or was evicted and the Fernet and
+AEAD objects aren't built again for every value.
+
+Untagged tokens, written before the field had a resolver, and tokens tagged
+with the ids of the `FIELD_ENCRYPTION_KEY` keys are decrypted with those.
+The values of these fields are not put in the decryption cache, which is
+shared by all keys.
+"""
+import threading
+import time
+
+import cryptography.fernet
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.utils.module_loading import import_string
+
+from .cache import LRUCache
+from .ciphers import FERNET
+from .signals import keys_reloaded
+from .utils import KEY_ID_SEPARATOR, KeyRing, get_crypter
+
+KEY_CACHE_SETTINGS = (
+    'FIELD_ENCRYPTION_KEY_PROVIDER',
+    'FIELD_ENCRYPTION_KEY_CACHE_SIZE',
+    'FIELD_ENCRYPTION_KEY_CACHE_TTL',
+    'FIELD_ENCRYPTION_CIPHER',
+)
+
+
+def get_key_provider():
+    """
+    Returns the callable named by settings.FIELD_ENCRYPTION_KEY_PROVIDER.
+
+    Raises:
+        ImproperlyConfigured: if the setting is missing.
+    """
+    provider = getattr(settings, 'FIELD_ENCRYPTION_KEY_PROVIDER', None)
+    if provider is None:
+        raise ImproperlyConfigured(
+            'FIELD_ENCRYPTION_KEY_PROVIDER is required to use key_resolver.')
+    if isinstance(provider, basestring):
+        provider = import_string(provider)
+    return provider
+
+
+class KeyCache(LRUCache):
+    """
+    A bounded, thread safe LRU cache of the `KeyRing` of each key id, whose
+    entries expire after `ttl` seconds.
+    """
+
+    def __init__(self, provider, max_size=1000, ttl=300, cipher=FERNET):
+        super(KeyCache, self).__init__(max_size)
+        self.provider = provider
+        self.ttl = ttl
+        self.cipher = cipher
+
+    def is_expired(self, value):
+        expires, _ = value
+        return expires <= time.time()
+
+    def get(self, key_id):
+        """
+        Returns the `KeyRing` of the key id, loading it from the provider
+        when it isn't cached.
+
+        Raises:
+            KeyError: if the provider has no such key.
+
+        Returns:
+            KeyRing
+        """
+        found, entry = self.lookup(key_id)
+        if found:
+            return entry[1]
+
+        # Outside of the lock, the provider may be slow.  Two threads
+        # loading the same key both get a working ring.
+        expires = time.time() + self.ttl
+        ring = self.load(key_id)
+        self.store(key_id, (expires, ring))
+        return ring
+
+    def load(self, key_id):
+        key = self.provider(key_id)
+        if key is None:
+            raise KeyError(key_id)
+        return KeyRing(
+            [(key_id, cryptography.fernet.Fernet(key))],
+            tag_tokens=True, cipher=self.cipher)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_key_cache():
+    """
+    Returns the process wide `KeyCache`.
+
+    Returns:
+        KeyCache
+    """
+    global _cache
+
+    with _cache_lock:
+        if _cache is None:
+            _cache = KeyCache(
+                get_key_provider(),
+                max_size=getattr(
+                    settings, 'FIELD_ENCRYPTION_KEY_CACHE_SIZE', 1000),
+                ttl=getattr(settings, 'FIELD_ENCRYPTION_KEY_CACHE_TTL', 300),
+                cipher=getattr(settings, 'FIELD_ENCRYPTION_CIPHER', FERNET),
+            )
+        return _cache
+
+
+def reset_key_cache(**kwargs):
+    """
+    Drops the cached keys when their settings change or the keys are
+    reloaded, e.g. after a key was revoked.
+    """
+    global _cache
+
+    if kwargs.get('setting', KEY_CACHE_SETTINGS[0]) not in KEY_CACHE_SETTINGS:
+        return
+
+    with _cache_lock:
+        _cache = None
+
+
+setting_changed.connect(reset_key_cache)
+keys_reloaded.connect(reset_key_cache)
+
+
+def get_key_ring(key_id):
+    """
+    Returns the `KeyRing` encrypting with the key id.
+
+    Raises:
+        ValueError: if the provider has no such key.
+
+    Returns:
+        KeyRing
+    """
+    try:
+        return get_key_cache().get(key_id)
+    except KeyError:
+        raise ValueError('No encryption key %r' % key_id)
+
+
+def decrypt_token(token):
+    """
+    Decrypts a token with the key it is tagged with, see the module
+    docstring.
+
+    Raises:
+        InvalidToken: if the key is unknown or doesn't decrypt the token.
+
+    Returns:
+        bytes
+    """
+    key_id, separator, _ = token.partition(KEY_ID_SEPARATOR)
+    crypter = get_crypter()
+    if not separator or crypter.has_key(key_id):
+        return crypter.decrypt(token)
+
+    try:
+        ring = get_key_cache().get(key_id)
+    except KeyError:
+        raise cryptography.fernet.InvalidToken
+    return ring.decrypt(token)
@@ -0,0 +1,187 @@
+from collections import MutableMapping, MutableSequence
+
+from .cache import get_decryption_cache
+from .utils import decrypt_values
+
+
+class _PENDING(object):
+    """
+    Marks a value that has not been decrypted yet.
+
+    Classes are used as markers so they survive pickling.
+    """
+
+
+class _TOUCHED(object):
+    """
+    Marks a value whose stored token can no longer be reused.
+    """
+
+
+def _decode(raw):
+    """
+    Returns the lazy container for a raw container, or the decrypted leaf.
+    """
+    if isinstance(raw, dict):
+        return LazyDecryptedDict(raw)
+
+    if isinstance(raw, (list, tuple)):
+        return LazyDecryptedList(raw)
+
+    return decrypt_values(raw, cache=get_decryption_cache())
+
+
+class LazyContainer(object):
+    """
+    Base class of the lazily decrypting containers.
+
+    A lazy container keeps the stored (encrypted) values next to the
+    decrypted ones.  A value is decrypted the first time it is read and the
+    result is kept.  As long as a value has not been replaced its stored
+    token is kept as well, see `raw_value`, so an untouched container can be
+    written back without encrypting it again.
+    """
+
+    def _get(self, key):
+        value = self._data[key]
+        if value is _PENDING:
+            value = self._data[key] = _decode(self._raw[key])
+
+            # Nested containers and mutable leaves can be changed in place,
+            # so their stored value can't be trusted anymore.
+            if isinstance(value, (dict, list, LazyContainer)):
+                self._raw[key] = _TOUCHED
+
+        return value
+
+    def _set(self, key, value):
+        self._data[key] = value
+        self._raw[key] = _TOUCHED
+
+    def raw_value(self, key):
+        """
+        Returns a `(untouched, raw)` tuple for the key.
+
+        When untouched is True, raw is the value as it was loaded from the
+        database and can be stored again as is.
+
+        Returns:
+            tuple(bool, object)
+        """
+        raw = self._raw[key]
+        return raw is not _TOUCHED, raw
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, materialize(self))
+
+
+class LazyDecryptedDict(LazyContainer, MutableMapping):
+    """
+    A dict like container that decrypts its values on access.
+    """
+
+    def __init__(self, raw):
+        self._raw = dict(raw)
+        self._data = dict.fromkeys(raw, _PENDING)
+
+    def __getitem__(self, key):
+        return self._get(key)
+
+    def __setitem__(self, key, value):
+        self._set(key, value)
+
+    def __delitem__(self, key):
+        del self._data[key]
+        del self._raw[key]
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+
+class LazyDecryptedList(LazyContainer, MutableSequence):
+    """
+    A list like container that decrypts its values on access.
+    """
+
+    def __init__(self, raw):
+        self._raw = list(raw)
+        self._data = [_PENDING] * len(self._raw)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [
+                self._get(i) for i in range(*index.indices(len(self)))
+            ]
+        return self._get(index)
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            value = list(value)
+            self._data[index] = value
+            self._raw[index] = [_TOUCHED] * len(value)
+        else:
+            self._set(index, value)
+
+    def __delitem__(self, index):
+        del self._data[index]
+        del self._raw[index]
+
+    def __len__(self):
+        return len(self._data)
+
+    def insert(self, index, value):
+        self._data.insert(index, value)
+        self._raw.insert(index, _TOUCHED)
+
+    def __eq__(self, other):
+        if isinstance(other, (list, LazyDecryptedList)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+
+def lazy_decrypt_values(data):
+    """
+    Returns data wrapped in lazily decrypting containers.
+
+    Dicts and lists are returned as `LazyDecryptedDict` and
+    `LazyDecryptedList`, no value is decrypted until it is read.  Any other
+    value is decrypted right away with `decrypt_values`.
+
+    Arguments:
+        data (object): the data to decrypt.
+
+    Returns:
+        object
+    """
+    if isinstance(data, LazyContainer):
+        return data
+
+    return _decode(data)
+
+
+def materialize(data):
+    """
+    Returns data with all lazy containers replaced by plain dicts and lists.
+
+    Returns:
+        object
+    """
+    if isinstance(data, (dict, LazyDecryptedDict)):
+        return {key: materialize(value) for key, value in data.iteritems()}
+
+    if isinstance(data, (list, LazyDecryptedList)):
+        return [materialize(value) for value in data]
+
+    return data
@@ -0,0 +1,500 @@
+"""
+Helpers for the management commands that rewrite encrypted columns.
+"""
+import json
+import os
+import time
+import uuid
+
+from cryptography.fernet import InvalidToken
+from django.apps import apps
+from django.db import connections, transaction
+from django_pgjson.fields import JsonAdapter
+
+from . import utils
+from .batch import encrypt_many
+from .blind_index import BLIND_INDEX_KEY, strip_blind_index
+from .skip_rules import compile_skip_keys
+
+
+def get_encrypted_fields(labels=None):
+    """
+    Yields `(model, field)` for every encrypted json field.
+
+    Arguments:
+        labels (list[str]): only include these models, given as
+            `app_label.ModelName` or `app_label`.
+
+    Returns:
+        generator
+    """
+    from .fields import EncryptedValueJsonField
+
+    labels = set(label.lower() for label in labels or [])
+
+    for model in apps.get_models():
+        opts = model._meta
+        if opts.proxy or not opts.managed:
+            continue
+
+        if labels and opts.app_label.lower() not in labels and \
+                get_model_label(model) not in labels:
+            continue
+
+        for field in opts.concrete_fields:
+            if isinstance(field, EncryptedValueJsonField):
+                yield model, field
+
+
+def get_model_label(model):
+    return '%s.%s' % (model._meta.app_label, model._meta.model_name)
+
+
+def get_label(model, field):
+    return '%s.%s' % (get_model_label(model), field.name)
+
+
+class Checkpoint(object):
+    """
+    The last primary key processed for each column, kept in a json file.
+
+    Without a path nothing is stored and every run starts from the top.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.data = {}
+
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.data = json.load(f)
+
+    def get(self, label):
+        return self.data.get(label)
+
+    def set(self, label, pk):
+        self.data[label] = pk
+
+        if not self.path:
+            return
+
+        # write and rename so an interrupted run can't truncate the file
+        tmp = '%s.tmp' % self.path
+        with open(tmp, 'w') as f:
+            json.dump(self.data, f)
+        os.rename(tmp, self.path)
+
+
+class ThroughputReporter(object):
+    """
+    Writes progress and rows per second for a column to a stream.
+
+    With changes=False the number of changed rows is left out.
+    """
+
+    def __init__(self, stream, label, changes=True):
+        self.stream = stream
+        self.label = label
+        self.changes = changes
+        self.start = time.time()
+        self.rows = 0
+        self.changed = 0
+
+    @property
+    def rate(self):
+        elapsed = time.time() - self.start
+        return self.rows / elapsed if elapsed else 0.0
+
+    def update(self, rows, changed=0):
+        self.rows += rows
+        self.changed += changed
+        self.report()
+
+    def report(self, final=False):
+        changed = ''
+        if self.changes:
+            changed = ' %d changed,' % self.changed
+        self.stream.write(
+            '%s: %s%d rows,%s %.0f rows/s\n' % (
+                self.label, 'done ' if final else '', self.rows, changed,
+                self.rate)
+        )
+
+
+def get_pk_cast(model, connection):
+    pk = model._meta.pk
+    if pk.get_internal_type() == 'AutoField':
+        return 'integer'
+    return pk.db_type(connection)
+
+
+def iter_keyset(model, field, batch_size, after=None, using='default'):
+    """
+    Yields lists of `(pk, value, text)` rows ordered by primary key, where
+    text is the value as stored, leaving out the NULL values.
+
+    Each batch is a separate `WHERE pk > last ORDER BY pk LIMIT` query, so
+    no cursor is held open between batches and rows written meanwhile are
+    seen by the later batches.  Pass the text to `bulk_update_if_unchanged`
+    so the rows written since they were read aren't overwritten.
+
+    Arguments:
+        model: the model to read.
+        field: the encrypted field to read.
+        batch_size (int): the number of rows per batch.
+        after: only read rows with a primary key greater than this.
+        using (str): the database alias.
+
+    Returns:
+        generator
+    """
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    pk_column = qn(model._meta.pk.column)
+    select = (
+        'SELECT {pk}, {column}::text FROM {table} '
+        'WHERE {column} IS NOT NULL'
+    ).format(
+        pk=pk_column,
+        column=qn(field.column),
+        table=qn(model._meta.db_table),
+    )
+    order = ' ORDER BY {pk} LIMIT %s'.format(pk=pk_column)
+
+    while True:
+        if after is None:
+            sql, params = select + order, [batch_size]
+        else:
+            sql = select + ' AND {pk} > %s'.format(pk=pk_column) + order
+            params = [after, batch_size]
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            rows = [
+                (pk, json.loads(text), text)
+                for pk, text in cursor.fetchall()
+            ]
+
+        if not rows:
+            return
+        yield rows
+        if len(rows) < batch_size:
+            return
+        after = rows[-1][0]
+
+
+def iter_chunks(raw_connection, sql, params, batch_size):
+    """
+    Yields the rows of the query in lists of batch_size rows, read through
+    a server side cursor.
+
+    The cursor only lives as long as the transaction, call it inside
+    `transaction.atomic()`.  A `WITH HOLD` cursor would have the database
+    run the whole query and copy its result before the first row is
+    returned.
+
+    Arguments:
+        raw_connection: the psycopg2 connection.
+        sql (str): the query.
+        params (list): the query parameters.
+        batch_size (int): the number of rows per list.
+
+    Returns:
+        generator
+    """
+    cursor = raw_connection.cursor(
+        name='django_encrypted_json_%s' % uuid.uuid4().hex)
+    cursor.itersize = batch_size
+    try:
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        cursor.close()
+
+
+def bulk_update(model, field, rows, using='default'):
+    """
+    Writes the `(pk, value)` rows with a single UPDATE statement.
+
+    The values are written as is, they must already be encrypted.
+    """
+    if not rows:
+        return
+
+    connection = connections[using]
+    qn = connection.ops.quote_name
+
+    sql = (
+        'UPDATE {table} SET {column} = v.value::{db_type} '
+        'FROM (VALUES {values}) AS v(pk, value) '
+        'WHERE {table}.{pk} = v.pk::{pk_cast}'
+    ).format(
+        table=qn(model._meta.db_table),
+        column=qn(field.column),
+        db_type=field.db_type(connection),
+        values=', '.join(['(%s, %s)'] * len(rows)),
+        pk=qn(model._meta.pk.column),
+        pk_cast=get_pk_cast(model, connection),
+    )
+    params = []
+    for pk, value in rows:
+        params.extend([pk, JsonAdapter(value)])
+
+    with transaction.atomic(using=using):
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+
+
+def bulk_update_if_unchanged(model, field, rows, using='default'):
+    """
+    Writes the `(pk, text, value)` rows with a single UPDATE statement,
+    only where the column still holds text, the value read by
+    `iter_keyset`.
+
+    Rows the application wrote since they were read are left as they are,
+    the values it writes are already encrypted with the current keys.
+
+    Returns:
+        int - the number of rows written.
+    """
+    if not rows:
+        return 0
+
+    connection = connections[using]
+    qn = connection.ops.quote_name
+
+    sql = (
+        'UPDATE {table} SET {column} = v.value::{db_type} '
+        'FROM (VALUES {values}) AS v(pk, old, value) '
+        'WHERE {table}.{pk} = v.pk::{pk_cast} '
+        'AND {table}.{column}::text = v.old'
+    ).format(
+        table=qn(model._meta.db_table),
+        column=qn(field.column),
+        db_type=field.db_type(connection),
+        values=', '.join(['(%s, %s, %s)'] * len(rows)),
+        pk=qn(model._meta.pk.column),
+        pk_cast=get_pk_cast(model, connection),
+    )
+    params = []
+    for pk, text, value in rows:
+        params.extend([pk, text, JsonAdapter(value)])
+
+    with transaction.atomic(using=using):
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.rowcount
+
+
+def rotate_values(data, ring=None):
+    """
+    Re-encrypts, in place, every token in data not using the primary key
+    and the cipher set by `FIELD_ENCRYPTION_CIPHER`.
+
+    Only tokens are touched, plaintext values, skipped keys and the layout
+    of envelope documents are left as they are.  The decrypted bytes are
+    encrypted again directly, they are never deserialized.
+
+    Arguments:
+        data (object): a document loaded from the database.
+        ring (KeyRing): the keys, defaults to `utils.get_crypter()`.
+
+    Returns:
+        tuple(object, int, int) - the data, the number of rotated tokens
+        and the number of tokens none of the keys could decrypt.
+    """
+    ring = ring or utils.get_crypter()
+
+    if utils.is_token(data):
+        root = [data]
+    elif isinstance(data, (dict, list)):
+        root = data
+    else:
+        return data, 0, 0
+
+    slots = []
+    payloads = []
+    failed = 0
+    for container, key, token in utils.iter_tokens(root):
+        token = token.encode('ascii')
+        if ring.is_primary(token):
+            continue
+        try:
+            payloads.append(ring.decrypt(token))
+        except InvalidToken:
+            failed += 1
+            continue
+        slots.append((container, key))
+
+    tokens = encrypt_many(payloads, ring)
+    for (container, key), token in zip(slots, tokens):
+        container[key] = token
+
+    if root is not data:
+        data = root[0]
+    return data, len(slots), failed
+
+
+def iter_plaintext(data, skip_keys=None, blind_index=False):
+    """
+    Yields `(container, key, value)` for every value of data outside of
+    skip_keys that is not a token.
+
+    Arguments:
+        data (dict or list): a document loaded from the database.
+        skip_keys (list[str] or SkipRules): the keys stored in plaintext.
+        blind_index (bool): leave out the blind index of data.
+
+    Returns:
+        generator
+    """
+    rules = compile_skip_keys(skip_keys)
+    stack = [(data, rules.root)]
+    while stack:
+        container, state = stack.pop()
+        is_list = isinstance(container, list)
+        if is_list:
+            items = enumerate(container)
+        else:
+            items = (
+                (key, value) for key, value in container.iteritems()
+                if not blind_index or container is not data or
+                key != BLIND_INDEX_KEY
+            )
+
+        for key, value in items:
+            skipped, item_state = rules.enter(state, key, index=is_list)
+            if skipped:
+                continue
+            if isinstance(value, (dict, list)):
+                stack.append((value, item_state))
+            elif not utils.is_token(value):
+                yield container, key, value
+
+
+def encrypt_plaintext(data, field, ring=None, dry_run=False):
+    """
+    Encrypts, in place, the plaintext values of a document the field
+    encrypts, e.g. rows written before the column was encrypted.
+
+    Tokens are recognized by their shape and left as they are.  Documents
+    of envelope fields and of fields with a blind index are encrypted again
+    whole, the way the field writes them, other documents only get their
+    plaintext values encrypted, in one batch.
+
+    Arguments:
+        data (object): a document loaded from the database.
+        field (EncryptedValueJsonField): the field of the column.
+        ring (KeyRing): the keys, defaults to `utils.get_crypter()`.
+        dry_run (bool): only count the plaintext values.
+
+    Returns:
+        tuple(object, int, int) - the data, the number of plaintext values
+        and the size in bytes of their serialized form.
+    """
+    if utils.is_envelope(data):
+        return data, 0, 0
+
+    if isinstance(data, (dict, list)):
+        root = data
+    else:
+        root = [data]
+
+    encode = utils.get_leaf_encoder()
+    slots = []
+    payloads = []
+    leaves = iter_plaintext(
+        root, field.skip_rules, blind_index=bool(field.blind_index))
+    for container, key, value in leaves:
+        slots.append((container, key))
+        payloads.append(encode(value))
+
+    size = sum(len(payload) for payload in payloads)
+    if dry_run or not slots:
+        return data, len(slots), size
+
+    if field.envelope or field.blind_index:
+        if field.blind_index:
+            data = strip_blind_index(data)
+        plain = utils.decrypt_values(data, field.get_decrypter())
+        return field.encrypt(plain, ring), len(slots), size
+
+    if field.compressor is not None:
+        payloads = [field.compressor.compress(payload)
+                    for payload in payloads]
+    tokens = encrypt_many(payloads, ring)
+    for (container, key), token in zip(slots, tokens):
+        container[key] = token
+
+    if root is not data:
+        data = root[0]
+    return data, len(slots), size
+
+
+def encrypt_column(model, field, batch_size=1000, using='default',
+                   checkpoint=None, reporter=None, dry_run=False):
+    """
+    Encrypts the plaintext values of a column, batch by batch.
+
+    Arguments:
+        model: the model of the column.
+        field (EncryptedValueJsonField): the field of the column.
+        batch_size (int): the number of rows read and updated at a time.
+        using (str): the database alias.
+        checkpoint (Checkpoint): where to resume from and record progress,
+            it isn't updated by a dry run.
+        reporter (ThroughputReporter): reports the progress.
+        dry_run (bool): only count the plaintext values.
+
+    Raises:
+        ValueError: if the field uses per row keys.
+
+    Rows are only updated when they still hold the value that was read,
+    rows written in the meantime are left as they are and counted in
+    `skipped`, run the command again to encrypt them.
+
+    Returns:
+        dict - the numbers of rows read, `rows`, rows with plaintext values,
+        `changed`, rows written meanwhile, `skipped`, plaintext values,
+        `values`, and their size, `bytes`.
+    """
+    if field.key_resolver is not None:
+        raise ValueError(
+            "%s is encrypted with per row keys, save the instances "
+            "instead" % field.name)
+
+    ring = utils.KeyRing.from_settings()
+    label = get_label(model, field)
+    after = checkpoint.get(label) if checkpoint is not None else None
+    totals = {'rows': 0, 'changed': 0, 'skipped': 0, 'values': 0,
+              'bytes': 0}
+
+    for rows in iter_keyset(model, field, batch_size, after, using):
+        updates = []
+        for pk, value, text in rows:
+            value, count, size = encrypt_plaintext(
+                value, field, ring, dry_run=dry_run)
+            if count:
+                updates.append((pk, text, value))
+                totals['values'] += count
+                totals['bytes'] += size
+
+        written = len(updates)
+        if not dry_run:
+            written = bulk_update_if_unchanged(
+                model, field, updates, using=using)
+            if checkpoint is not None:
+                checkpoint.set(label, rows[-1][0])
+        totals['rows'] += len(rows)
+        totals['changed'] += written
+        totals['skipped'] += len(updates) - written
+        if reporter is not None:
+            reporter.update(len(rows), written)
+
+    if reporter is not None:
+        reporter.report(final=True)
+    return totals
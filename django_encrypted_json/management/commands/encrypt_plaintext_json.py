@@ -0,0 +1,61 @@
+from django.core.management.base import BaseCommand
+
+from ...maintenance import (
+    Checkpoint, ThroughputReporter, encrypt_column, get_encrypted_fields,
+    get_label
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Encrypts the plaintext values left in the encrypted json columns, "
+        "e.g. rows written before the column was encrypted.  Values that "
+        "are already tokens are left alone."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'labels', nargs='*', metavar='app_label[.ModelName]',
+            help='Only encrypt the fields of these apps or models.')
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='The number of rows read and updated at a time.')
+        parser.add_argument(
+            '--checkpoint',
+            help='A file recording the progress, an interrupted run started '
+                 'with the same file resumes where it stopped.')
+        parser.add_argument(
+            '--database', default='default',
+            help='The database to encrypt.')
+        parser.add_argument(
+            '--dry-run', action='store_true', default=False,
+            help='Only count the plaintext values, nothing is written.')
+
+    def handle(self, *args, **options):
+        checkpoint = Checkpoint(options['checkpoint'])
+        dry_run = options['dry_run']
+
+        for model, field in get_encrypted_fields(options['labels']):
+            label = get_label(model, field)
+            if field.key_resolver is not None:
+                self.stderr.write(
+                    '%s: skipped, it is encrypted with per row keys, save '
+                    'the instances instead' % label)
+                continue
+
+            totals = encrypt_column(
+                model, field,
+                batch_size=options['batch_size'],
+                using=options['database'],
+                checkpoint=checkpoint,
+                reporter=ThroughputReporter(self.stdout, label),
+                dry_run=dry_run,
+            )
+            self.stdout.write(
+                '%s: %s %d plaintext values, %d bytes, in %d rows\n' % (
+                    label, 'found' if dry_run else 'encrypted',
+                    totals['values'], totals['bytes'], totals['changed']))
+            if totals['skipped']:
+                self.stderr.write(
+                    '%s: %d rows were written while they were encrypted and '
+                    'left as they are' % (label, totals['skipped']))
@@ -0,0 +1,75 @@
+from django.core.management.base import BaseCommand
+
+from ...maintenance import (
+    Checkpoint, ThroughputReporter, bulk_update_if_unchanged,
+    get_encrypted_fields, get_label, iter_keyset, rotate_values
+)
+from ...utils import KeyRing
+
+
+class Command(BaseCommand):
+    help = (
+        "Re-encrypts the encrypted json columns with the first key in "
+        "FIELD_ENCRYPTION_KEY.  Values already encrypted with that key are "
+        "left alone, as are rows written while they were rotated."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'labels', nargs='*', metavar='app_label[.ModelName]',
+            help='Only rotate the fields of these apps or models.')
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='The number of rows read and updated at a time.')
+        parser.add_argument(
+            '--checkpoint',
+            help='A file recording the progress, an interrupted run started '
+                 'with the same file resumes where it stopped.')
+        parser.add_argument(
+            '--database', default='default',
+            help='The database to rotate.')
+
+    def handle(self, *args, **options):
+        ring = KeyRing.from_settings()
+        checkpoint = Checkpoint(options['checkpoint'])
+        batch_size = options['batch_size']
+        using = options['database']
+
+        for model, field in get_encrypted_fields(options['labels']):
+            label = get_label(model, field)
+            if field.key_resolver is not None:
+                self.stderr.write(
+                    '%s: skipped, it is encrypted with per row keys, rotate '
+                    'them by resolving new key ids' % label)
+                continue
+
+            reporter = ThroughputReporter(self.stdout, label)
+            failed = 0
+            skipped = 0
+
+            batches = iter_keyset(
+                model, field, batch_size,
+                after=checkpoint.get(label), using=using)
+            for rows in batches:
+                updates = []
+                for pk, value, text in rows:
+                    value, rotated, row_failed = rotate_values(value, ring)
+                    failed += row_failed
+                    if rotated:
+                        updates.append((pk, text, value))
+
+                written = bulk_update_if_unchanged(
+                    model, field, updates, using=using)
+                skipped += len(updates) - written
+                checkpoint.set(label, rows[-1][0])
+                reporter.update(len(rows), written)
+
+            reporter.report(final=True)
+            if failed:
+                self.stderr.write(
+                    '%s: %d values could not be decrypted with any key' % (
+                        label, failed))
+            if skipped:
+                self.stderr.write(
+                    '%s: %d rows were written while they were rotated and '
+                    'left as they are' % (label, skipped))
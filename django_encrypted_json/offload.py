@@ -0,0 +1,314 @@
+"""
+Encrypts and decrypts off the calling thread.
+
+Services running an event loop can't afford to encrypt a large document on
+the loop's thread.  The functions here hand the work to a shared, bounded
+thread pool (the OpenSSL calls release the GIL) and return a future right
+away:
+
+    future = encrypt_values_async(data, skip_keys=['test'])
+    future.add_done_callback(store)
+
+Documents with fewer than `FIELD_ENCRYPTION_INLINE_LEAVES` values (100 by
+default) are cheaper to encrypt than to hand over, they are done inline and
+the returned future is already done.
+
+The futures are `concurrent.futures.Future` instances when that module is
+available, so on Python 3 they can be awaited with `asyncio.wrap_future`.
+Otherwise `Future` provides the same `result`, `exception`, `done` and
+`add_done_callback` methods.
+
+The pool has `FIELD_ENCRYPTION_EXECUTOR_WORKERS` threads, the number of cpus
+by default.  At most `FIELD_ENCRYPTION_EXECUTOR_QUEUE_SIZE` jobs (4 per
+worker by default) wait for a thread.  Submitting more never blocks the
+caller, it raises `QueueFull` right away, so the caller can shed the load
+or retry later.  `get_executor().stats()` reports the queue depth and the
+rejected jobs.
+"""
+import multiprocessing
+import threading
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import connections
+
+from .batch import encrypt_values_batch
+from .cache import get_decryption_cache
+from .instrumentation import count_leaves
+from .utils import decrypt_values
+
+EXECUTOR_SETTINGS = (
+    'FIELD_ENCRYPTION_EXECUTOR_WORKERS',
+    'FIELD_ENCRYPTION_EXECUTOR_QUEUE_SIZE',
+)
+
+try:
+    from concurrent.futures import Future
+except ImportError:
+    class Future(object):
+        """
+        The subset of `concurrent.futures.Future` used by this module.
+        """
+
+        def __init__(self):
+            self._done = threading.Event()
+            self._result = None
+            self._exception = None
+            self._callbacks = []
+            self._lock = threading.Lock()
+
+        def done(self):
+            return self._done.is_set()
+
+        def result(self, timeout=None):
+            if not self._done.wait(timeout):
+                raise RuntimeError('The job did not finish in time')
+            if self._exception is not None:
+                raise self._exception
+            return self._result
+
+        def exception(self, timeout=None):
+            if not self._done.wait(timeout):
+                raise RuntimeError('The job did not finish in time')
+            return self._exception
+
+        def add_done_callback(self, fn):
+            with self._lock:
+                if not self.done():
+                    self._callbacks.append(fn)
+                    return
+            fn(self)
+
+        def set_result(self, result):
+            self._result = result
+            self._finish()
+
+        def set_exception(self, exception):
+            self._exception = exception
+            self._finish()
+
+        def _finish(self):
+            with self._lock:
+                self._done.set()
+                callbacks, self._callbacks = self._callbacks, []
+            for fn in callbacks:
+                fn(self)
+
+
+class QueueFull(RuntimeError):
+    """
+    Raised when a job is submitted while the queue of the executor is full.
+    """
+
+
+class EncryptionExecutor(object):
+    """
+    A bounded thread pool for encryption jobs.
+    """
+
+    def __init__(self, workers, max_queue):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.queued = 0
+        self.running = 0
+        self.peak_queued = 0
+        self.submitted = 0
+        self.completed = 0
+        self.rejected = 0
+        self.inline = 0
+        self._pool = None
+        self._slots = threading.BoundedSemaphore(max_queue)
+        self._lock = threading.Lock()
+
+    def stats(self):
+        """
+        Returns the counters of the executor.
+
+        Returns:
+            dict
+        """
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'max_queue': self.max_queue,
+                'queued': self.queued,
+                'running': self.running,
+                'peak_queued': self.peak_queued,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'inline': self.inline,
+            }
+
+    def submit(self, func, *args):
+        """
+        Returns a future for func(*args) run on the pool.
+
+        Raises:
+            QueueFull: if `max_queue` jobs are already waiting for a thread.
+        """
+        if not self._slots.acquire(False):
+            with self._lock:
+                self.rejected += 1
+            raise QueueFull(
+                '%d encryption jobs are already waiting' % self.max_queue)
+
+        future = Future()
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.workers)
+            self.queued += 1
+            self.submitted += 1
+            self.peak_queued = max(self.peak_queued, self.queued)
+
+        self._pool.apply_async(self._run, (future, func, args))
+        return future
+
+    def run_inline(self, func, *args):
+        """
+        Returns a done future for func(*args) run on the calling thread.
+        """
+        with self._lock:
+            self.inline += 1
+
+        future = Future()
+        try:
+            future.set_result(func(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def _run(self, future, func, args):
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+        self._slots.release()
+
+        result = error = None
+        try:
+            result = func(*args)
+        except Exception as e:
+            error = e
+
+        # before the future is resolved, its callers may read the stats
+        with self._lock:
+            self.running -= 1
+            self.completed += 1
+
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def shutdown(self):
+        """
+        Stops the pool once the submitted jobs are done.
+        """
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.close()
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    Returns the process wide `EncryptionExecutor`.
+
+    Returns:
+        EncryptionExecutor
+    """
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            workers = getattr(
+                settings, 'FIELD_ENCRYPTION_EXECUTOR_WORKERS', None
+            ) or multiprocessing.cpu_count()
+            max_queue = getattr(
+                settings, 'FIELD_ENCRYPTION_EXECUTOR_QUEUE_SIZE', None
+            ) or workers * 4
+            _executor = EncryptionExecutor(workers, max_queue)
+        return _executor
+
+
+def reset_executor(**kwargs):
+    """
+    Replaces the executor when its settings change.
+    """
+    global _executor
+
+    if kwargs.get('setting', EXECUTOR_SETTINGS[0]) not in EXECUTOR_SETTINGS:
+        return
+
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown()
+
+
+setting_changed.connect(reset_executor)
+
+
+def is_small(data):
+    threshold = getattr(settings, 'FIELD_ENCRYPTION_INLINE_LEAVES', 100)
+    return count_leaves(data, limit=threshold) < threshold
+
+
+def encrypt_values_async(data, skip_keys=None):
+    """
+    Returns a future of data encrypted with `encrypt_values_batch`.
+
+    Arguments:
+        data (object): the data to encrypt.
+        skip_keys (list[str]): a list of keys that should not be encrypted
+
+    Returns:
+        Future
+    """
+    executor = get_executor()
+    if is_small(data):
+        return executor.run_inline(encrypt_values_batch, data, skip_keys)
+    return executor.submit(encrypt_values_batch, data, skip_keys)
+
+
+def _decrypt(data):
+    return decrypt_values(data, cache=get_decryption_cache())
+
+
+def decrypt_values_async(data):
+    """
+    Returns a future of data decrypted with `decrypt_values`.
+
+    Returns:
+        Future
+    """
+    executor = get_executor()
+    if is_small(data):
+        return executor.run_inline(_decrypt, data)
+    return executor.submit(_decrypt, data)
+
+
+def _fetch(queryset):
+    try:
+        return list(queryset)
+    finally:
+        # the connections of a pool thread are never reused by a request
+        connections.close_all()
+
+
+def fetch_decrypted_async(queryset):
+    """
+    Returns a future of the list of instances of queryset.
+
+    The query and the decryption of the encrypted fields both run on the
+    pool, on a database connection of its own.
+
+    Returns:
+        Future
+    """
+    return get_executor().submit(_fetch, queryset.all())
@@ -0,0 +1,150 @@
+"""
+Migration operations for encrypted json fields.
+"""
+import hashlib
+
+from django.apps import apps as global_apps
+from django.db.backends.utils import truncate_name
+from django.db.migrations.operations.base import Operation
+
+from .maintenance import encrypt_column
+from .plaintext import path_sql
+
+
+class AddPlaintextIndex(Operation):
+    """
+    Creates an index on the plaintext `skip_keys` values of a field.
+
+    With a path, a btree index on the text at the path, used by
+    `filter(data__plain__tenant=...)`:
+
+        AddPlaintextIndex('document', 'data', path=['tenant'])
+
+    Without a path, a GIN index on the whole jsonb column, used by
+    `filter(data__jcontains={'tenant': ...})`:
+
+        AddPlaintextIndex('document', 'data', method='gin')
+
+    Historical models don't know the `skip_keys` of a field, the path is
+    not checked here, only by the `plain` lookups.
+
+    The index is created with `CREATE INDEX CONCURRENTLY` when `concurrently`
+    is True, the migration must then set `atomic = False`.
+    """
+
+    reduces_to_sql = True
+    reversible = True
+
+    def __init__(self, model_name, name, path=None, method='btree',
+                 index_name=None, concurrently=False):
+        self.model_name = model_name
+        self.name = name
+        self.path = list(path) if path else None
+        self.method = method
+        self.index_name = index_name
+        self.concurrently = concurrently
+
+        if method not in ('btree', 'gin'):
+            raise ValueError('Unknown index method %r' % method)
+        if method == 'btree' and not self.path:
+            raise ValueError('A btree plaintext index needs a path')
+
+    def state_forwards(self, app_label, state):
+        pass
+
+    def get_index_name(self, schema_editor, model, field):
+        if self.index_name:
+            return self.index_name
+
+        digest = hashlib.md5(
+            '.'.join(self.path or [self.method]).encode('utf-8')).hexdigest()
+        return truncate_name(
+            '%s_%s_plain_%s' % (model._meta.db_table, field.column, digest[:8]),
+            schema_editor.connection.ops.max_name_length())
+
+    def get_expression(self, schema_editor, model, field):
+        column = schema_editor.quote_name(field.column)
+        if self.method == 'gin':
+            return '%s jsonb_path_ops' % column
+        return '(%s)' % path_sql(column, self.path)
+
+    def database_forwards(self, app_label, schema_editor, from_state,
+                          to_state):
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, model):
+            return
+
+        field = model._meta.get_field(self.name)
+        schema_editor.execute(
+            'CREATE INDEX %s%s ON %s USING %s (%s)' % (
+                'CONCURRENTLY ' if self.concurrently else '',
+                schema_editor.quote_name(
+                    self.get_index_name(schema_editor, model, field)),
+                schema_editor.quote_name(model._meta.db_table),
+                self.method,
+                self.get_expression(schema_editor, model, field),
+            )
+        )
+
+    def database_backwards(self, app_label, schema_editor, from_state,
+                           to_state):
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, model):
+            return
+
+        field = model._meta.get_field(self.name)
+        schema_editor.execute('DROP INDEX %s%s' % (
+            'CONCURRENTLY ' if self.concurrently else '',
+            schema_editor.quote_name(
+                self.get_index_name(schema_editor, model, field)),
+        ))
+
+    def describe(self):
+        return 'Create %s index on the plaintext %s of %s.%s' % (
+            self.method, '.'.join(self.path or ['values']),
+            self.model_name, self.name)
+
+
+class EncryptPlaintextValues(Operation):
+    """
+    Encrypts the plaintext values of a column, batch by batch, e.g. after
+    an `AlterField` turning a `JsonField` into an encrypted one:
+
+        EncryptPlaintextValues('document', 'data', batch_size=5000)
+
+    Historical models don't know the options of a field, its `skip_keys`,
+    `envelope` or `blind_index`, so the current model is used.  Values that
+    are already tokens are left alone, reversing the migration leaves the
+    encrypted values as they are.  See the `encrypt_plaintext_json` command
+    for large tables, it can resume an interrupted run.
+    """
+
+    reduces_to_sql = False
+    reversible = True
+
+    def __init__(self, model_name, name, batch_size=1000):
+        self.model_name = model_name
+        self.name = name
+        self.batch_size = batch_size
+
+    def state_forwards(self, app_label, state):
+        pass
+
+    def database_forwards(self, app_label, schema_editor, from_state,
+                          to_state):
+        model = global_apps.get_model(app_label, self.model_name)
+        alias = schema_editor.connection.alias
+        if not self.allow_migrate_model(alias, model):
+            return
+
+        encrypt_column(
+            model, model._meta.get_field(self.name),
+            batch_size=self.batch_size, using=alias)
+
+    def database_backwards(self, app_label, schema_editor, from_state,
+                           to_state):
+        pass
+
+    def describe(self):
+        return 'Encrypt the plaintext values of %s.%s' % (
+            self.model_name, self.name)
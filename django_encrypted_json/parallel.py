@@ -0,0 +1,228 @@
+"""
+Encrypts the values of many model instances on a pool of workers.
+
+`encrypt_values` runs on a single thread inside `get_db_prep_value`.  For
+bulk writes the field values can instead be encrypted up front on a thread
+pool (the OpenSSL calls release the GIL) or a process pool, and then stored
+as `PreEncryptedValue` instances, which the field writes as they are:
+
+    parallel_bulk_create(objs, workers=8)
+    parallel_bulk_update(objs, fields=['json'])
+
+or through `ParallelEncryptionManager`:
+
+    TestModel.objects.parallel_bulk_create(objs)
+
+The stored values are the same as the ones the serial path writes.
+
+With `processes=True` the values are encrypted in the child processes but
+reported to the instrumentation by the calling process, see
+`django_encrypted_json.instrumentation`, so the signal receivers and the
+callback run there.
+"""
+import multiprocessing
+import time
+from functools import partial
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.db import models
+
+from .fields import EncryptedValueJsonField, PreEncryptedValue
+from .instrumentation import get_size, instrument, is_instrumented, report
+from .key_providers import get_key_ring
+from .maintenance import bulk_update
+
+
+def _encrypt(job):
+    field, value, key_id = job
+    ring = get_key_ring(key_id) if key_id is not None else None
+    return instrument(
+        field, 'encrypt', partial(field.encrypt, ring=ring), value)
+
+
+def _encrypt_timed(job):
+    # in a child process, which can't report to the instrumentation of the
+    # caller, only the duration is sent back
+    field, value, key_id = job
+    ring = get_key_ring(key_id) if key_id is not None else None
+    start = time.time()
+    result = field.encrypt(value, ring=ring)
+    return result, time.time() - start
+
+
+def get_encrypted_model_fields(model, names=None):
+    """
+    Returns the encrypted json fields of the model.
+
+    Arguments:
+        model: the model class.
+        names (list[str]): only return these fields.
+
+    Returns:
+        list[EncryptedValueJsonField]
+    """
+    if names is not None:
+        return [model._meta.get_field(name) for name in names]
+
+    return [
+        field for field in model._meta.concrete_fields
+        if isinstance(field, EncryptedValueJsonField)
+    ]
+
+
+def encrypt_instances(objs, fields=None, workers=None, chunk_size=None,
+                      processes=False):
+    """
+    Returns the encrypted field values of objs, encrypted in parallel.
+
+    Arguments:
+        objs (list[Model]): instances of a single model.
+        fields (list[str]): the encrypted fields to encrypt, defaults to all
+            of them.
+        workers (int): the pool size, defaults to
+            `FIELD_ENCRYPTION_PARALLEL_WORKERS` or the number of cpus.
+        chunk_size (int): the number of values handed to a worker at a
+            time, defaults to `FIELD_ENCRYPTION_PARALLEL_CHUNK_SIZE` or 100.
+        processes (bool): use a process pool instead of a thread pool.
+
+    Returns:
+        list[tuple] - `(obj, field, PreEncryptedValue)` triples.
+    """
+    if not objs:
+        return []
+
+    workers = workers or getattr(
+        settings, 'FIELD_ENCRYPTION_PARALLEL_WORKERS', None
+    ) or multiprocessing.cpu_count()
+    chunk_size = chunk_size or getattr(
+        settings, 'FIELD_ENCRYPTION_PARALLEL_CHUNK_SIZE', 100)
+
+    slots = []
+    jobs = []
+    for field in get_encrypted_model_fields(type(objs[0]), fields):
+        for obj in objs:
+            value = getattr(obj, field.attname)
+            if isinstance(value, PreEncryptedValue):
+                continue
+            # the id is sent rather than the ring, process pools pickle jobs
+            key_id = None
+            if field.key_resolver is not None:
+                key_id = field.key_resolver(obj)
+            slots.append((obj, field))
+            jobs.append((field, value, key_id))
+
+    if processes:
+        pool = multiprocessing.Pool(workers)
+        func = _encrypt_timed
+    else:
+        pool = ThreadPool(workers)
+        func = _encrypt
+    try:
+        values = pool.map(func, jobs, chunk_size)
+    finally:
+        pool.close()
+        pool.join()
+
+    if processes:
+        instrumented = is_instrumented('encrypt')
+        for index, (result, duration) in enumerate(values):
+            if instrumented:
+                field, value, _ = jobs[index]
+                report(field, 'encrypt', value, result, duration,
+                       get_size(value))
+            values[index] = result
+
+    return [
+        (obj, field, PreEncryptedValue(value))
+        for (obj, field), value in zip(slots, values)
+    ]
+
+
+def parallel_bulk_create(objs, batch_size=None, queryset=None, **options):
+    """
+    `bulk_create` with the encrypted fields encrypted in parallel.
+
+    The instances keep their decrypted values afterwards.
+
+    Arguments:
+        objs (list[Model]): instances of a single model.
+        batch_size (int): passed on to `bulk_create`.
+        queryset (QuerySet): the queryset to create the objects with,
+            defaults to the default manager of the model.
+        options: passed on to `encrypt_instances`.
+
+    Returns:
+        list[Model]
+    """
+    objs = list(objs)
+    if not objs:
+        return objs
+
+    if queryset is None:
+        queryset = type(objs[0])._default_manager.all()
+
+    encrypted = encrypt_instances(objs, **options)
+    originals = [
+        (obj, field, obj.__dict__[field.attname])
+        for obj, field, _ in encrypted
+    ]
+    # Written to the instance dict directly, setattr would go through the
+    # to_python of SubfieldBase and decrypt the restored values again.
+    try:
+        for obj, field, value in encrypted:
+            obj.__dict__[field.attname] = value
+        return models.QuerySet.bulk_create(
+            queryset, objs, batch_size=batch_size)
+    finally:
+        for obj, field, value in originals:
+            obj.__dict__[field.attname] = value
+
+
+def parallel_bulk_update(objs, fields=None, batch_size=1000,
+                         using='default', **options):
+    """
+    Writes the encrypted fields of saved objs, encrypted in parallel.
+
+    Only the encrypted fields are written, one `UPDATE ... FROM (VALUES ...)`
+    statement per field and batch.
+
+    Arguments:
+        objs (list[Model]): saved instances of a single model.
+        fields (list[str]): the encrypted fields to write, defaults to all
+            of them.
+        batch_size (int): the number of rows per UPDATE statement.
+        using (str): the database alias.
+        options: passed on to `encrypt_instances`.
+    """
+    objs = list(objs)
+    if not objs:
+        return
+
+    model = type(objs[0])
+    rows = {}
+    for obj, field, value in encrypt_instances(objs, fields, **options):
+        rows.setdefault(field, []).append((obj.pk, value.value))
+
+    for field, field_rows in rows.iteritems():
+        for start in range(0, len(field_rows), batch_size):
+            bulk_update(
+                model, field, field_rows[start:start + batch_size],
+                using=using)
+
+
+class ParallelEncryptionQuerySet(models.QuerySet):
+
+    def parallel_bulk_create(self, objs, batch_size=None, **options):
+        return parallel_bulk_create(
+            objs, batch_size=batch_size, queryset=self, **options)
+
+    def parallel_bulk_update(self, objs, fields=None, batch_size=1000,
+                             **options):
+        return parallel_bulk_update(
+            objs, fields=fields, batch_size=batch_size, using=self.db,
+            **options)
+
+
+ParallelEncryptionManager = models.Manager.from_queryset(
+    ParallelEncryptionQuerySet)
@@ -0,0 +1,180 @@
+"""
+Queries on the plaintext `skip_keys` values.
+
+Values under `skip_keys` are stored as they are, so the database can compare
+them.  The `plain` transform selects one of them as text, the next lookup
+names are the path:
+
+    Model.objects.filter(data__plain__tenant='acme')
+    Model.objects.filter(data__plain__meta__status__in=['new', 'open'])
+
+The SQL is `(data #>> '{tenant}')`, which a btree expression index on the
+same expression serves, see `operations.AddPlaintextIndex`.  Non string
+operands are compared with their json text, `True` matches `true`.
+
+On `EncryptedValueJsonBField` the `jcontains` lookup is restricted to the
+skip keys too and its operand is sent as is, so a GIN index on the column
+serves `filter(data__jcontains={'tenant': 'acme'})`.
+
+Only paths that are stored in plaintext are accepted: with `envelope=True`
+the first key must be skipped, otherwise the path must be matched by one of
+the skip rules, see `django_encrypted_json.skip_rules`.
+"""
+import json
+
+from django.core.exceptions import FieldError
+from django.db.models import CharField, Lookup, Transform
+from django_pgjson.fields import JsonAdapter
+
+
+def is_plaintext_path(field, path):
+    """
+    Returns True when the values at the path are stored in plaintext.
+
+    Arguments:
+        field (EncryptedValueJsonField): the field.
+        path (list[str]): the keys and list indexes leading to the value.
+
+    Returns:
+        bool
+    """
+    rules = getattr(field, 'skip_rules', None)
+    if not path or not rules:
+        return False
+
+    if field.envelope:
+        return rules.enter(rules.root, path[0])[0]
+
+    states = [rules.root]
+    for part in path:
+        next_states = []
+        for state in states:
+            # a lookup path doesn't say whether a part is a key or an index
+            attempts = [rules.enter(state, part)]
+            if part.isdigit():
+                attempts.append(rules.enter(state, int(part), index=True))
+            for skipped, next_state in attempts:
+                if skipped:
+                    return True
+                next_states.append(next_state)
+        states = next_states
+
+    return False
+
+
+def path_literal(path):
+    """
+    Returns the path as a postgres text array literal, `{a,b}`.
+    """
+    return u'{%s}' % u','.join(
+        u'"%s"' % part.replace(u'\\', u'\\\\').replace(u'"', u'\\"')
+        for part in path
+    )
+
+
+def path_sql(column, path):
+    """
+    Returns the SQL selecting the text at the path, with the path inlined.
+
+    The expression must be the one `PlainKeyTransform` generates for an
+    index on it to be used.
+    """
+    literal = path_literal(path).replace(u"'", u"''")
+    return u"(%s #>> '%s')" % (column, literal)
+
+
+class PlainValueField(CharField):
+    """
+    The output field of a plaintext path, operands are compared as json text.
+    """
+
+    def get_prep_value(self, value):
+        if value is None or isinstance(value, basestring):
+            return value
+        return json.dumps(value)
+
+
+class PlainKeyTransform(Transform):
+    """
+    Selects the text at a plaintext path, `(column #>> '{a,b}')`.
+    """
+
+    output_field = PlainValueField()
+
+    def __init__(self, path, *args, **kwargs):
+        super(PlainKeyTransform, self).__init__(*args, **kwargs)
+        self.path = path
+
+    def as_sql(self, qn, connection):
+        lhs, params = qn.compile(self.lhs)
+        return "(%s #>> %%s)" % lhs, params + [path_literal(self.path)]
+
+    def get_lookup(self, lookup_name):
+        lookup = super(PlainKeyTransform, self).get_lookup(lookup_name)
+        # Only checked once the path is complete, a nested skip key can
+        # follow keys that are encrypted.
+        if lookup is not None and \
+                not is_plaintext_path(self.lhs.output_field, self.path):
+            raise FieldError(
+                "'%s' of %s is not stored in plaintext" % (
+                    '__'.join(self.path), self.lhs.output_field.name))
+        return lookup
+
+    def get_transform(self, name):
+        transform = super(PlainKeyTransform, self).get_transform(name)
+        if transform:
+            return transform
+        return PlainKeyTransformFactory(self.path + [name])
+
+
+class PlainKeyTransformFactory(object):
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, lhs, lookups):
+        # Both the `plain` transform and a shorter path wrap the column, the
+        # new transform replaces them so the path is selected at once.
+        return PlainKeyTransform(self.path, lhs.lhs, lookups)
+
+
+class PlainTransform(Transform):
+    """
+    The `plain` transform, the next lookup names are the path to compare.
+    """
+
+    lookup_name = 'plain'
+
+    def as_sql(self, qn, connection):
+        raise FieldError('The plain transform needs a path')
+
+    def get_lookup(self, lookup_name):
+        return None
+
+    def get_transform(self, name):
+        return PlainKeyTransformFactory([name])
+
+
+class PlainContainsLookup(Lookup):
+    """
+    `jcontains` restricted to the skip keys, the operand is not encrypted.
+    """
+
+    lookup_name = 'jcontains'
+
+    def get_prep_lookup(self):
+        field = self.lhs.output_field
+        if not isinstance(self.rhs, dict) or not all(
+                is_plaintext_path(field, [key]) for key in self.rhs):
+            raise ValueError(
+                'jcontains on %s only accepts a dict of the skip_keys %r' % (
+                    field.name, tuple(field.skip_keys)))
+        return self.rhs
+
+    def process_rhs(self, qn, connection):
+        return '%s', [JsonAdapter(self.rhs)]
+
+    def as_sql(self, qn, connection):
+        lhs, lhs_params = self.process_lhs(qn, connection)
+        rhs, rhs_params = self.process_rhs(qn, connection)
+        params = lhs_params + rhs_params
+        return "{0} @> {1}::jsonb".format(lhs, rhs), params
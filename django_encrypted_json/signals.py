@@ -0,0 +1,14 @@
+from django.dispatch import Signal
+
+# Sent after an encrypted field encrypted or decrypted a value.  The sender
+# is the model class, see `django_encrypted_json.instrumentation`.
+_providing_args = [
+    'field', 'operation', 'leaves', 'plaintext_bytes', 'ciphertext_bytes',
+    'duration', 'fallback_leaves',
+]
+
+field_encrypted = Signal(providing_args=_providing_args)
+field_decrypted = Signal(providing_args=_providing_args)
+
+# Sent by `utils.reload_keys` after the cached keys were dropped.
+keys_reloaded = Signal()
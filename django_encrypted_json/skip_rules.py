@@ -0,0 +1,183 @@
+"""
+Compiled `skip_keys` rules.
+
+A plain key name, e.g. `'test'`, skips that key at any depth, as it always
+has, whatever characters it contains.  A rule starting with `$.` or `$[`
+is a path, which only skips the values it leads to:
+
+    '$.status'          the top level status key only
+    '$.meta.tenant'     the tenant key of the top level meta dict
+    '$.meta.*.tenant'   the tenant key of any dict inside meta
+    '$.items[*].sku'    the sku key of every item of the items list
+    '$.items[0]'        the first item of the items list
+    '$[0]'              the first item of a top level list
+
+The rules are compiled once into a trie.  The encryption walks keep the set
+of trie nodes matching the current container and step it with every key,
+so checking a key costs a few dict lookups whatever the number of rules.
+Plain key names are kept in a set.
+"""
+import re
+
+PATH_RE = re.compile(r'\[(\*|\d+)\]|([^.\[\]]+)')
+
+
+class _Node(object):
+
+    __slots__ = ('keys', 'any_key', 'items', 'any_item', 'terminal')
+
+    def __init__(self):
+        self.keys = {}
+        self.any_key = None
+        self.items = {}
+        self.any_item = None
+        self.terminal = False
+
+    def child(self, segment):
+        kind, value = segment
+        if kind == 'key':
+            if value == '*':
+                if self.any_key is None:
+                    self.any_key = _Node()
+                return self.any_key
+            return self.keys.setdefault(value, _Node())
+
+        if value == '*':
+            if self.any_item is None:
+                self.any_item = _Node()
+            return self.any_item
+        return self.items.setdefault(value, _Node())
+
+
+def parse_rule(rule):
+    """
+    Returns the `(kind, value)` segments of a path rule, kind is 'key' or
+    'item'.
+
+    Raises:
+        ValueError: if the rule is not a valid path.
+    """
+    path = rule[2:] if rule.startswith('$.') else rule[1:]
+
+    segments = []
+    position = 0
+    for match in PATH_RE.finditer(path):
+        separator = path[position:match.start()]
+        if separator not in ('', '.') or (separator == '.' and not segments):
+            raise ValueError('Invalid skip_keys path %r' % rule)
+        position = match.end()
+
+        item, key = match.groups()
+        if item is not None:
+            segments.append(('item', '*' if item == '*' else int(item)))
+        else:
+            segments.append(('key', key))
+
+    if position != len(path) or not segments:
+        raise ValueError('Invalid skip_keys path %r' % rule)
+    return segments
+
+
+def is_path_rule(rule):
+    return rule.startswith(('$.', '$['))
+
+
+class SkipRules(object):
+    """
+    The compiled skip rules of a field.
+
+    `enter(state, key)` returns whether the value under key is skipped and
+    the state of that value, the walk starts with `root`.
+    """
+
+    def __init__(self, rules=()):
+        self.rules = tuple(rules)
+        self.bare = frozenset(
+            rule for rule in self.rules if not is_path_rule(rule))
+
+        paths = [rule for rule in self.rules if is_path_rule(rule)]
+        self.root = ()
+        if paths:
+            node = _Node()
+            for rule in paths:
+                leaf = node
+                for segment in parse_rule(rule):
+                    leaf = leaf.child(segment)
+                leaf.terminal = True
+            self.root = (node,)
+
+    def __iter__(self):
+        return iter(self.rules)
+
+    def __contains__(self, key):
+        return key in self.bare
+
+    def __len__(self):
+        return len(self.rules)
+
+    def __repr__(self):
+        return '<SkipRules %r>' % (self.rules,)
+
+    def __reduce__(self):
+        return compile_skip_keys, (self.rules,)
+
+    def enter(self, state, key, index=False):
+        """
+        Returns a `(skipped, state)` tuple for the value under key.
+
+        Arguments:
+            state (tuple): the state of the container.
+            key: the dict key, or the list index when index is True.
+            index (bool): whether the container is a list.
+
+        Returns:
+            tuple(bool, tuple)
+        """
+        if not index and key in self.bare:
+            return True, ()
+        if not state:
+            return False, state
+
+        matches = []
+        for node in state:
+            if index:
+                candidates = (node.items.get(key), node.any_item)
+            else:
+                candidates = (node.keys.get(key), node.any_key)
+
+            for candidate in candidates:
+                if candidate is None:
+                    continue
+                if candidate.terminal:
+                    return True, ()
+                matches.append(candidate)
+
+        return False, tuple(matches)
+
+
+EMPTY = SkipRules()
+
+_compiled = {}
+
+
+def compile_skip_keys(skip_keys):
+    """
+    Returns the `SkipRules` of skip_keys, compiled once per list of rules.
+
+    Arguments:
+        skip_keys (list[str] or SkipRules): the rules.
+
+    Returns:
+        SkipRules
+    """
+    if isinstance(skip_keys, SkipRules):
+        return skip_keys
+    if not skip_keys:
+        return EMPTY
+
+    rules = tuple(skip_keys)
+    try:
+        return _compiled[rules]
+    except KeyError:
+        compiled = _compiled[rules] = SkipRules(rules)
+        return compiled
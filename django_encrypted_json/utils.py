@@ -1,27 +1,388 @@
+import base64
+import binascii
 import json
+import re
+import threading
 
 import cryptography.fernet
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.hmac import HMAC
 from django.conf import settings
-from django_pgjson.fields import get_encoder_class
+from django.core.signals import setting_changed
 
-# Allow the use of key rotation
-if isinstance(settings.FIELD_ENCRYPTION_KEY, (tuple, list)):
-    keys = [
-        cryptography.fernet.Fernet(k)
-        for k in settings.FIELD_ENCRYPTION_KEY
-    ]
+from . import encoding
+from .ciphers import FERNET, AEADCipher, get_token_cipher, is_aead_token, \
+    is_cipher
+from .compression import decompress
+from .encoding import get_encoder_class
+from .signals import keys_reloaded
+from .skip_rules import compile_skip_keys
 
-elif isinstance(settings.FIELD_ENCRYPTION_KEY, dict):
-    # allow the keys to be indexed in a dictionary
-    keys = [
-        cryptography.fernet.Fernet(k)
-        for k in settings.FIELD_ENCRYPTION_KEY.values()
-    ]
-else:
-    # else turn the single key into a list of one
-    keys = [cryptography.fernet.Fernet(settings.FIELD_ENCRYPTION_KEY), ]
+# Separates the key id from the Fernet token in a tagged token.
+KEY_ID_SEPARATOR = ':'
 
-crypter = cryptography.fernet.MultiFernet(keys)
+KEY_ID_RE = re.compile(r'^[A-Za-z0-9_.-]+$')
+
+
+class KeyRing(object):
+    """
+    Encrypts with the first key and decrypts with any of the keys.
+
+    This behaves like `cryptography.fernet.MultiFernet`, but the keys can be
+    named.  When `tag_tokens` is set tokens are prefixed with the name of the
+    key that encrypted them, e.g. `2016-01:gAAAAA...`, and decrypting a
+    tagged token goes straight to that key instead of trying every key in
+    turn.  Untagged tokens are still decrypted by trying each key.
+
+    With an AEAD `cipher` the tokens are written with keys derived from the
+    Fernet keys instead, see `django_encrypted_json.ciphers`.  Tokens of
+    every cipher are decrypted whatever the cipher writing them.
+    """
+
+    def __init__(self, keys, tag_tokens=False, cipher=FERNET):
+        """
+        Arguments:
+            keys (list[tuple]): `(key_id, Fernet)` pairs, the first one is
+                used to encrypt.  key_id may be None for unnamed keys.
+            tag_tokens (bool): prefix tokens with the id of the primary key.
+            cipher (str): 'fernet' or the name of a registered AEAD cipher.
+        """
+        if not keys:
+            raise ValueError("KeyRing requires at least one key")
+
+        if not is_cipher(cipher):
+            raise ValueError("Unknown cipher %r" % cipher)
+
+        self.primary_id, self.primary = keys[0]
+        self.fernets = [fernet for _, fernet in keys]
+        self._by_id = {
+            key_id: fernet
+            for key_id, fernet in keys
+            if key_id is not None
+        }
+        self._multi = cryptography.fernet.MultiFernet(self.fernets)
+        self._keys = list(keys)
+        self._aead = {}
+        self.cipher = cipher
+
+        if tag_tokens and self.primary_id is None:
+            raise ValueError("Tagged tokens require named keys")
+
+        if tag_tokens and not KEY_ID_RE.match(self.primary_id):
+            raise ValueError(
+                "Invalid key id for tagged tokens: %r" % self.primary_id)
+
+        self.tag_tokens = tag_tokens
+
+    @classmethod
+    def from_settings(cls):
+        """
+        Returns the KeyRing for settings.FIELD_ENCRYPTION_KEY.
+
+        The keys may be a single key, a list of keys or a dict of named keys,
+        use an OrderedDict so the first key is well defined.  Tokens are
+        tagged when `FIELD_ENCRYPTION_TAG_TOKENS` is True.
+
+        Returns:
+            KeyRing
+        """
+        setting = settings.FIELD_ENCRYPTION_KEY
+
+        # Allow the use of key rotation
+        if isinstance(setting, (tuple, list)):
+            keys = [(None, k) for k in setting]
+
+        elif isinstance(setting, dict):
+            # allow the keys to be indexed in a dictionary
+            keys = list(setting.items())
+        else:
+            # else turn the single key into a list of one
+            keys = [(None, setting)]
+
+        return cls(
+            [(key_id, cryptography.fernet.Fernet(k)) for key_id, k in keys],
+            tag_tokens=getattr(settings, 'FIELD_ENCRYPTION_TAG_TOKENS', False),
+            cipher=getattr(settings, 'FIELD_ENCRYPTION_CIPHER', FERNET),
+        )
+
+    def aead_keys(self, name):
+        """
+        Returns the `(key_id, AEADCipher)` pairs of the cipher, derived on
+        first use.
+
+        Returns:
+            list[tuple]
+        """
+        try:
+            return self._aead[name]
+        except KeyError:
+            keys = self._aead[name] = [
+                (key_id, AEADCipher.from_fernet(name, fernet))
+                for key_id, fernet in self._keys
+            ]
+            return keys
+
+    @property
+    def primary_aead(self):
+        """
+        The `AEADCipher` encrypting with the primary key, when the cipher is
+        not Fernet.
+        """
+        return self.aead_keys(self.cipher)[0][1]
+
+    def tag(self, token):
+        """
+        Returns the token tagged with the primary key id, if enabled.
+        """
+        if self.tag_tokens:
+            return self.primary_id + KEY_ID_SEPARATOR + token
+        return token
+
+    def has_key(self, key_id):
+        """
+        Returns True if one of the keys is named key_id.
+        """
+        return key_id in self._by_id
+
+    def key_id(self, token):
+        """
+        Returns the key id the token is tagged with, or None.
+        """
+        key_id, separator, _ = token.partition(KEY_ID_SEPARATOR)
+        if separator:
+            return key_id
+        return None
+
+    def is_primary(self, token):
+        """
+        Returns True if the token was encrypted with the primary key.
+
+        Tagged tokens are checked by their tag.  For untagged tokens only the
+        HMAC is verified, the value is not decrypted.  When tokens are tagged
+        an untagged token is never considered primary, so it gets tagged the
+        next time it is encrypted.  Tokens of another cipher than `cipher`
+        are never primary.
+        """
+        key_id, separator, body = token.partition(KEY_ID_SEPARATOR)
+        if not separator:
+            body = token
+
+        if (get_token_cipher(body) or FERNET) != self.cipher:
+            return False
+
+        if separator:
+            return key_id == self.primary_id
+
+        if self.tag_tokens:
+            return False
+
+        if self.cipher != FERNET:
+            try:
+                self.primary_aead.decrypt(token)
+            except cryptography.fernet.InvalidToken:
+                return False
+            return True
+
+        try:
+            data = base64.urlsafe_b64decode(token)
+        except (TypeError, binascii.Error):
+            return False
+
+        h = HMAC(self.primary._signing_key, hashes.SHA256(),
+                 backend=self.primary._backend)
+        h.update(data[:-32])
+        try:
+            h.verify(data[-32:])
+        except InvalidSignature:
+            return False
+        return True
+
+    def encrypt(self, data):
+        if self.cipher != FERNET:
+            return self.tag(self.primary_aead.encrypt(data))
+        return self.tag(self.primary.encrypt(data))
+
+    def decrypt(self, token):
+        key_id, separator, rest = token.partition(KEY_ID_SEPARATOR)
+
+        name = get_token_cipher(rest if separator else token)
+        if name is not None:
+            return self._decrypt_aead(
+                name, key_id if separator else None, rest or token)
+
+        if not separator:
+            return self._multi.decrypt(token)
+
+        try:
+            fernet = self._by_id[key_id]
+        except KeyError:
+            raise cryptography.fernet.InvalidToken
+        return fernet.decrypt(rest)
+
+    def _decrypt_aead(self, name, key_id, token):
+        for candidate_id, cipher in self.aead_keys(name):
+            if key_id is not None and candidate_id != key_id:
+                continue
+            try:
+                return cipher.decrypt(token)
+            except cryptography.fernet.InvalidToken:
+                continue
+        raise cryptography.fernet.InvalidToken
+
+
+# The settings the KeyRing is built from.
+KEY_SETTINGS = (
+    'FIELD_ENCRYPTION_KEY',
+    'FIELD_ENCRYPTION_TAG_TOKENS',
+    'FIELD_ENCRYPTION_CIPHER',
+)
+
+_crypter = None
+_crypter_lock = threading.Lock()
+
+
+def get_crypter():
+    """
+    Returns the KeyRing for the current settings.
+
+    The keys are parsed on first use rather than on import, and cached until
+    `reload_keys` is called.
+
+    Returns:
+        KeyRing
+    """
+    global _crypter
+
+    crypter = _crypter
+    if crypter is None:
+        with _crypter_lock:
+            if _crypter is None:
+                _crypter = KeyRing.from_settings()
+            crypter = _crypter
+    return crypter
+
+
+def reload_keys(**kwargs):
+    """
+    Drops the cached KeyRing, the keys are read again on next use.
+
+    This is connected to the `setting_changed` signal, call it directly
+    after changing the keys of a running process, e.g. from a signal
+    handler.  Sends the `keys_reloaded` signal.
+    """
+    global _crypter
+
+    if kwargs.get('setting', KEY_SETTINGS[0]) not in KEY_SETTINGS:
+        return
+
+    with _crypter_lock:
+        _crypter = None
+
+    keys_reloaded.send(sender=KeyRing)
+
+
+setting_changed.connect(reload_keys)
+
+
+class LazyKeyRing(object):
+    """
+    Forwards to the current `get_crypter()`, kept for code using `crypter`.
+    """
+
+    def __getattr__(self, name):
+        return getattr(get_crypter(), name)
+
+
+crypter = LazyKeyRing()
+
+# The key holding the encrypted document in the envelope format.
+ENVELOPE_KEY = '__encrypted__'
+
+# Every Fernet token starts with the version byte 0x80 followed by a 64 bit
+# timestamp whose high bytes are zero, which base64 encodes to this prefix.
+TOKEN_PREFIX = 'gAAAAA'
+
+# Version, timestamp, IV, one AES block and the HMAC, base64 encoded.
+TOKEN_MIN_LENGTH = 100
+
+TOKEN_RE = re.compile(r'^[A-Za-z0-9_-]+={0,2}$')
+
+
+class DecryptStats(object):
+    """
+    Counts the values `decrypt_values` returned without decrypting them.
+
+    `skipped` counts values that were not shaped like a token, usually
+    plaintext passed to `to_python` during assignment.  `invalid` counts
+    token shaped values that failed to decrypt, e.g. a lost key.  A steadily
+    growing `skipped` count points at code decrypting the same data twice.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.skipped = 0
+        self.invalid = 0
+
+    def as_dict(self):
+        return {'skipped': self.skipped, 'invalid': self.invalid}
+
+
+decrypt_stats = DecryptStats()
+
+
+def is_token(data):
+    """
+    Returns True if data has the shape of an encrypted value.
+
+    This is a cheap structural check of the version byte, the length and
+    the url safe base64 alphabet, it does not verify the token.  Tokens
+    tagged with a key id and AEAD tokens, see `django_encrypted_json.ciphers`,
+    are accepted too.
+
+    Returns:
+        bool
+    """
+    if not isinstance(data, basestring):
+        return False
+
+    if not data.startswith(TOKEN_PREFIX):
+        key_id, separator, rest = data.partition(KEY_ID_SEPARATOR)
+        if separator:
+            if not KEY_ID_RE.match(key_id):
+                return False
+            data = rest
+
+        if is_aead_token(data):
+            return True
+
+    return (
+        len(data) >= TOKEN_MIN_LENGTH and
+        len(data) % 4 == 0 and
+        data.startswith(TOKEN_PREFIX) and
+        TOKEN_RE.match(data) is not None
+    )
+
+
+def iter_tokens(data):
+    """
+    Yields `(container, key, token)` for every token in data.
+    """
+    stack = [data]
+    while stack:
+        container = stack.pop()
+        if isinstance(container, dict):
+            items = container.iteritems()
+        else:
+            items = enumerate(container)
+
+        for key, value in items:
+            if isinstance(value, (dict, list)):
+                stack.append(value)
+            elif is_token(value):
+                yield container, key, value
 
 
 def no_op_encrypt_values(data, encrypter=None, skip_keys=None):
@@ -50,108 +411,352 @@ def pick_encrypter(key, keys, encrypter):
     return encrypter
 
 
-def encrypt_values(data, encrypter=None, skip_keys=None):
+def value_to_bytes(data, encoder_class=None):
+    """
+    Returns the bytes that are encrypted for a single leaf value.
+
+    Strings are escaped with `unicode_escape`, everything else is converted
+    using `json.dumps` with the given encoder class, or the value of
+    `PGJSON_ENCODER_CLASS` when none is given.
+
+    Arguments:
+        data (object): the leaf value.
+        encoder_class: the json encoder class to use.
+
+    Returns:
+        bytes
+    """
+    if isinstance(data, basestring):
+        return data.encode('unicode_escape')
+
+    return bytes(json.dumps(data, cls=encoder_class or get_encoder_class()))
+
+
+def get_leaf_encoder():
+    """
+    Returns the function converting a leaf value to the bytes to encrypt.
+
+    This is `encoding.encode_compact` when `FIELD_ENCRYPTION_COMPACT_LEAVES`
+    is set and `value_to_bytes` otherwise.  Resolve it once per document,
+    not once per leaf.
+
+    Returns:
+        function
+    """
+    if getattr(settings, 'FIELD_ENCRYPTION_COMPACT_LEAVES', False):
+        return encoding.encode_compact
+    return value_to_bytes
+
+
+def bytes_to_value(data):
+    """
+    Returns the leaf value for decrypted bytes, in either leaf format.
+
+    Returns:
+        object
+    """
+    data = decompress(data)
+
+    if encoding.is_compact(data):
+        return encoding.decode_compact(data)
+
+    # undo the unicode_escape from `value_to_bytes`
+    return _loads(data.decode('unicode_escape'))
+
+
+def encrypt_values(data, encrypter=None, skip_keys=None, _state=None,
+                   in_place=False):
     """
     Returns data with values it contains recursively encrypted.
 
     Note that this will use `json.dumps` to convert the data to a string type.
     The encoder class will be the value of `PGJSON_ENCODER_CLASS` in the
-    settings or `django.core.serializers.json.DjangoJSONEncoder`.
+    settings or `django.core.serializers.json.DjangoJSONEncoder`.  With
+    `FIELD_ENCRYPTION_COMPACT_LEAVES` set the compact leaf format from
+    `django_encrypted_json.encoding` is used instead.
+
+    The document is walked iteratively, so its depth is not limited by the
+    recursion limit.  See `decrypt_values` for `in_place`.
 
     Arguments:
         data (object): the data to decrypt.
         encrypter (function): the decryption function to use.  If not
             specified it will use the
-            cryptography.fernet.MultiFernetMultiFernet.encrypt method
+            KeyRing.encrypt method
             with the keys being taken from settings.FIELD_ENCRYPTION_KEY
-        skip_keys (list[str]): a list of keys that should not be encrypted
+        skip_keys (list[str]): a list of keys or paths that should not be
+            encrypted, see `django_encrypted_json.skip_rules`
+        in_place (bool): replace the values in the dicts and lists of data
+            instead of copying them.
 
     Returns:
         object
     """
-    if skip_keys is None:
-        skip_keys = []
-
-    encrypter = encrypter or crypter.encrypt
-
-    if isinstance(data, (list, tuple, set)):
-        return [encrypt_values(x, encrypter, skip_keys) for x in data]
-
-    if isinstance(data, dict):
-
-        return {
-            key: pick_encrypter(key, skip_keys, encrypt_values)(
-                value, encrypter, skip_keys)
-            for key, value in data.iteritems()
-        }
-
-    if isinstance(data, basestring):
-        return encrypter(data.encode('unicode_escape'))
+    rules = compile_skip_keys(skip_keys)
+    if _state is None:
+        _state = rules.root
+
+    encrypter = encrypter or get_crypter().encrypt
+    encode_leaf = get_leaf_encoder()
+
+    root = [data]
+    stack = [(root, 0, data, _state)]
+    while stack:
+        container, key, value, state = stack.pop()
+
+        if isinstance(value, (list, tuple, set)):
+            target = _target(value, list, in_place)
+            container[key] = target
+            for index, item in enumerate(target):
+                skipped, item_state = rules.enter(state, index, index=True)
+                if not skipped:
+                    stack.append((target, index, item, item_state))
+
+        elif isinstance(value, dict):
+            target = _target(value, dict, in_place)
+            container[key] = target
+            for item_key, item in value.iteritems():
+                skipped, item_state = rules.enter(state, item_key)
+                if skipped:
+                    target[item_key] = item
+                else:
+                    stack.append((target, item_key, item, item_state))
+
+        else:
+            container[key] = encrypter(encode_leaf(value))
+
+    return root[0]
+
+
+def _target(value, kind, in_place):
+    """
+    Returns the container the walked values of value are written to.
 
-    return encrypter(
-        bytes(json.dumps(data, cls=get_encoder_class()))
-    )
+    Lists and dicts are reused in place, tuples and sets can't be and are
+    always copied.
+    """
+    if in_place and isinstance(value, kind):
+        return value
+    if kind is list:
+        return list(value)
+    return {}
 
 
-def decrypt_values(data, decrypter=None):
+def decrypt_values(data, decrypter=None, cache=None, in_place=False):
     """
     Returns data with values it contains recursively decrypted.
 
     Note that this will use `json.loads` to convert the decrypted data to
     its most likely python type.
 
+    The document is walked iteratively, so its depth is not limited by the
+    recursion limit.  By default a new tree is built next to data.  With
+    `in_place=True` the values are replaced in the dicts and lists of data
+    instead, only tuples and sets are copied to lists.  This saves a copy of
+    every container, but data is destroyed, only use it for documents
+    nothing else refers to: values just loaded from the database by the
+    exports, the key rotation and the maintenance commands, or just parsed
+    json.  Never use it on values passed in by callers, e.g. the values
+    assigned to a field, nor on values whose tokens are still needed, the
+    fields keep the stored tokens of loaded values, see
+    `django_encrypted_json.changes`.
+
     Arguments:
         data (object): the data to decrypt.
         decrypter (function): the decryption function to use.  If not
             specified it will use the
-            cryptography.fernet.MultiFernetMultiFernet.decrypt method
+            KeyRing.decrypt method
             with the keys being taken from settings.FIELD_ENCRYPTION_KEY
+        cache (DecryptionCache): an optional cache of decrypted values,
+            keyed by token.  Only values that were actually decrypted are
+            stored in it.
+        in_place (bool): replace the values in the dicts and lists of data
+            instead of copying them.
+
+    Values that are not shaped like a token, see `is_token`, are returned
+    without calling the decrypter and counted in `decrypt_stats`.
 
     Returns:
         object
     """
-    decrypter = decrypter or crypter.decrypt
+    decrypter = decrypter or get_crypter().decrypt
 
-    if isinstance(data, (list, tuple, set)):
-        return [decrypt_values(x, decrypter) for x in data]
+    root = [data]
+    stack = [(root, 0, data)]
+    while stack:
+        container, key, value = stack.pop()
 
-    if isinstance(data, dict):
-        return {
-            key: decrypt_values(value, decrypter)
-            for key, value in data.iteritems()
-        }
+        if isinstance(value, (list, tuple, set)):
+            target = _target(value, list, in_place)
+            container[key] = target
+            stack.extend(
+                (target, index, item) for index, item in enumerate(target))
 
-    if isinstance(data, basestring):
-        # string data! if we got a string or unicode convert it to
-        # bytes first, as per http://stackoverflow.com/a/11174804.
-        #
-        # Note 1: This is required for the decrypter, it only accepts bytes.
-        # Note 2: this is primarily needed because the decrypt method is called
-        # on the value during the save as well as during the read, by the
-        # django ORM.
-        data = data.encode('unicode_escape')
+        elif isinstance(value, dict):
+            target = _target(value, dict, in_place)
+            container[key] = target
+            stack.extend(
+                (target, item_key, item)
+                for item_key, item in value.iteritems())
+
+        else:
+            container[key] = decrypt_leaf(value, decrypter, cache)
+
+    return root[0]
+
+
+def decrypt_leaf(data, decrypter, cache=None):
+    """
+    Returns a single value of a document decrypted, see `decrypt_values`.
+
+    Returns:
+        object
+    """
+    if not is_token(data):
+        # Not encrypted, this is usually django calling to_python during
+        # value assignment.  Skip the decrypter entirely.
+        decrypt_stats.skipped += 1
+        if isinstance(data, basestring) and not getattr(
+                settings, 'FIELD_ENCRYPTION_COMPACT_LEAVES', False):
+            return _loads(data)
+        return data
+
+    # The decrypter only accepts bytes, tokens are always ascii.
+    token = data.encode('ascii')
+
+    if cache is not None:
+        found, value = cache.get(token)
+        if found:
+            return value
 
     try:
         # decrypt the bytes data
-        value = decrypter(data)
-    except TypeError:
-        # Not bytes data??! probably from a django field calling
-        # to_python during value assignment
-        value = data
-    except cryptography.fernet.InvalidToken:
-        # Either the data is corrupted, e.g. a lost key or the data
-        # was never encrypted, this could be from django calling to_python
-        # during value assignment.
-        value = data
+        value = decrypter(token)
+    except (TypeError, cryptography.fernet.InvalidToken):
+        # Either the data is corrupted, e.g. a lost key, or it only looks
+        # like a token.
+        decrypt_stats.invalid += 1
+        return _loads(data)
 
-    try:
-        # undo the unicode mess from earlier
-        value = value.decode('unicode_escape')
-    except AttributeError:
-        pass
+    value = bytes_to_value(value)
 
+    if cache is not None:
+        cache.set(token, value)
+
+    return value
+
+
+def _loads(value):
     try:
         return json.loads(value)
     except (ValueError, TypeError):
         # Not valid json, just return the value
         return value
+
+
+def is_envelope(data):
+    """
+    Returns True if data is a document stored by `encrypt_document`, a dict
+    with a token under `ENVELOPE_KEY`.
+
+    Returns:
+        bool
+    """
+    return isinstance(data, dict) and is_token(data.get(ENVELOPE_KEY))
+
+
+def encrypt_document(data, encrypter=None, skip_keys=None, compressor=None):
+    """
+    Returns data encrypted as a single token, the envelope format.
+
+    The whole document is converted with `json.dumps` and encrypted once,
+    which avoids paying the token overhead for every value.  The token is
+    stored under `ENVELOPE_KEY`.  When data is a dict the top level keys in
+    skip_keys are kept next to the token in plaintext, so they can still be
+    queried, e.g.
+
+        {'test': 1, '__encrypted__': 'gAAAAA...'}
+
+    Arguments:
+        data (object): the data to encrypt.
+        encrypter (function): the encryption function to use.  If not
+            specified it will use the
+            KeyRing.encrypt method
+            with the keys being taken from settings.FIELD_ENCRYPTION_KEY
+        skip_keys (list[str]): a list of top level keys that should not be
+            encrypted, rules for nested paths are ignored
+        compressor (Compressor): compresses the document before it is
+            encrypted, see `django_encrypted_json.compression`.
+
+    Returns:
+        dict
+    """
+    rules = compile_skip_keys(skip_keys)
+    encrypter = encrypter or get_crypter().encrypt
+
+    plaintext = {}
+    if isinstance(data, dict):
+        encrypted = {}
+        for key, value in data.iteritems():
+            if rules.enter(rules.root, key)[0]:
+                plaintext[key] = value
+            else:
+                encrypted[key] = value
+        data = encrypted
+
+    if getattr(settings, 'FIELD_ENCRYPTION_COMPACT_LEAVES', False):
+        # utf-8 instead of \u escapes, json.loads reads both
+        payload = json.dumps(
+            data, cls=get_encoder_class(), ensure_ascii=False
+        ).encode('utf-8')
+    else:
+        payload = bytes(json.dumps(data, cls=get_encoder_class()))
+
+    if compressor is not None:
+        payload = compressor.compress(payload)
+
+    plaintext[ENVELOPE_KEY] = encrypter(payload)
+
+    return plaintext
+
+
+def decrypt_document(data, decrypter=None):
+    """
+    Returns the document stored by `encrypt_document`.
+
+    Like `decrypt_values`, an envelope whose token can't be decrypted, e.g.
+    because its key was lost, is returned as it is.
+
+    Arguments:
+        data (dict): the envelope to decrypt.
+        decrypter (function): the decryption function to use.  If not
+            specified it will use the
+            KeyRing.decrypt method
+            with the keys being taken from settings.FIELD_ENCRYPTION_KEY
+
+    Returns:
+        object
+    """
+    decrypter = decrypter or get_crypter().decrypt
+
+    token = data[ENVELOPE_KEY]
+    if isinstance(token, unicode):
+        token = token.encode('ascii')
+
+    try:
+        payload = decrypter(token)
+    except (TypeError, cryptography.fernet.InvalidToken):
+        decrypt_stats.invalid += 1
+        return data
+
+    value = json.loads(decompress(payload))
+
+    siblings = {
+        key: item
+        for key, item in data.iteritems()
+        if key != ENVELOPE_KEY
+    }
+    if siblings and isinstance(value, dict):
+        value.update(siblings)
+
+    return value
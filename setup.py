@@ -22,7 +22,7 @@ setup(
     packages=find_packages(),
     include_package_data=False,
     install_requires=[
-        'cryptography',
+        'cryptography>=2.0',
         'django-pgjson'
     ],
     zip_safe=False,
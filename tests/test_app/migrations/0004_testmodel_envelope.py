@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django_encrypted_json.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('test_app', '0003_testmodel_partial_encrypt_w_default'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='testmodel',
+            name='envelope',
+            field=django_encrypted_json.fields.EncryptedValueJsonField(null=True, blank=True),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django_encrypted_json.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('test_app', '0006_testmodel_compressed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='testmodel',
+            name='blind',
+            field=django_encrypted_json.fields.EncryptedValueJsonField(null=True, blank=True),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django_encrypted_json.fields
+import django_encrypted_json.operations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('test_app', '0007_testmodel_blind'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='testmodel',
+            name='plain',
+            field=django_encrypted_json.fields.EncryptedValueJsonBField(null=True, blank=True),
+        ),
+        django_encrypted_json.operations.AddPlaintextIndex(
+            'testmodel', 'plain', path=['tenant'],
+        ),
+        django_encrypted_json.operations.AddPlaintextIndex(
+            'testmodel', 'plain', method='gin',
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django_encrypted_json.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('test_app', '0008_testmodel_plain'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TenantModel',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('tenant', models.CharField(max_length=32, blank=True)),
+                ('data', django_encrypted_json.fields.EncryptedValueJsonBField(null=True, blank=True)),
+                ('envelope', django_encrypted_json.fields.EncryptedValueJsonField(null=True, blank=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django_encrypted_json.fields
+import django_encrypted_json.changes
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('test_app', '0009_tenantmodel'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UnchangedModel',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('json', django_encrypted_json.fields.EncryptedValueJsonField(default={})),
+                ('envelope', django_encrypted_json.fields.EncryptedValueJsonField(null=True, blank=True)),
+            ],
+            bases=(django_encrypted_json.changes.SkipUnchangedFieldsMixin, models.Model),
+        ),
+    ]
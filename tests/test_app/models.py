@@ -1,9 +1,26 @@
 from django.db import models
 
 
-from django_encrypted_json.fields import EncryptedValueJsonField
+from django_encrypted_json.changes import SkipUnchangedFieldsMixin
+from django_encrypted_json.fields import (
+    EncryptedValueJsonBField, EncryptedValueJsonField
+)
+from django_encrypted_json.parallel import ParallelEncryptionManager
 # Create your models here.
 
+# The per tenant keys, the key provider of the tests.
+TENANT_KEYS = {}
+
+
+def get_tenant_key(key_id):
+    return TENANT_KEYS.get(key_id)
+
+
+def get_tenant_key_id(instance):
+    if not instance.tenant:
+        return None
+    return 'tenant-%s' % instance.tenant
+
 
 class TestModel(models.Model):
     json = EncryptedValueJsonField(default={})
@@ -12,3 +29,32 @@ class TestModel(models.Model):
         blank=True, null=True, skip_keys=('test', ))
     partial_encrypt_w_default = EncryptedValueJsonField(
         blank=True, skip_keys=('test', ), default=[])
+    envelope = EncryptedValueJsonField(
+        blank=True, null=True, skip_keys=('test', ), envelope=True)
+    lazy = EncryptedValueJsonField(
+        blank=True, null=True, skip_keys=('test', ), lazy=True)
+    compressed = EncryptedValueJsonField(
+        blank=True, null=True, envelope=True, compress=True,
+        compress_threshold=100)
+    blind = EncryptedValueJsonField(
+        blank=True, null=True, blind_index=('email', 'user.emails.0'))
+    plain = EncryptedValueJsonBField(
+        blank=True, null=True, skip_keys=('tenant', 'status'))
+
+    objects = ParallelEncryptionManager()
+
+
+class TenantModel(models.Model):
+    tenant = models.CharField(max_length=32, blank=True)
+    data = EncryptedValueJsonBField(
+        blank=True, null=True, key_resolver=get_tenant_key_id)
+    envelope = EncryptedValueJsonField(
+        blank=True, null=True, envelope=True, key_resolver=get_tenant_key_id)
+
+    objects = ParallelEncryptionManager()
+
+
+class UnchangedModel(SkipUnchangedFieldsMixin, models.Model):
+    json = EncryptedValueJsonField(default={})
+    envelope = EncryptedValueJsonField(
+        blank=True, null=True, skip_keys=('test', ), envelope=True)
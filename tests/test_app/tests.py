@@ -1,12 +1,69 @@
 # -*- coding=utf-8 -*-
+import bz2
 import datetime
+import hashlib
 import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+from StringIO import StringIO
 
-from django.db import connection
-from django.test import TestCase
+from cryptography.fernet import Fernet, InvalidToken
+from django import forms
+from django.conf import settings
+from django.core.exceptions import FieldError, ImproperlyConfigured
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.db.models.signals import post_save
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 
-from .models import TestModel
+from django_encrypted_json import encoding, maintenance, utils
+from django_encrypted_json.batch import encrypt_values_batch
+from django_encrypted_json.blind_index import (
+    BLIND_INDEX_KEY, blind_digest, get_blind_index_key
+)
+from django_encrypted_json.cache import DecryptionCache, get_decryption_cache
+from django_encrypted_json.changes import (
+    TrackedDict, fingerprint, get_stored, get_unchanged_fields
+)
+from django_encrypted_json.ciphers import AEADCipher, is_aead_token
+from django_encrypted_json.compression import (
+    Compressor, compression_stats, decompress, is_compressed, register_codec
+)
+from django_encrypted_json.export import iter_decrypted
+from django_encrypted_json.expressions import JsonGet, JsonSet
+from django_encrypted_json.fields import (
+    EncryptedValueJsonField, PreEncryptedValue
+)
+from django_encrypted_json.instrumentation import count_leaves
+from django_encrypted_json.key_providers import (
+    KeyCache, get_key_cache, reset_key_cache
+)
+from django_encrypted_json.lazy import (
+    _PENDING, LazyDecryptedDict, materialize
+)
+from django_encrypted_json.maintenance import (
+    bulk_update_if_unchanged, iter_keyset, rotate_values
+)
+from django_encrypted_json.operations import EncryptPlaintextValues
+from django_encrypted_json.offload import (
+    EncryptionExecutor, QueueFull, decrypt_values_async,
+    encrypt_values_async, fetch_decrypted_async, get_executor, is_small,
+    reset_executor
+)
+from django_encrypted_json.parallel import parallel_bulk_create
+from django_encrypted_json.plaintext import is_plaintext_path
+from django_encrypted_json.signals import field_decrypted, field_encrypted
+from django_encrypted_json.skip_rules import compile_skip_keys
+from django_encrypted_json.utils import (
+    KeyRing, decrypt_stats, decrypt_values, encrypt_values
+)
+
+from .models import TENANT_KEYS, TenantModel, TestModel, UnchangedModel
 # Create your tests here.
 
 
@@ -23,6 +80,19 @@ UNICODE_HODGEPODGE = \
     u"Testing «ταБЬℓσ»: 1<2 & 4+1>3, now 20% off! ÄŸÃ¼ÅŸiöçı 木下さん利用"
 
 
+def get_raw(model, pk, column):
+    """
+    Returns the value of column as it is stored, without the field.
+    """
+    cursor = connection.cursor()
+    cursor.execute(
+        'SELECT {} FROM {} WHERE id = %s'.format(
+            column, model._meta.db_table),
+        [pk]
+    )
+    return cursor.fetchone()[0]
+
+
 class PlainJsonField(TestCase):
     maxDiff = 2000
 
@@ -147,3 +217,1871 @@ class PlainJsonField(TestCase):
 
         instance.refresh_from_db()
         self.assertEqual(instance.json['test'], UNICODE_HODGEPODGE)
+
+
+class BatchEncryption(TestCase):
+
+    def setUp(self):
+        self.data = {
+            'test': 1,
+            'null': None,
+            'many': [1, 2, 3],
+            'set': set([4]),
+            'nested_1': {
+                'test': True,
+                'previous': 1.0,
+                'unicode': UNICODE_HODGEPODGE,
+            },
+            'many_nested': [{'test': 1}, {'test': 2}],
+        }
+
+    def test_batch_round_trip(self):
+        encrypted = encrypt_values_batch(self.data)
+
+        self.assertIsInstance(encrypted['test'], bytes)
+        self.assertIsInstance(encrypted['many'], list)
+        self.assertEqual(encrypted['set'], [encrypted['set'][0]])
+        self.assertNotEqual(encrypted['many'][0], encrypted['many'][1])
+
+        expected = dict(self.data, set=[4])
+        self.assertEqual(decrypt_values(encrypted), expected)
+
+    def test_batch_tokens_are_fernet_tokens(self):
+        tokens = encrypt_values_batch(['a', 'b'])
+
+        self.assertEqual(
+            [utils.get_crypter().decrypt(token) for token in tokens], ['a', 'b'])
+
+    def test_batch_skip_keys(self):
+        encrypted = encrypt_values_batch(self.data, skip_keys=('test', ))
+
+        self.assertEqual(encrypted['test'], 1)
+        self.assertEqual(encrypted['many_nested'], [{'test': 1}, {'test': 2}])
+        self.assertNotEqual(encrypted['nested_1']['previous'], 1.0)
+
+    def test_batch_scalar(self):
+        self.assertEqual(decrypt_values(encrypt_values_batch(u'value')),
+                         u'value')
+
+
+class EnvelopeJsonField(TestCase):
+
+    def test_envelope_round_trip(self):
+        data = {
+            'test': 1,
+            'many': [1, 2, 3],
+            'nested_1': {'unicode': UNICODE_HODGEPODGE},
+        }
+        instance = TestModel.objects.create(envelope=data)
+
+        raw_db_data = get_raw(TestModel, instance.pk, 'envelope')
+        self.assertEqual(
+            sorted(raw_db_data.keys()), [utils.ENVELOPE_KEY, 'test'])
+        self.assertEqual(raw_db_data['test'], 1)
+
+        instance.refresh_from_db()
+        self.assertEqual(instance.envelope, data)
+
+    def test_envelope_list(self):
+        instance = TestModel.objects.create(envelope=[1, u'two'])
+
+        raw_db_data = get_raw(TestModel, instance.pk, 'envelope')
+        self.assertEqual(list(raw_db_data.keys()), [utils.ENVELOPE_KEY])
+
+        instance.refresh_from_db()
+        self.assertEqual(instance.envelope, [1, u'two'])
+
+    def test_reads_per_value_format(self):
+        # rows written before the field switched to the envelope format
+        # are still decrypted
+        data = {'test': 1, 'other': u'value'}
+        instance = TestModel.objects.create(partial_encrypt=data)
+        cursor = connection.cursor()
+        cursor.execute(
+            "UPDATE test_app_testmodel SET envelope = partial_encrypt "
+            "WHERE id = %s", [instance.pk]
+        )
+
+        instance = TestModel.objects.get(pk=instance.pk)
+        self.assertEqual(instance.envelope, data)
+
+    def test_envelope_key_without_token_is_not_an_envelope(self):
+        data = {utils.ENVELOPE_KEY: 'x'}
+        instance = TestModel(json=data)
+        self.assertEqual(instance.json, data)
+
+    def test_envelope_key_is_reserved(self):
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                TestModel.objects.create(json={utils.ENVELOPE_KEY: 'x'})
+
+    def test_lost_key_returns_stored_envelope(self):
+        token = Fernet(Fernet.generate_key()).encrypt(b'{}')
+        stored = {'test': 1, utils.ENVELOPE_KEY: token}
+        instance = TestModel.objects.create()
+        TestModel.objects.filter(pk=instance.pk).update(
+            envelope=PreEncryptedValue(stored))
+
+        instance = TestModel.objects.get(pk=instance.pk)
+        self.assertEqual(instance.envelope, stored)
+
+
+class DecryptionCacheTests(TestCase):
+
+    def test_lru_eviction(self):
+        cache = DecryptionCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(cache.get('a'), (True, 1))
+        self.assertEqual(cache.get('b'), (False, None))
+        self.assertEqual(cache.get('c'), (True, 3))
+        self.assertEqual(
+            cache.stats(),
+            {'hits': 3, 'misses': 1, 'size': 2, 'max_size': 2})
+
+    def test_decrypt_values_uses_cache(self):
+        cache = DecryptionCache(max_size=10)
+        encrypted = encrypt_values_batch({'test': 1, 'other': u'value'})
+
+        self.assertEqual(
+            decrypt_values(encrypted, cache=cache),
+            {'test': 1, 'other': u'value'})
+        self.assertEqual(cache.misses, 2)
+
+        self.assertEqual(
+            decrypt_values(encrypted, cache=cache),
+            {'test': 1, 'other': u'value'})
+        self.assertEqual(cache.hits, 2)
+
+    def test_plaintext_is_not_cached(self):
+        cache = DecryptionCache(max_size=10)
+        decrypt_values({'test': u'plain'}, cache=cache)
+
+        self.assertEqual(len(cache), 0)
+
+    @override_settings(FIELD_ENCRYPTION_CACHE_SIZE=100)
+    def test_field_uses_cache(self):
+        instance = TestModel.objects.create(json={'test': 1})
+        TestModel.objects.get(pk=instance.pk)
+        TestModel.objects.get(pk=instance.pk)
+
+        self.assertEqual(get_decryption_cache().hits, 1)
+
+    def test_disabled_by_default(self):
+        self.assertIsNone(get_decryption_cache())
+
+
+class LazyJsonField(TestCase):
+
+    def setUp(self):
+        self.data = {
+            'test': 1,
+            'status': u'active',
+            'many': [1, 2, 3],
+            'nested_1': {'unicode': UNICODE_HODGEPODGE},
+        }
+        self.instance = TestModel.objects.create(lazy=self.data)
+
+    def test_decrypts_on_access(self):
+        instance = TestModel.objects.get(pk=self.instance.pk)
+
+        self.assertIsInstance(instance.lazy, LazyDecryptedDict)
+        self.assertEqual(instance.lazy['status'], u'active')
+        self.assertIs(instance.lazy._data['many'], _PENDING)
+        self.assertIs(instance.lazy._data['nested_1'], _PENDING)
+
+        self.assertEqual(instance.lazy, self.data)
+        self.assertEqual(materialize(instance.lazy), self.data)
+
+    def test_untouched_tokens_are_reused(self):
+        raw = get_raw(TestModel, self.instance.pk, 'lazy')
+
+        instance = TestModel.objects.get(pk=self.instance.pk)
+        instance.lazy['status']
+        instance.save()
+
+        self.assertEqual(get_raw(TestModel, self.instance.pk, 'lazy'), raw)
+
+    def test_changed_values_are_encrypted(self):
+        raw = get_raw(TestModel, self.instance.pk, 'lazy')
+
+        instance = TestModel.objects.get(pk=self.instance.pk)
+        instance.lazy['status'] = u'inactive'
+        instance.lazy['many'].append(4)
+        instance.save()
+
+        new_raw = get_raw(TestModel, self.instance.pk, 'lazy')
+        self.assertEqual(new_raw['nested_1'], raw['nested_1'])
+        self.assertEqual(new_raw['many'][:3], raw['many'])
+        self.assertTrue(utils.is_token(new_raw['many'][3]))
+        self.assertNotEqual(new_raw['status'], raw['status'])
+        self.assertTrue(utils.is_token(new_raw['status']))
+
+        instance = TestModel.objects.get(pk=self.instance.pk)
+        self.assertEqual(instance.lazy['status'], u'inactive')
+        self.assertEqual(instance.lazy['many'], [1, 2, 3, 4])
+
+    def test_form(self):
+        class Form(forms.ModelForm):
+            class Meta:
+                model = TestModel
+                fields = ['lazy']
+
+        instance = TestModel.objects.get(pk=self.instance.pk)
+        html = Form(instance=instance).as_p()
+        self.assertIn('&quot;status&quot;: &quot;active&quot;', html)
+
+        data = {'lazy': json.dumps({'status': u'new'})}
+        form = Form(data, instance=instance)
+        self.assertTrue(form.is_valid())
+        form.save()
+        instance = TestModel.objects.get(pk=self.instance.pk)
+        self.assertEqual(instance.lazy, {'status': u'new'})
+
+    def test_assigned_plaintext_is_encrypted(self):
+        self.instance.lazy = {'status': u'new'}
+        self.instance.save()
+
+        raw = get_raw(TestModel, self.instance.pk, 'lazy')
+        self.assertTrue(utils.is_token(raw['status']))
+
+
+class TokenDetection(TestCase):
+
+    def setUp(self):
+        decrypt_stats.reset()
+
+    def test_is_token(self):
+        token = encrypt_values_batch(u'value')
+
+        self.assertTrue(utils.is_token(token))
+        self.assertTrue(utils.is_token(token.decode('ascii')))
+        self.assertFalse(utils.is_token(token[:-4]))
+        self.assertFalse(utils.is_token(token[:-1] + '!'))
+        self.assertFalse(utils.is_token(u'gAAAAA'))
+        self.assertFalse(utils.is_token(LATIN1_NON_BREAKING_SPACE))
+        self.assertFalse(utils.is_token(1))
+
+    def test_plaintext_skips_decrypter(self):
+        def decrypter(data):
+            raise AssertionError('decrypter called for %r' % data)
+
+        data = {'test': 1, 'many': [u'a', u'{"b": 1}'], 'null': None}
+        self.assertEqual(
+            decrypt_values(data, decrypter),
+            {'test': 1, 'many': [u'a', {'b': 1}], 'null': None})
+        self.assertEqual(decrypt_stats.as_dict(), {'skipped': 4, 'invalid': 0})
+
+    def test_invalid_token_is_counted(self):
+        token = Fernet(Fernet.generate_key()).encrypt(b'1')
+
+        self.assertEqual(decrypt_values(token), token)
+        self.assertEqual(decrypt_stats.as_dict(), {'skipped': 0, 'invalid': 1})
+
+
+class TaggedTokens(TestCase):
+
+    def setUp(self):
+        self.old = Fernet(Fernet.generate_key())
+        self.new = Fernet(Fernet.generate_key())
+        self.ring = KeyRing([('new', self.new), ('old', self.old)],
+                            tag_tokens=True)
+
+    def test_tokens_are_tagged(self):
+        token = self.ring.encrypt(b'1')
+
+        self.assertTrue(token.startswith('new:'))
+        self.assertTrue(utils.is_token(token))
+        self.assertEqual(self.ring.key_id(token), 'new')
+        self.assertEqual(self.ring.decrypt(token), b'1')
+
+    def test_tag_selects_the_key(self):
+        token = 'old:' + self.old.encrypt(b'1')
+        self.assertEqual(self.ring.decrypt(token), b'1')
+
+        # a wrong tag is not retried with the other keys
+        with self.assertRaises(InvalidToken):
+            self.ring.decrypt('new:' + self.old.encrypt(b'1'))
+        with self.assertRaises(InvalidToken):
+            self.ring.decrypt('missing:' + self.old.encrypt(b'1'))
+
+    def test_untagged_tokens_try_each_key(self):
+        self.assertEqual(self.ring.decrypt(self.old.encrypt(b'1')), b'1')
+
+    def test_round_trip(self):
+        data = {'test': 1, 'unicode': UNICODE_HODGEPODGE}
+        encrypted = encrypt_values(data, self.ring.encrypt)
+
+        self.assertTrue(encrypted['test'].startswith('new:'))
+        self.assertEqual(decrypt_values(encrypted, self.ring.decrypt), data)
+
+    def test_requires_named_keys(self):
+        with self.assertRaises(ValueError):
+            KeyRing([(None, self.new)], tag_tokens=True)
+
+
+class AEADCiphers(TestCase):
+
+    def setUp(self):
+        self.old = Fernet(Fernet.generate_key())
+        self.new = Fernet(Fernet.generate_key())
+        self.ring = KeyRing([('new', self.new), ('old', self.old)],
+                            cipher='aes-gcm')
+
+    def test_tokens(self):
+        token = self.ring.encrypt(b'1')
+
+        self.assertTrue(token.startswith('a1.'))
+        self.assertTrue(is_aead_token(token))
+        self.assertTrue(utils.is_token(token))
+        self.assertTrue(utils.is_token(token.decode('ascii')))
+        self.assertFalse(utils.is_token(token[:-8]))
+        self.assertFalse(utils.is_token(token[:-1] + '!'))
+        self.assertEqual(self.ring.decrypt(token), b'1')
+
+        # smaller than the Fernet token of the same value
+        self.assertLess(len(token), len(self.new.encrypt(b'1')) / 2)
+
+    def test_chacha20(self):
+        ring = KeyRing([('new', self.new)], cipher='chacha20-poly1305')
+        token = ring.encrypt(UNICODE_HODGEPODGE.encode('utf-8'))
+
+        self.assertTrue(token.startswith('c1.'))
+        self.assertEqual(
+            self.ring.decrypt(token), UNICODE_HODGEPODGE.encode('utf-8'))
+
+    def test_keys_are_derived(self):
+        token = AEADCipher.from_fernet('aes-gcm', self.old).encrypt(b'1')
+        self.assertEqual(self.ring.decrypt(token), b'1')
+
+        for key in [self.old._encryption_key, self.old._signing_key]:
+            with self.assertRaises(InvalidToken):
+                AEADCipher('aes-gcm', key * 2).decrypt(token)
+
+        # the prefix is authenticated
+        with self.assertRaises(InvalidToken):
+            self.ring.decrypt('c1.' + token[3:])
+
+    def test_all_token_types_are_read(self):
+        data = {'test': 1, 'unicode': UNICODE_HODGEPODGE}
+        fernet = KeyRing([('new', self.new), ('old', self.old)])
+
+        for encrypter in [self.ring.encrypt, fernet.encrypt, self.old.encrypt]:
+            encrypted = encrypt_values(data, encrypter)
+            self.assertEqual(
+                decrypt_values(encrypted, self.ring.decrypt), data)
+            self.assertEqual(decrypt_values(encrypted, fernet.decrypt), data)
+
+    def test_tagged_tokens(self):
+        ring = KeyRing([('new', self.new), ('old', self.old)],
+                       tag_tokens=True, cipher='aes-gcm')
+        token = ring.encrypt(b'1')
+
+        self.assertTrue(token.startswith('new:a1.'))
+        self.assertTrue(utils.is_token(token))
+        self.assertEqual(self.ring.decrypt(token), b'1')
+        with self.assertRaises(InvalidToken):
+            self.ring.decrypt('old:' + token[4:])
+
+    def test_is_primary(self):
+        fernet = KeyRing([('new', self.new), ('old', self.old)])
+
+        self.assertTrue(self.ring.is_primary(self.ring.encrypt(b'1')))
+        self.assertFalse(self.ring.is_primary(fernet.encrypt(b'1')))
+        self.assertFalse(fernet.is_primary(self.ring.encrypt(b'1')))
+
+        old = KeyRing([('old', self.old)], cipher='aes-gcm')
+        self.assertFalse(self.ring.is_primary(old.encrypt(b'1')))
+
+    def test_unknown_cipher(self):
+        with self.assertRaises(ValueError):
+            KeyRing([(None, self.new)], cipher='rot13')
+
+    @override_settings(FIELD_ENCRYPTION_CIPHER='aes-gcm')
+    def test_field(self):
+        data = {'test': 1, 'nested': {'many': [1, u'two']}}
+        instance = TestModel.objects.create(json=data)
+
+        raw = get_raw(TestModel, instance.pk, 'json')
+        self.assertTrue(is_aead_token(raw['test']))
+        self.assertEqual(TestModel.objects.get(pk=instance.pk).json, data)
+
+    def test_rotation_switches_the_cipher(self):
+        data = {'test': 1, 'nested': {'many': [1, u'two']}}
+        fernet = KeyRing([('new', self.new), ('old', self.old)])
+        encrypted = encrypt_values(data, fernet.encrypt)
+
+        rotated, count, failed = rotate_values(encrypted, self.ring)
+
+        self.assertEqual((count, failed), (3, 0))
+        self.assertTrue(is_aead_token(rotated['test']))
+        self.assertEqual(decrypt_values(rotated, self.ring.decrypt), data)
+
+
+class RotateEncryptionKeysCommand(TestCase):
+
+    def setUp(self):
+        # promote the second key so the rows can still be read afterwards
+        self.old_key, self.new_key = settings.FIELD_ENCRYPTION_KEY
+        self.data = {'test': 1, 'unicode': UNICODE_HODGEPODGE}
+        self.instance = TestModel.objects.create(
+            json=self.data, partial_encrypt=self.data, envelope=self.data)
+
+    def rotate(self, *args, **kwargs):
+        stdout = StringIO()
+        keys = [self.new_key, self.old_key]
+        with override_settings(FIELD_ENCRYPTION_KEY=keys):
+            call_command(
+                'rotate_encryption_keys', *args, stdout=stdout,
+                stderr=StringIO(), **kwargs)
+        return stdout.getvalue()
+
+    def test_rotates_to_the_new_key(self):
+        new = Fernet(self.new_key)
+        output = self.rotate('test_app')
+
+        self.assertIn('test_app.testmodel.json: done 1 rows, 1 changed',
+                      output)
+        json_data = get_raw(TestModel, self.instance.pk, 'json')
+        self.assertEqual(new.decrypt(json_data['test'].encode('ascii')), '1')
+
+        partial = get_raw(TestModel, self.instance.pk, 'partial_encrypt')
+        self.assertEqual(partial['test'], 1)
+        new.decrypt(partial['unicode'].encode('ascii'))
+
+        envelope = get_raw(TestModel, self.instance.pk, 'envelope')
+        self.assertEqual(envelope['test'], 1)
+        new.decrypt(envelope[utils.ENVELOPE_KEY].encode('ascii'))
+
+        instance = TestModel.objects.get(pk=self.instance.pk)
+        self.assertEqual(instance.json, self.data)
+        self.assertEqual(instance.envelope, self.data)
+
+    def test_skips_rows_using_the_primary_key(self):
+        self.rotate()
+        raw = get_raw(TestModel, self.instance.pk, 'json')
+
+        output = self.rotate()
+        self.assertIn('test_app.testmodel.json: done 1 rows, 0 changed',
+                      output)
+        self.assertEqual(get_raw(TestModel, self.instance.pk, 'json'), raw)
+
+    def test_keeps_rows_written_meanwhile(self):
+        field = TestModel._meta.get_field('json')
+        (pk, value, text), = next(iter_keyset(TestModel, field, 10))
+        self.assertEqual(json.loads(text), value)
+
+        # the application saves the row after it was read
+        TestModel.objects.filter(pk=pk).update(json={'test': u'new'})
+        self.assertEqual(bulk_update_if_unchanged(
+            TestModel, field, [(pk, text, {'test': u'old'})]), 0)
+        self.assertEqual(
+            TestModel.objects.get(pk=pk).json, {'test': u'new'})
+
+        (pk, value, text), = next(iter_keyset(TestModel, field, 10))
+        self.assertEqual(bulk_update_if_unchanged(
+            TestModel, field, [(pk, text, value)]), 1)
+
+    def test_resumes_from_checkpoint(self):
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+        with open(path, 'w') as f:
+            json.dump({'test_app.testmodel.json': self.instance.pk}, f)
+
+        output = self.rotate(checkpoint=path)
+
+        self.assertIn('test_app.testmodel.json: done 0 rows', output)
+        self.assertIn('test_app.testmodel.envelope: done 1 rows', output)
+        with open(path) as f:
+            self.assertEqual(
+                json.load(f)['test_app.testmodel.envelope'],
+                self.instance.pk)
+
+
+class EncryptPlaintextCommand(TestCase):
+
+    def setUp(self):
+        self.token = utils.encrypt_values(u'secret')
+        self.instance = TestModel.objects.create()
+        # rows written while the columns were plaintext json
+        TestModel.objects.filter(pk=self.instance.pk).update(
+            json=PreEncryptedValue({'test': 1, 'items': ['a', None]}),
+            partial_encrypt=PreEncryptedValue(
+                {'test': 1, 'done': self.token, 'todo': u'plain'}),
+            envelope=PreEncryptedValue({'test': 1, 'other': 2}),
+            blind=PreEncryptedValue({'email': u'someone@example.com'}),
+        )
+
+    def encrypt(self, *args, **kwargs):
+        stdout = StringIO()
+        stderr = StringIO()
+        call_command(
+            'encrypt_plaintext_json', *args, stdout=stdout, stderr=stderr,
+            **kwargs)
+        return stdout.getvalue(), stderr.getvalue()
+
+    def test_encrypts_plaintext_values(self):
+        output, _ = self.encrypt('test_app.testmodel')
+
+        self.assertIn(
+            'test_app.testmodel.json: encrypted 3 plaintext values', output)
+        self.assertIn('test_app.testmodel.json: done 1 rows, 1 changed',
+                      output)
+
+        json_data = get_raw(TestModel, self.instance.pk, 'json')
+        self.assertTrue(utils.is_token(json_data['test']))
+        self.assertTrue(all(utils.is_token(v) for v in json_data['items']))
+
+        partial = get_raw(TestModel, self.instance.pk, 'partial_encrypt')
+        self.assertEqual(partial['test'], 1)
+        self.assertEqual(partial['done'], self.token)
+        self.assertTrue(utils.is_token(partial['todo']))
+
+        envelope = get_raw(TestModel, self.instance.pk, 'envelope')
+        self.assertTrue(utils.is_envelope(envelope))
+        self.assertTrue(TestModel.objects.filter(
+            blind__blind__email=u'someone@example.com').exists())
+
+        instance = TestModel.objects.get(pk=self.instance.pk)
+        self.assertEqual(instance.json, {'test': 1, 'items': ['a', None]})
+        self.assertEqual(
+            instance.partial_encrypt,
+            {'test': 1, 'done': u'secret', 'todo': u'plain'})
+        self.assertEqual(instance.envelope, {'test': 1, 'other': 2})
+
+    def test_leaves_encrypted_rows_alone(self):
+        self.encrypt('test_app.testmodel')
+        raw = get_raw(TestModel, self.instance.pk, 'json')
+
+        output, _ = self.encrypt('test_app.testmodel')
+        self.assertIn('test_app.testmodel.json: done 1 rows, 0 changed',
+                      output)
+        self.assertEqual(get_raw(TestModel, self.instance.pk, 'json'), raw)
+
+    def test_dry_run_writes_nothing(self):
+        output, _ = self.encrypt('test_app.testmodel', dry_run=True)
+
+        self.assertIn(
+            'test_app.testmodel.partial_encrypt: found 1 plaintext values, '
+            '5 bytes, in 1 rows', output)
+        self.assertEqual(
+            get_raw(TestModel, self.instance.pk, 'json'),
+            {'test': 1, 'items': ['a', None]})
+
+    def test_resumes_from_checkpoint(self):
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+        with open(path, 'w') as f:
+            json.dump({'test_app.testmodel.json': self.instance.pk}, f)
+
+        output, _ = self.encrypt('test_app.testmodel', checkpoint=path)
+
+        self.assertIn('test_app.testmodel.json: done 0 rows', output)
+        self.assertEqual(
+            get_raw(TestModel, self.instance.pk, 'json')['test'], 1)
+        with open(path) as f:
+            self.assertEqual(
+                json.load(f)['test_app.testmodel.envelope'],
+                self.instance.pk)
+
+    def test_keeps_rows_written_meanwhile(self):
+        read = maintenance.iter_keyset
+
+        def iter_keyset(*args, **kwargs):
+            for rows in read(*args, **kwargs):
+                # the application saves the row after it was read
+                TestModel.objects.filter(pk=self.instance.pk).update(
+                    json={'test': u'new'})
+                yield rows
+
+        maintenance.iter_keyset = iter_keyset
+        self.addCleanup(setattr, maintenance, 'iter_keyset', read)
+        output, errors = self.encrypt('test_app.testmodel')
+
+        self.assertIn('test_app.testmodel.json: done 1 rows, 0 changed',
+                      output)
+        self.assertIn(
+            'test_app.testmodel.json: 1 rows were written while they were '
+            'encrypted', errors)
+        self.assertEqual(
+            TestModel.objects.get(pk=self.instance.pk).json, {'test': u'new'})
+
+    def test_skips_per_row_key_fields(self):
+        _, errors = self.encrypt('test_app.tenantmodel')
+        self.assertIn('test_app.tenantmodel.data: skipped', errors)
+
+    def test_migration_operation(self):
+        other = TestModel.objects.create()
+        TestModel.objects.filter(pk=other.pk).update(
+            json=PreEncryptedValue([1, 2]))
+
+        operation = EncryptPlaintextValues('testmodel', 'json', batch_size=1)
+        with connection.schema_editor() as editor:
+            operation.database_forwards('test_app', editor, None, None)
+
+        raw = get_raw(TestModel, self.instance.pk, 'json')
+        self.assertTrue(utils.is_token(raw['test']))
+        self.assertEqual(TestModel.objects.get(pk=other.pk).json, [1, 2])
+        raw = get_raw(TestModel, other.pk, 'json')
+        self.assertTrue(all(utils.is_token(value) for value in raw))
+        partial = get_raw(TestModel, self.instance.pk, 'partial_encrypt')
+        self.assertEqual(partial['todo'], u'plain')
+
+
+class ParallelEncryption(TestCase):
+
+    def setUp(self):
+        self.objs = [
+            TestModel(json={'test': i, 'unicode': UNICODE_HODGEPODGE},
+                      partial_encrypt={'test': i, 'other': i},
+                      envelope={'test': i, 'other': i})
+            for i in range(20)
+        ]
+
+    def assert_stored(self, offset=0):
+        pks = TestModel.objects.order_by('id').values_list('pk', flat=True)
+        partial = [get_raw(TestModel, pk, 'partial_encrypt') for pk in pks]
+        self.assertEqual(
+            [row['test'] for row in partial], list(range(20)))
+        self.assertTrue(all(utils.is_token(row['other']) for row in partial))
+        self.assertTrue(all(
+            utils.is_envelope(get_raw(TestModel, pk, 'envelope'))
+            for pk in pks))
+
+        instances = TestModel.objects.order_by('id')
+        self.assertEqual(
+            [instance.json['test'] for instance in instances],
+            [i + offset for i in range(20)])
+        self.assertEqual(
+            [instance.envelope for instance in instances],
+            [{'test': i, 'other': i} for i in range(20)])
+
+    def test_bulk_create_threads(self):
+        TestModel.objects.parallel_bulk_create(
+            self.objs, workers=4, chunk_size=3)
+
+        self.assert_stored()
+        # the instances keep their decrypted values
+        self.assertEqual(self.objs[1].json['test'], 1)
+
+    def test_bulk_create_keeps_values_without_decrypting(self):
+        calls = []
+
+        def receiver(**kwargs):
+            calls.append(kwargs)
+
+        field_decrypted.connect(receiver)
+        self.addCleanup(field_decrypted.disconnect, receiver)
+        TestModel.objects.parallel_bulk_create(self.objs, workers=2)
+
+        self.assertEqual(calls, [])
+        self.assertIsInstance(self.objs[0].json, dict)
+
+    def test_bulk_create_processes(self):
+        calls = []
+
+        def receiver(**kwargs):
+            calls.append(kwargs['field'].name)
+
+        field_encrypted.connect(receiver)
+        self.addCleanup(field_encrypted.disconnect, receiver)
+        parallel_bulk_create(
+            self.objs, workers=2, chunk_size=5, processes=True)
+
+        self.assert_stored()
+        # reported by this process
+        self.assertEqual(calls.count('json'), 20)
+
+    def test_bulk_update(self):
+        TestModel.objects.bulk_create(self.objs)
+        objs = list(TestModel.objects.order_by('id'))
+        for obj in objs:
+            obj.json['test'] += 100
+
+        TestModel.objects.parallel_bulk_update(
+            objs, fields=['json'], batch_size=7, workers=2)
+
+        self.assert_stored(offset=100)
+
+
+def record_metrics(**kwargs):
+    record_metrics.calls.append(kwargs)
+
+record_metrics.calls = []
+
+
+class Instrumentation(TestCase):
+
+    def setUp(self):
+        self.calls = []
+        field_encrypted.connect(self.receiver)
+        field_decrypted.connect(self.receiver)
+        self.addCleanup(field_encrypted.disconnect, self.receiver)
+        self.addCleanup(field_decrypted.disconnect, self.receiver)
+        record_metrics.calls = []
+
+    def receiver(self, sender, signal, **kwargs):
+        kwargs['sender'] = sender
+        self.calls.append(kwargs)
+
+    def test_signals(self):
+        instance = TestModel.objects.create(json={'test': 1, 'many': [1, 2]})
+        self.calls = []
+
+        instance.save()
+        encrypt = [c for c in self.calls if c['operation'] == 'encrypt']
+        self.assertEqual(encrypt[0]['sender'], TestModel)
+        self.assertEqual(encrypt[0]['field'].name, 'json')
+        self.assertEqual(encrypt[0]['leaves'], 3)
+        self.assertEqual(
+            encrypt[0]['plaintext_bytes'],
+            len(json.dumps({'test': 1, 'many': [1, 2]})))
+        self.assertGreater(
+            encrypt[0]['ciphertext_bytes'], encrypt[0]['plaintext_bytes'])
+
+        self.calls = []
+        TestModel.objects.get(pk=instance.pk)
+        decrypt = [c for c in self.calls if c['field'].name == 'json']
+        self.assertEqual(decrypt[0]['operation'], 'decrypt')
+        self.assertEqual(decrypt[0]['leaves'], 3)
+        self.assertEqual(decrypt[0]['fallback_leaves'], 0)
+
+    def test_fallback_leaves(self):
+        instance = TestModel()
+        self.calls = []
+
+        instance.json = {'test': 1, 'many': [1, 2]}
+        self.assertEqual(self.calls[0]['fallback_leaves'], 3)
+
+    @override_settings(
+        FIELD_ENCRYPTION_METRICS_CALLBACK='test_app.tests.record_metrics')
+    def test_callback(self):
+        field_encrypted.disconnect(self.receiver)
+        field_decrypted.disconnect(self.receiver)
+
+        TestModel.objects.create(json={'test': 1})
+        self.assertIn(
+            ('json', 'encrypt', 1),
+            [(c['field'].name, c['operation'], c['leaves'])
+             for c in record_metrics.calls])
+
+    @override_settings(FIELD_ENCRYPTION_SLOW_THRESHOLD=0)
+    def test_slow_operations_are_logged(self):
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger = logging.getLogger('django_encrypted_json')
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+
+        TestModel.objects.create(json={'test': 1})
+        self.assertIn(
+            'Slow encrypt of TestModel.json',
+            [r.getMessage().split(':')[0] for r in records])
+
+
+class KeyRegistry(TestCase):
+
+    def test_keys_are_loaded_on_first_use(self):
+        utils.reload_keys()
+        self.assertIsNone(utils._crypter)
+
+        crypter = utils.get_crypter()
+        self.assertIs(utils.get_crypter(), crypter)
+        self.assertIs(utils.crypter.primary, crypter.primary)
+
+    def test_setting_change_reloads_keys(self):
+        key = Fernet.generate_key()
+        keys = [key] + list(settings.FIELD_ENCRYPTION_KEY)
+
+        with override_settings(FIELD_ENCRYPTION_KEY=keys):
+            instance = TestModel.objects.create(json={'test': 1})
+            token = instance._meta.get_field('json').encrypt(1)
+            self.assertEqual(Fernet(key).decrypt(token), '1')
+            self.assertEqual(
+                TestModel.objects.get(pk=instance.pk).json, {'test': 1})
+
+        self.assertNotEqual(utils.get_crypter().fernets[0]._signing_key,
+                            Fernet(key)._signing_key)
+
+    @override_settings(FIELD_ENCRYPTION_CACHE_SIZE=10)
+    def test_reload_clears_the_cache(self):
+        cache = get_decryption_cache()
+        decrypt_values(encrypt_values_batch(1), cache=cache)
+        self.assertEqual(len(cache), 1)
+
+        utils.reload_keys()
+        self.assertIsNot(get_decryption_cache(), cache)
+
+
+class CompactLeaves(TestCase):
+
+    values = [
+        u'', u'text', UNICODE_HODGEPODGE, u'1', u'[1, 2]', 0, 1, -1, 127, 128,
+        -129, 2 ** 70, -(2 ** 70), 1.5, -0.0, True, False, None,
+    ]
+
+    def test_round_trip(self):
+        for value in self.values:
+            payload = encoding.encode_compact(value)
+            self.assertTrue(encoding.is_compact(payload))
+            decoded = encoding.decode_compact(payload)
+            self.assertEqual(decoded, value)
+            self.assertIs(type(decoded), type(value))
+
+    def test_other_types_use_the_encoder(self):
+        now = timezone.now()
+        payload = encoding.encode_compact(now)
+
+        self.assertEqual(
+            encoding.decode_compact(payload),
+            json.loads(json.dumps(now, cls=encoding.get_encoder_class())))
+
+    def test_smaller_than_legacy(self):
+        for value in [UNICODE_HODGEPODGE, 123456789, True, None, 1.0 / 3]:
+            self.assertLess(
+                len(encoding.encode_compact(value)),
+                len(utils.value_to_bytes(value)))
+
+    @override_settings(FIELD_ENCRYPTION_COMPACT_LEAVES=True)
+    def test_field_round_trip(self):
+        data = {
+            'test': 1, 'string': u'1', 'unicode': UNICODE_HODGEPODGE,
+            'many': [True, None, 2.5],
+        }
+        instance = TestModel.objects.create(json=data, envelope=data)
+
+        instance = TestModel.objects.get(pk=instance.pk)
+        self.assertEqual(instance.json, data)
+        self.assertEqual(instance.envelope, data)
+
+    def test_reads_legacy_tokens(self):
+        encrypted = encrypt_values_batch({'test': 1, 'unicode': u'ü'})
+
+        with override_settings(FIELD_ENCRYPTION_COMPACT_LEAVES=True):
+            self.assertEqual(
+                decrypt_values(encrypted), {'test': 1, 'unicode': u'ü'})
+
+    def test_encoder_class_is_cached(self):
+        self.assertIs(
+            encoding.get_encoder_class(), encoding.get_encoder_class())
+
+
+class Compression(TestCase):
+
+    def setUp(self):
+        compression_stats.reset()
+        self.data = {
+            'items': [{'sku': u'SKU-%04d' % i, 'qty': i} for i in range(50)],
+            'note': LATIN1_NON_BREAKING_SPACE,
+        }
+
+    def test_document_round_trip(self):
+        instance = TestModel.objects.create(compressed=self.data)
+        raw = get_raw(TestModel, instance.pk, 'compressed')
+        token = raw[utils.ENVELOPE_KEY].encode('ascii')
+        payload = utils.get_crypter().decrypt(token)
+
+        self.assertTrue(is_compressed(payload))
+        self.assertEqual(compression_stats.compressed, 1)
+        self.assertGreater(compression_stats.report()['ratio'], 2)
+
+        instance = TestModel.objects.get(pk=instance.pk)
+        self.assertEqual(instance.compressed, self.data)
+
+    def test_small_values_are_not_compressed(self):
+        instance = TestModel.objects.create(compressed={'test': 1})
+        raw = get_raw(TestModel, instance.pk, 'compressed')
+        token = raw[utils.ENVELOPE_KEY].encode('ascii')
+
+        self.assertFalse(
+            is_compressed(utils.get_crypter().decrypt(token)))
+        self.assertEqual(compression_stats.skipped, 1)
+
+    def test_leaves(self):
+        compressor = Compressor(threshold=10)
+        encrypted = encrypt_values_batch(
+            {'short': u'a', 'long': LATIN1_NON_BREAKING_SPACE},
+            compressor=compressor)
+
+        self.assertEqual(compression_stats.compressed, 1)
+        self.assertEqual(
+            decrypt_values(encrypted),
+            {'short': u'a', 'long': LATIN1_NON_BREAKING_SPACE})
+
+    def test_custom_codec(self):
+        register_codec(b'bz2', bz2.compress, bz2.decompress)
+        compressor = Compressor(b'bz2', threshold=0)
+        payload = compressor.compress(b'abc' * 100)
+
+        self.assertTrue(payload.startswith(b'\xc2bz2:'))
+        self.assertEqual(decompress(payload), b'abc' * 100)
+
+
+class BlindIndex(TestCase):
+
+    def setUp(self):
+        self.first = TestModel.objects.create(blind={
+            'email': u'first@example.com',
+            'user': {'emails': [u'first@example.com', u'other@example.com']},
+        })
+        self.second = TestModel.objects.create(blind={
+            'email': u'second@example.com',
+            'user': {'emails': []},
+        })
+
+    def test_digests_are_stored(self):
+        raw = get_raw(TestModel, self.first.pk, 'blind')
+
+        self.assertTrue(utils.is_token(raw['email']))
+        self.assertEqual(raw[BLIND_INDEX_KEY], {
+            'email': blind_digest('email', u'first@example.com'),
+            'user.emails.0': blind_digest(
+                'user.emails.0', u'first@example.com'),
+        })
+        # the missing path is left out
+        raw = get_raw(TestModel, self.second.pk, 'blind')
+        self.assertEqual(raw[BLIND_INDEX_KEY].keys(), ['email'])
+
+    def test_index_is_hidden(self):
+        instance = TestModel.objects.get(pk=self.first.pk)
+
+        self.assertNotIn(BLIND_INDEX_KEY, instance.blind)
+        self.assertEqual(instance.blind['email'], u'first@example.com')
+
+    def test_exact(self):
+        queryset = TestModel.objects.filter(
+            blind__blind__email=u'second@example.com')
+        self.assertEqual(list(queryset), [self.second])
+
+        queryset = TestModel.objects.filter(
+            **{'blind__blind__user.emails.0': u'first@example.com'})
+        self.assertEqual(list(queryset), [self.first])
+
+        self.assertFalse(TestModel.objects.filter(
+            blind__blind__email=u'other@example.com').exists())
+
+    def test_in_and_isnull(self):
+        queryset = TestModel.objects.filter(blind__blind__email__in=[
+            u'first@example.com', u'second@example.com'])
+        self.assertEqual(set(queryset), {self.first, self.second})
+
+        queryset = TestModel.objects.filter(
+            **{'blind__blind__user.emails.0__isnull': True})
+        self.assertEqual(list(queryset), [self.second])
+
+    def test_updates_follow_the_value(self):
+        self.first.blind['email'] = u'changed@example.com'
+        self.first.save()
+
+        self.assertEqual(list(TestModel.objects.filter(
+            blind__blind__email=u'changed@example.com')), [self.first])
+
+    def test_unknown_path(self):
+        with self.assertRaises(FieldError):
+            list(TestModel.objects.filter(blind__blind__name=u'x'))
+
+        with self.assertRaises(FieldError):
+            list(TestModel.objects.filter(blind__blind__email__contains=u'x'))
+
+    def test_key_must_differ(self):
+        with override_settings(
+                FIELD_BLIND_INDEX_KEY=settings.FIELD_ENCRYPTION_KEY[0]):
+            self.assertRaises(ImproperlyConfigured, get_blind_index_key)
+
+        with override_settings(FIELD_BLIND_INDEX_KEY=None):
+            self.assertRaises(ImproperlyConfigured, get_blind_index_key)
+
+        key = settings.FIELD_ENCRYPTION_KEY[0]
+        with override_settings(FIELD_ENCRYPTION_KEY={'k1': key},
+                               FIELD_BLIND_INDEX_KEY=key):
+            self.assertRaises(ImproperlyConfigured, get_blind_index_key)
+
+    def test_index_key_is_kept_without_blind_index(self):
+        stored = {BLIND_INDEX_KEY: u'user data', 'a': 1}
+        instance = TestModel.objects.create()
+        TestModel.objects.filter(pk=instance.pk).update(
+            json=PreEncryptedValue(stored))
+
+        instance = TestModel.objects.get(pk=instance.pk)
+        self.assertEqual(instance.json, stored)
+        instance.save()
+
+        raw = get_raw(TestModel, instance.pk, 'json')
+        self.assertTrue(utils.is_token(raw[BLIND_INDEX_KEY]))
+        self.assertEqual(TestModel.objects.get(pk=instance.pk).json, stored)
+
+    def test_index_key_is_reserved(self):
+        field = TestModel._meta.get_field('blind')
+        with self.assertRaises(ValueError):
+            field.encrypt({BLIND_INDEX_KEY: u'x'})
+
+        instance = TestModel.objects.create(json={BLIND_INDEX_KEY: u'x'})
+        instance = TestModel.objects.get(pk=instance.pk)
+        self.assertEqual(instance.json, {BLIND_INDEX_KEY: u'x'})
+
+
+class PlaintextLookups(TestCase):
+
+    def setUp(self):
+        self.acme = TestModel.objects.create(plain={
+            'tenant': u'acme', 'status': {'open': True}, 'secret': u'acme'})
+        self.other = TestModel.objects.create(plain={
+            'tenant': u'other', 'status': {'open': False},
+            'items': [{'status': 5}]})
+
+    def test_plain(self):
+        queryset = TestModel.objects.filter(plain__plain__tenant=u'acme')
+        self.assertEqual(list(queryset), [self.acme])
+
+        queryset = TestModel.objects.filter(
+            plain__plain__tenant__in=[u'acme', u'other'])
+        self.assertEqual(set(queryset), {self.acme, self.other})
+
+    def test_nested_paths(self):
+        queryset = TestModel.objects.filter(plain__plain__status__open=True)
+        self.assertEqual(list(queryset), [self.acme])
+
+        # skip keys apply at any depth outside of envelopes
+        queryset = TestModel.objects.filter(
+            plain__plain__items__0__status=5)
+        self.assertEqual(list(queryset), [self.other])
+
+    def test_operand_is_not_encrypted(self):
+        queryset = TestModel.objects.filter(plain__plain__tenant=u'acme')
+        sql, params = queryset.query.sql_with_params()
+        self.assertIn(u'acme', params)
+
+        queryset = TestModel.objects.filter(
+            plain__jcontains={'tenant': u'acme'})
+        self.assertEqual(list(queryset), [self.acme])
+
+    def test_encrypted_paths_are_rejected(self):
+        with self.assertRaises(FieldError):
+            TestModel.objects.filter(plain__plain__secret=u'acme')
+
+        with self.assertRaises(ValueError):
+            TestModel.objects.filter(plain__jcontains={'secret': u'acme'})
+
+    def test_indexes_are_used(self):
+        cursor = connection.cursor()
+        cursor.execute(
+            "SELECT indexdef FROM pg_indexes "
+            "WHERE tablename = 'test_app_testmodel' AND indexdef LIKE %s",
+            ['%plain%'])
+        self.assertEqual(len(cursor.fetchall()), 2)
+
+        cursor.execute('SET enable_seqscan = off')
+        try:
+            for queryset in [
+                    TestModel.objects.filter(plain__plain__tenant=u'acme'),
+                    TestModel.objects.filter(
+                        plain__jcontains={'tenant': u'acme'})]:
+                sql, params = queryset.query.sql_with_params()
+                cursor.execute('EXPLAIN ' + sql, params)
+                plan = '\n'.join(row[0] for row in cursor.fetchall())
+                self.assertIn('_plain_', plan)
+        finally:
+            cursor.execute('SET enable_seqscan = on')
+
+
+class UnchangedValues(TestCase):
+
+    def setUp(self):
+        self.data = {'test': 1, 'nested': {'list': [1, u'two', None]}}
+        self.instance = TestModel.objects.create(
+            json=self.data, envelope=self.data, partial_encrypt=self.data)
+
+    def test_unchanged_values_keep_their_tokens(self):
+        raw = get_raw(TestModel, self.instance.pk, 'json')
+        envelope = get_raw(TestModel, self.instance.pk, 'envelope')
+
+        instance = TestModel.objects.get(pk=self.instance.pk)
+        self.assertIsInstance(instance.json, TrackedDict)
+        instance.save(update_fields=['json', 'envelope'])
+
+        self.assertEqual(get_raw(TestModel, instance.pk, 'json'), raw)
+        self.assertEqual(get_raw(TestModel, instance.pk, 'envelope'), envelope)
+
+    def test_changed_values_are_encrypted(self):
+        raw = get_raw(TestModel, self.instance.pk, 'json')
+
+        instance = TestModel.objects.get(pk=self.instance.pk)
+        instance.json['nested']['list'].append(4)
+        self.assertIsNone(get_stored(instance.json))
+        instance.save()
+
+        self.assertNotEqual(
+            get_raw(TestModel, instance.pk, 'json')['test'], raw['test'])
+        instance = TestModel.objects.get(pk=self.instance.pk)
+        self.assertEqual(instance.json['nested']['list'], [1, u'two', None, 4])
+
+    def test_unchanged_fields(self):
+        instance = TestModel.objects.get(pk=self.instance.pk)
+        instance.envelope['test'] = 2
+        self.assertEqual(
+            set(get_unchanged_fields(instance)),
+            {'json', 'partial_encrypt', 'partial_encrypt_w_default'})
+
+    def test_plaintext_rows_are_encrypted(self):
+        cursor = connection.cursor()
+        cursor.execute(
+            "UPDATE test_app_testmodel SET json = %s WHERE id = %s",
+            [json.dumps({'test': 1}), self.instance.pk])
+
+        instance = TestModel.objects.get(pk=self.instance.pk)
+        self.assertNotIsInstance(instance.json, TrackedDict)
+        instance.save()
+
+        raw = get_raw(TestModel, instance.pk, 'json')
+        self.assertTrue(utils.is_token(raw['test']))
+
+    def test_fingerprint_is_streamed(self):
+        data = {u'b': [1, u'\xe9', None], u'a': {u'c': 1.5}}
+        chunks = list(encoding.iter_canonical_bytes(data))
+
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(b''.join(chunks), encoding.canonical_bytes(data))
+        self.assertEqual(
+            fingerprint(data),
+            hashlib.sha1(encoding.canonical_bytes(data)).digest())
+        self.assertIsNone(fingerprint({'test': object()}))
+
+    def test_assigned_values_are_not_tracked(self):
+        instance = TestModel.objects.get(pk=self.instance.pk)
+        instance.json = {'test': 1}
+
+        self.assertNotIsInstance(instance.json, TrackedDict)
+        self.assertNotIn('json', get_unchanged_fields(instance))
+
+
+class SkipUnchangedFields(TestCase):
+
+    def setUp(self):
+        self.data = {'test': 1, 'other': u'value'}
+        self.instance = UnchangedModel.objects.create(
+            json=self.data, envelope=self.data)
+
+    def test_unchanged_values_are_left_out(self):
+        instance = UnchangedModel.objects.get(pk=self.instance.pk)
+        instance.envelope['test'] = 2
+
+        with CaptureQueriesContext(connection) as queries:
+            instance.save()
+
+        sql = queries.captured_queries[-1]['sql']
+        self.assertIn('"envelope"', sql)
+        self.assertNotIn('"json"', sql)
+
+    def test_unchanged_instance_is_saved(self):
+        saved = []
+
+        def receiver(instance, created, **kwargs):
+            saved.append(created)
+
+        post_save.connect(receiver, sender=UnchangedModel)
+        self.addCleanup(post_save.disconnect, receiver, sender=UnchangedModel)
+        instance = UnchangedModel.objects.get(pk=self.instance.pk)
+
+        with CaptureQueriesContext(connection) as queries:
+            instance.save()
+
+        self.assertEqual(saved, [False])
+        self.assertNotIn('UPDATE', queries.captured_queries[-1]['sql'])
+
+    def test_deleted_row_is_inserted_again(self):
+        instance = UnchangedModel.objects.get(pk=self.instance.pk)
+        UnchangedModel.objects.filter(pk=instance.pk).delete()
+
+        instance.save()
+
+        instance = UnchangedModel.objects.get(pk=self.instance.pk)
+        self.assertEqual(instance.json, self.data)
+        self.assertEqual(instance.envelope, self.data)
+
+
+@override_settings(
+    FIELD_ENCRYPTION_EXECUTOR_WORKERS=2, FIELD_ENCRYPTION_INLINE_LEAVES=10)
+class Offload(TestCase):
+
+    def setUp(self):
+        reset_executor()
+
+    def test_small_values_run_inline(self):
+        future = encrypt_values_async({'test': 1})
+
+        self.assertTrue(future.done())
+        self.assertEqual(decrypt_values(future.result()), {'test': 1})
+        self.assertEqual(get_executor().stats()['inline'], 1)
+        self.assertEqual(get_executor().stats()['submitted'], 0)
+
+    def test_leaves_are_counted_up_to_the_threshold(self):
+        class Values(list):
+            def __iter__(self):
+                for value in range(10):
+                    yield value
+                raise AssertionError('counted past the threshold')
+
+        data = {'values': [[], (), {'a': 1}] + range(20), 'test': u'plain'}
+        self.assertEqual(count_leaves(data), 22)
+        self.assertEqual(count_leaves(data, limit=5), 5)
+        self.assertFalse(is_small({'values': Values()}))
+
+    def test_large_values_are_offloaded(self):
+        data = {'values': range(100), 'test': u'plain'}
+        encrypted = encrypt_values_async(data, skip_keys=['test']).result(5)
+
+        self.assertEqual(encrypted['test'], u'plain')
+        self.assertEqual(decrypt_values_async(encrypted).result(5), data)
+
+        stats = get_executor().stats()
+        self.assertEqual(stats['submitted'], 2)
+        self.assertEqual(stats['completed'], 2)
+        self.assertEqual(stats['queued'], 0)
+        self.assertEqual(stats['workers'], 2)
+
+    def test_callbacks_and_errors(self):
+        done = []
+        future = get_executor().submit(int, 'x')
+        future.add_done_callback(done.append)
+
+        with self.assertRaises(ValueError):
+            future.result(5)
+        self.assertIsInstance(future.exception(), ValueError)
+        self.assertEqual(done, [future])
+
+    def test_full_queue_fails_fast(self):
+        executor = EncryptionExecutor(workers=1, max_queue=1)
+        self.addCleanup(executor.shutdown)
+        started = threading.Event()
+        release = threading.Event()
+
+        def job():
+            started.set()
+            return release.wait(5)
+
+        running = executor.submit(job)
+        self.assertTrue(started.wait(5))
+        queued = executor.submit(release.wait, 5)
+
+        with self.assertRaises(QueueFull):
+            executor.submit(release.wait, 5)
+
+        release.set()
+        running.result(5)
+        queued.result(5)
+
+        stats = executor.stats()
+        self.assertEqual(stats['completed'], 2)
+        self.assertEqual(stats['rejected'], 1)
+        self.assertEqual(stats['peak_queued'], 1)
+
+
+class OffloadQueryset(TransactionTestCase):
+
+    def test_fetch_decrypted(self):
+        TestModel.objects.create(json={'test': 1})
+        TestModel.objects.create(json={'test': 2})
+
+        future = fetch_decrypted_async(TestModel.objects.order_by('pk'))
+        self.assertEqual(
+            [instance.json for instance in future.result(5)],
+            [{'test': 1}, {'test': 2}])
+
+
+class PartialUpdates(TestCase):
+
+    def setUp(self):
+        self.instance = TestModel.objects.create(
+            json={'count': 1, 'nested': {'a': u'first', 'b': [1, 2]}},
+            plain={'tenant': u'acme', 'meta': {'views': 1}},
+            blind={'email': u'first@example.com', 'user': {'emails': []}},
+            envelope={'test': u'one', 'secret': u'hidden'})
+
+    def update(self, **kwargs):
+        TestModel.objects.filter(pk=self.instance.pk).update(**kwargs)
+        return TestModel.objects.get(pk=self.instance.pk)
+
+    def test_only_the_new_value_is_encrypted(self):
+        raw = get_raw(TestModel, self.instance.pk, 'plain')
+
+        instance = self.update(plain=JsonSet('plain', 'meta.views', 2))
+
+        stored = get_raw(TestModel, self.instance.pk, 'plain')
+        self.assertTrue(utils.is_token(stored['meta']['views']))
+        self.assertNotEqual(stored['meta']['views'], raw['meta']['views'])
+        self.assertEqual(stored['tenant'], u'acme')
+        self.assertEqual(
+            instance.plain, {'tenant': u'acme', 'meta': {'views': 2}})
+
+    def test_json_columns(self):
+        raw = get_raw(TestModel, self.instance.pk, 'json')
+
+        instance = self.update(
+            json=JsonSet('json', ['nested', 'b', 0], {'c': u'new'}))
+
+        stored = get_raw(TestModel, self.instance.pk, 'json')
+        self.assertEqual(stored['count'], raw['count'])
+        self.assertEqual(stored['nested']['a'], raw['nested']['a'])
+        self.assertTrue(utils.is_token(stored['nested']['b'][0]['c']))
+        self.assertEqual(instance.json, {
+            'count': 1, 'nested': {'a': u'first', 'b': [{'c': u'new'}, 2]}})
+
+    def test_missing_keys_are_created(self):
+        instance = self.update(plain=JsonSet('plain', 'status', u'open'))
+
+        raw = get_raw(TestModel, self.instance.pk, 'plain')
+        self.assertEqual(raw['status'], u'open')
+        self.assertEqual(instance.plain['status'], u'open')
+
+        instance = self.update(
+            optional_json=JsonSet('optional_json', 'count', 1))
+        self.assertEqual(instance.optional_json, {'count': 1})
+
+    def test_skip_keys_apply_below_the_path(self):
+        self.update(plain=JsonSet(
+            'plain', 'meta', {'status': u'new', 'views': 3}))
+
+        stored = get_raw(TestModel, self.instance.pk, 'plain')
+        self.assertEqual(stored['meta']['status'], u'new')
+        self.assertTrue(utils.is_token(stored['meta']['views']))
+
+    def test_blind_index_is_updated(self):
+        self.update(blind=JsonSet('blind', 'email', u'new@example.com'))
+
+        self.assertEqual(list(TestModel.objects.filter(
+            blind__blind__email=u'new@example.com')), [self.instance])
+
+        instance = self.update(blind=JsonSet(
+            'blind', 'user', {'emails': [u'user@example.com']}))
+        self.assertEqual(list(TestModel.objects.filter(
+            **{'blind__blind__user.emails.0': u'user@example.com'})),
+            [instance])
+
+        self.update(blind=JsonSet('blind', 'user', {'emails': []}))
+        self.assertNotIn(
+            'user.emails.0',
+            get_raw(TestModel, self.instance.pk, 'blind')[BLIND_INDEX_KEY])
+
+        with self.assertRaises(ValueError):
+            self.update(blind=JsonSet('blind', 'user.emails.0.domain', u'x'))
+
+    def test_envelopes(self):
+        raw = get_raw(TestModel, self.instance.pk, 'envelope')
+
+        instance = self.update(envelope=JsonSet('envelope', 'test', u'two'))
+
+        stored = get_raw(TestModel, self.instance.pk, 'envelope')
+        self.assertEqual(stored['test'], u'two')
+        self.assertEqual(
+            stored[utils.ENVELOPE_KEY], raw[utils.ENVELOPE_KEY])
+        self.assertEqual(instance.envelope['secret'], u'hidden')
+
+        with self.assertRaises(ValueError):
+            self.update(envelope=JsonSet('envelope', 'secret', u'x'))
+
+    def test_needs_postgresql_9_5(self):
+        pg_version = connection.pg_version
+        connection.pg_version = 90400
+        self.addCleanup(setattr, connection, 'pg_version', pg_version)
+
+        with self.assertRaisesRegexp(RuntimeError, 'PostgreSQL >= 9.5'):
+            self.update(json=JsonSet('json', 'count', 2))
+
+    def test_invalid_fields_and_paths(self):
+        with self.assertRaises(FieldError):
+            self.update(json=JsonSet('id', 'count', 1))
+
+        self.assertRaises(ValueError, JsonSet, 'json', '', 1)
+        self.assertRaises(ValueError, JsonSet, 'json', [], 1)
+
+
+class Projections(TestCase):
+
+    def setUp(self):
+        self.data = {
+            'status': u'open',
+            'nested': {'items': [{'sku': u'a-1'}, {'sku': u'b-2'}]},
+            'test': u'plain',
+            'large': [u'filler %d' % index for index in range(50)],
+        }
+        self.instance = TestModel.objects.create(
+            json=self.data, envelope=self.data, partial_encrypt=self.data)
+        decrypt_stats.reset()
+
+    def project(self, name, path):
+        return TestModel.objects.filter(pk=self.instance.pk).annotate(
+            value=JsonGet(name, path)).values_list('value', flat=True)[0]
+
+    def test_values(self):
+        queryset = TestModel.objects.annotate(
+            status=JsonGet('json', 'status'),
+            sku=JsonGet('json', 'nested.items.1.sku'),
+        ).values('pk', 'status', 'sku')
+
+        self.assertEqual(list(queryset), [
+            {'pk': self.instance.pk, 'status': u'open', 'sku': u'b-2'}])
+
+    def test_only_the_path_is_selected(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(
+                self.project('json', ['nested', 'items']),
+                self.data['nested']['items'])
+
+        self.assertIn('#>', queries[0]['sql'])
+        self.assertEqual(decrypt_stats.as_dict(), {'skipped': 0, 'invalid': 0})
+
+    def test_instances(self):
+        instance = TestModel.objects.defer('json').annotate(
+            status=JsonGet('json', 'status')).get(pk=self.instance.pk)
+
+        self.assertEqual(instance.status, u'open')
+        self.assertIn('json', instance.get_deferred_fields())
+
+    def test_skip_keys_and_missing_paths(self):
+        self.assertEqual(self.project('partial_encrypt', 'test'), u'plain')
+        self.assertIsNone(self.project('json', 'missing'))
+        self.assertIsNone(self.project('json', 'nested.items.5'))
+        self.assertIsNone(self.project('optional_json', 'status'))
+
+    def test_envelopes(self):
+        self.assertEqual(self.project('envelope', 'test'), u'plain')
+        self.assertEqual(self.project('envelope', 'nested.items.0.sku'),
+                         u'a-1')
+        self.assertIsNone(self.project('envelope', 'missing'))
+
+        # leaf rows that were moved to the envelope format
+        TestModel.objects.filter(pk=self.instance.pk).update(
+            json=PreEncryptedValue(utils.encrypt_document(self.data)))
+        self.assertEqual(self.project('json', 'status'), u'open')
+
+    def test_invalid_field(self):
+        with self.assertRaises(FieldError):
+            TestModel.objects.annotate(value=JsonGet('id', 'status'))
+
+
+class InPlace(TestCase):
+
+    def setUp(self):
+        self.data = {
+            'test': 1, 'nested': {'many': [1, u'two', None]},
+            'pair': (1, 2), 'unicode': UNICODE_HODGEPODGE,
+        }
+        self.expected = dict(self.data, pair=[1, 2])
+
+    def test_decrypt_in_place(self):
+        encrypted = encrypt_values(self.data)
+        nested = encrypted['nested']
+
+        decrypted = decrypt_values(encrypted, in_place=True)
+
+        self.assertIs(decrypted, encrypted)
+        self.assertIs(decrypted['nested'], nested)
+        self.assertEqual(decrypted, self.expected)
+
+    def test_copies_are_the_default(self):
+        encrypted = encrypt_values(self.data)
+        decrypted = decrypt_values(encrypted)
+
+        self.assertIsNot(decrypted['nested'], encrypted['nested'])
+        self.assertTrue(utils.is_token(encrypted['test']))
+
+        # the plaintext is left alone as well
+        self.assertEqual(self.data['nested']['many'], [1, u'two', None])
+
+    def test_encrypt_in_place(self):
+        data = json.loads(json.dumps(self.data))
+        nested = data['nested']
+
+        for encrypt in [encrypt_values, encrypt_values_batch]:
+            encrypted = encrypt(
+                json.loads(json.dumps(self.data)), in_place=True)
+            self.assertEqual(decrypt_values(encrypted), self.expected)
+
+        encrypted = encrypt_values_batch(
+            data, skip_keys=['test'], in_place=True)
+        self.assertIs(encrypted, data)
+        self.assertIs(encrypted['nested'], nested)
+        self.assertEqual(encrypted['test'], 1)
+        self.assertTrue(utils.is_token(nested['many'][0]))
+
+    def test_deep_documents(self):
+        data = leaf = {}
+        for _ in range(sys.getrecursionlimit() * 2):
+            leaf['next'] = {}
+            leaf = leaf['next']
+        leaf['value'] = u'deep'
+
+        for in_place in [False, True]:
+            value = decrypt_values(
+                encrypt_values(data, in_place=in_place), in_place=in_place)
+            while 'next' in value:
+                value = value['next']
+            self.assertEqual(value, {'value': u'deep'})
+
+    def test_field(self):
+        field = TestModel._meta.get_field('json')
+        stored = encrypt_values_batch(self.data)
+
+        value = field.decrypt(stored, in_place=True)
+
+        self.assertIs(value, stored)
+        self.assertNotIsInstance(value, TrackedDict)
+        self.assertEqual(value, self.expected)
+
+
+class TenantKeys(TestCase):
+
+    def setUp(self):
+        self.keys = {
+            'tenant-acme': Fernet.generate_key(),
+            'tenant-other': Fernet.generate_key(),
+        }
+        TENANT_KEYS.clear()
+        TENANT_KEYS.update(self.keys)
+        reset_key_cache()
+        decrypt_stats.reset()
+
+    def tearDown(self):
+        TENANT_KEYS.clear()
+        reset_key_cache()
+
+    def test_rotation_skips_the_fields(self):
+        TenantModel.objects.create(tenant='acme', data={'test': 1})
+        stdout = StringIO()
+        stderr = StringIO()
+        call_command(
+            'rotate_encryption_keys', 'test_app.tenantmodel', stdout=stdout,
+            stderr=stderr)
+
+        self.assertIn('test_app.tenantmodel.data: skipped', stderr.getvalue())
+        self.assertNotIn('could not be decrypted', stderr.getvalue())
+        self.assertNotIn('test_app.tenantmodel.data', stdout.getvalue())
+
+    def test_rows_use_their_key(self):
+        data = {'test': 1, 'nested': [u'two']}
+        acme = TenantModel.objects.create(tenant='acme', data=data)
+        other = TenantModel.objects.create(tenant='other', data=data)
+
+        token = get_raw(TenantModel, acme.pk, 'data')['test']
+        self.assertTrue(token.startswith('tenant-acme:'))
+        self.assertTrue(utils.is_token(token))
+        self.assertEqual(Fernet(self.keys['tenant-acme']).decrypt(
+            token.split(':', 1)[1].encode('ascii')), b'1')
+        self.assertTrue(
+            get_raw(TenantModel, other.pk, 'data')['test'].startswith(
+                'tenant-other:'))
+
+        # the instance keeps its plaintext
+        self.assertEqual(acme.data, data)
+        for instance in [acme, other]:
+            self.assertEqual(
+                TenantModel.objects.get(pk=instance.pk).data, data)
+
+    def test_moved_rows_use_their_new_key(self):
+        instance = TenantModel.objects.create(
+            tenant='acme', data={'test': 1}, envelope={'test': 1})
+
+        instance = TenantModel.objects.get(pk=instance.pk)
+        self.assertEqual(
+            set(get_unchanged_fields(instance)), {'data', 'envelope'})
+        instance.tenant = 'other'
+        self.assertEqual(get_unchanged_fields(instance), [])
+        instance.save()
+
+        data = get_raw(TenantModel, instance.pk, 'data')
+        envelope = get_raw(TenantModel, instance.pk, 'envelope')
+        self.assertTrue(data['test'].startswith('tenant-other:'))
+        self.assertTrue(
+            envelope[utils.ENVELOPE_KEY].startswith('tenant-other:'))
+        self.assertEqual(
+            TenantModel.objects.get(pk=instance.pk).data, {'test': 1})
+
+    def test_envelopes(self):
+        instance = TenantModel.objects.create(
+            tenant='acme', envelope={'test': 1})
+
+        raw = get_raw(TenantModel, instance.pk, 'envelope')
+        self.assertTrue(
+            raw[utils.ENVELOPE_KEY].startswith('tenant-acme:'))
+        self.assertEqual(
+            TenantModel.objects.get(pk=instance.pk).envelope, {'test': 1})
+
+    def test_default_keys(self):
+        instance = TenantModel.objects.create(data={'test': 1})
+
+        token = get_raw(TenantModel, instance.pk, 'data')['test']
+        self.assertEqual(
+            utils.get_crypter().decrypt(token.encode('ascii')), b'1')
+        self.assertEqual(
+            TenantModel.objects.get(pk=instance.pk).data, {'test': 1})
+
+    def test_unknown_keys(self):
+        with self.assertRaises(ValueError), transaction.atomic():
+            TenantModel.objects.create(tenant='missing', data={'test': 1})
+
+        instance = TenantModel.objects.create(
+            tenant='acme', data={'test': u'value'})
+        del TENANT_KEYS['tenant-acme']
+        reset_key_cache()
+
+        data = TenantModel.objects.get(pk=instance.pk).data
+        self.assertTrue(data['test'].startswith('tenant-acme:'))
+        self.assertEqual(decrypt_stats.invalid, 1)
+
+    def test_keys_are_cached(self):
+        calls = []
+
+        def provider(key_id):
+            calls.append(key_id)
+            return self.keys.get(key_id)
+
+        with override_settings(FIELD_ENCRYPTION_KEY_PROVIDER=provider):
+            for index in range(5):
+                instance = TenantModel.objects.create(
+                    tenant='acme', data={'test': index})
+                TenantModel.objects.get(pk=instance.pk)
+
+            self.assertEqual(calls, ['tenant-acme'])
+            self.assertEqual(get_key_cache().stats()['size'], 1)
+
+    def test_cache_expiry_and_size(self):
+        calls = []
+
+        def provider(key_id):
+            calls.append(key_id)
+            return self.keys.get(key_id)
+
+        cache = KeyCache(provider, max_size=1, ttl=0)
+        cache.get('tenant-acme')
+        cache.get('tenant-acme')
+        self.assertEqual(len(calls), 2)
+
+        cache = KeyCache(provider, max_size=1, ttl=60)
+        for key_id in ['tenant-acme', 'tenant-other', 'tenant-acme']:
+            cache.get(key_id)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(len(calls), 5)
+
+        with self.assertRaises(KeyError):
+            cache.get('missing')
+
+    def test_cache_is_thread_safe(self):
+        cache = KeyCache(self.keys.get, max_size=1, ttl=60)
+        errors = []
+
+        def work():
+            try:
+                for index in range(200):
+                    key_id = sorted(self.keys)[index % 2]
+                    ring = cache.get(key_id)
+                    self.assertEqual(ring.decrypt(ring.encrypt(b'1')), b'1')
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(cache), 1)
+
+    def test_parallel_bulk_create(self):
+        TenantModel.objects.parallel_bulk_create([
+            TenantModel(tenant=tenant, data={'test': tenant})
+            for tenant in ['acme', 'other', '']
+        ], workers=2)
+
+        for instance in TenantModel.objects.all():
+            self.assertEqual(instance.data, {'test': instance.tenant})
+            if instance.tenant:
+                raw = get_raw(TenantModel, instance.pk, 'data')
+                self.assertTrue(raw['test'].startswith(
+                    'tenant-%s:' % instance.tenant))
+
+    def test_updates_need_the_instance(self):
+        instance = TenantModel.objects.create(tenant='acme', data={})
+        queryset = TenantModel.objects.filter(pk=instance.pk)
+
+        with self.assertRaises(ValueError), transaction.atomic():
+            queryset.update(data={'test': 1})
+        with self.assertRaises(ValueError), transaction.atomic():
+            queryset.update(data=JsonSet('data', 'test', 1))
+
+        queryset.update(data=None)
+        self.assertIsNone(TenantModel.objects.get(pk=instance.pk).data)
+
+    def test_lazy_is_refused(self):
+        with self.assertRaises(ValueError):
+            EncryptedValueJsonField(key_resolver=lambda obj: None, lazy=True)
+
+
+class StreamingExport(TestCase):
+
+    def setUp(self):
+        self.instances = [
+            TestModel.objects.create(
+                json={'index': i},
+                envelope={'test': i, 'secret': u'secret %d' % i})
+            for i in range(25)
+        ]
+
+    def test_rows_are_decrypted_in_order(self):
+        rows = list(iter_decrypted(
+            TestModel.objects.order_by('-pk'), ['pk', 'json', 'envelope'],
+            chunk_size=4, workers=2))
+
+        self.assertEqual(
+            rows,
+            [
+                (instance.pk, {'index': i},
+                 {'test': i, 'secret': u'secret %d' % i})
+                for i, instance in reversed(list(enumerate(self.instances)))
+            ]
+        )
+
+    def test_filters_and_nulls(self):
+        queryset = TestModel.objects.filter(
+            pk__in=[instance.pk for instance in self.instances[:3]]
+        ).order_by('pk')
+
+        self.assertEqual(
+            list(iter_decrypted(queryset, ['json', 'optional_json'])),
+            [({'index': i}, None) for i in range(3)])
+
+    def test_progress(self):
+        stream = StringIO()
+        list(iter_decrypted(
+            TestModel.objects.all(), ['json'], chunk_size=10, stream=stream))
+
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(lines[-1].startswith('test_app.testmodel: done 25 rows,'))
+        self.assertNotIn('changed', lines[-1])
+
+    def test_stopping_early(self):
+        threads = threading.active_count()
+        rows = iter_decrypted(
+            TestModel.objects.order_by('pk'), ['json'], chunk_size=2,
+            prefetch=1)
+
+        self.assertEqual(next(rows), ({'index': 0},))
+        rows.close()
+        self.assertEqual(threading.active_count(), threads)
+
+    def test_cursor_is_not_holdable(self):
+        rows = iter_decrypted(
+            TestModel.objects.order_by('pk'), ['json'], chunk_size=2)
+        next(rows)
+
+        cursor = connection.cursor()
+        cursor.execute(
+            "SELECT is_holdable FROM pg_cursors "
+            "WHERE name LIKE 'django_encrypted_json_%%'")
+        self.assertEqual(cursor.fetchall(), [(False, )])
+        rows.close()
+
+
+class StreamingExportAutocommit(TransactionTestCase):
+
+    def test_export_outside_of_a_transaction(self):
+        TestModel.objects.create(json={'index': 0})
+        TestModel.objects.create(json={'index': 1})
+
+        rows = list(iter_decrypted(
+            TestModel.objects.order_by('pk'), ['json'], chunk_size=1))
+
+        self.assertEqual(rows, [({'index': 0},), ({'index': 1},)])
+        self.assertTrue(connection.get_autocommit())
+        self.assertFalse(connection.in_atomic_block)
+
+
+class SkipRules(TestCase):
+
+    def setUp(self):
+        self.data = {
+            'id': 1,
+            'user': {'id': 2, 'name': u'name'},
+            'meta': {'a': {'tenant': u't1', 'x': 1}, 'b': {'tenant': u't2'}},
+            'items': [{'sku': u'A', 'qty': 1}, {'sku': u'B', 'qty': 2}],
+            'tags': [u'one', u'two'],
+        }
+        self.rules = [
+            '$.user.id', '$.meta.*.tenant', '$.items[*].sku', '$.tags[0]',
+            '$.id']
+
+    def assert_skipped(self, encrypted):
+        self.assertEqual(encrypted['id'], 1)
+        self.assertEqual(encrypted['user']['id'], 2)
+        self.assertTrue(utils.is_token(encrypted['user']['name']))
+        self.assertEqual(encrypted['meta']['a']['tenant'], u't1')
+        self.assertEqual(encrypted['meta']['b']['tenant'], u't2')
+        self.assertTrue(utils.is_token(encrypted['meta']['a']['x']))
+        self.assertEqual(
+            [item['sku'] for item in encrypted['items']], [u'A', u'B'])
+        self.assertTrue(utils.is_token(encrypted['items'][0]['qty']))
+        self.assertEqual(encrypted['tags'][0], u'one')
+        self.assertTrue(utils.is_token(encrypted['tags'][1]))
+        self.assertEqual(decrypt_values(encrypted), self.data)
+
+    def test_encrypt_values(self):
+        self.assert_skipped(encrypt_values(self.data, skip_keys=self.rules))
+
+    def test_batch(self):
+        self.assert_skipped(
+            encrypt_values_batch(self.data, skip_keys=self.rules))
+
+    def test_lazy(self):
+        encrypted = encrypt_values_batch(self.data, skip_keys=self.rules)
+        lazy = LazyDecryptedDict(encrypted)
+        lazy['user']['name'] = u'changed'
+
+        encrypted = encrypt_values_batch(lazy, skip_keys=self.rules)
+        self.assertEqual(encrypted['user']['id'], 2)
+        self.assertEqual(decrypt_values(encrypted['user']['name']), u'changed')
+        self.assertEqual(encrypted['tags'][0], u'one')
+
+    def test_bare_keys_match_at_any_depth(self):
+        encrypted = encrypt_values_batch(self.data, skip_keys=['id'])
+
+        self.assertEqual(encrypted['id'], 1)
+        self.assertEqual(encrypted['user']['id'], 2)
+
+    def test_anchored_paths(self):
+        encrypted = encrypt_values_batch(self.data, skip_keys=['$.id'])
+
+        self.assertEqual(encrypted['id'], 1)
+        self.assertTrue(utils.is_token(encrypted['user']['id']))
+
+    def test_bare_keys_are_literal(self):
+        data = {'a.b': 1, 'a': {'b': 2}, 'c[0]': 3, '$set': 4}
+        encrypted = encrypt_values(data, skip_keys=['a.b', 'c[0]', '$set'])
+
+        self.assertEqual(encrypted['a.b'], 1)
+        self.assertEqual(encrypted['c[0]'], 3)
+        self.assertEqual(encrypted['$set'], 4)
+        self.assertTrue(utils.is_token(encrypted['a']['b']))
+
+        field = EncryptedValueJsonField(skip_keys=['a.b'])
+        self.assertTrue(is_plaintext_path(field, ['a.b']))
+        self.assertFalse(is_plaintext_path(field, ['a', 'b']))
+
+    def test_compiled_once(self):
+        self.assertIs(
+            compile_skip_keys(('a.b', 'c')), compile_skip_keys(['a.b', 'c']))
+        self.assertRaises(ValueError, compile_skip_keys, ['$.a..b'])
+
+    def test_plaintext_paths(self):
+        field = EncryptedValueJsonField(skip_keys=self.rules)
+
+        self.assertTrue(is_plaintext_path(field, ['meta', 'a', 'tenant']))
+        self.assertTrue(is_plaintext_path(field, ['items', '1', 'sku']))
+        self.assertFalse(is_plaintext_path(field, ['items', '1', 'qty']))
+        self.assertFalse(is_plaintext_path(field, ['user', 'name']))
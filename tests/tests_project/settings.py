@@ -26,6 +26,9 @@ FIELD_ENCRYPTION_KEY = [
     bytes('293xHgWwVwu1CrXTc-i1n5olreSGelFAxsbYcfWl-0k='),
 ]
 
+FIELD_BLIND_INDEX_KEY = 'c2VjcmV0LWJsaW5kLWluZGV4LWtleS1mb3ItdGVzdHM='
+FIELD_ENCRYPTION_KEY_PROVIDER = 'test_app.models.get_tenant_key'
+
 PGJSON_ENCODER_CLASS = "django.core.serializers.json.DjangoJSONEncoder"
 
 # SECURITY WARNING: don't run with debug turned on in production!
@@ -41,6 +44,7 @@ INSTALLED_APPS = (
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django_encrypted_json',
     'test_app',
 )
 